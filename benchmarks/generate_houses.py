@@ -0,0 +1,88 @@
+"""Synthetic houses modeled on houses.json, for benchmarks.
+
+Rows of houses.json are resampled and perturbed, and moved to nearby cities, so the generated
+data keeps the value ranges and the relations between fields (area, rooms, price) of the sample.
+
+    python -m benchmarks.generate_houses 100000 --output houses_100k.ndjson
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "houses.json")
+
+# City, offset from Porto in degrees (latitude, longitude) and price factor
+CITIES = [
+    ("Porto", 0.0, 0.0, 1.0),
+    ("Matosinhos", 0.03, -0.05, 0.9),
+    ("Vila Nova de Gaia", -0.04, 0.0, 0.8),
+    ("Maia", 0.08, 0.02, 0.7),
+    ("Gondomar", -0.01, 0.08, 0.65),
+    ("Braga", 0.39, 0.21, 0.6),
+    ("Aveiro", -0.52, -0.02, 0.55),
+    ("Lisboa", -2.44, -0.5, 1.3),
+]
+CITY_WEIGHTS = [0.35, 0.12, 0.12, 0.08, 0.08, 0.1, 0.05, 0.1]
+
+
+def generate_houses(n_rows, seed=42, sample_path=SAMPLE_PATH):
+    """Returns a DataFrame of n_rows synthetic houses with the columns of houses.json."""
+    rng = np.random.default_rng(seed)
+    with open(sample_path) as f:
+        sample = pd.DataFrame(json.load(f))
+
+    rows = sample.iloc[rng.integers(0, len(sample), n_rows)].reset_index(drop=True)
+    city_index = rng.choice(len(CITIES), size=n_rows, p=CITY_WEIGHTS)
+    city_names = np.array([city[0] for city in CITIES], dtype=object)
+    lat_offsets = np.array([city[1] for city in CITIES])
+    lon_offsets = np.array([city[2] for city in CITIES])
+    price_factors = np.array([city[3] for city in CITIES])
+
+    area_factor = rng.lognormal(0, 0.2, n_rows)
+    houses = pd.DataFrame({
+        "city": city_names[city_index],
+        "latitude": np.round(rows["latitude"].to_numpy() + lat_offsets[city_index] + rng.normal(0, 0.01, n_rows), 6),
+        "longitude": np.round(rows["longitude"].to_numpy() + lon_offsets[city_index] + rng.normal(0, 0.01, n_rows), 6),
+        "age": np.clip(rows["age"].to_numpy() + rng.integers(-3, 4, n_rows), 0, None),
+        "num_bedrooms": np.clip(rows["num_bedrooms"].to_numpy() + rng.integers(-1, 2, n_rows), 0, None),
+        "num_bathrooms": np.clip(rows["num_bathrooms"].to_numpy() + rng.integers(-1, 2, n_rows), 1, None),
+        "area": np.round(rows["area"].to_numpy() * area_factor, 1),
+        "is_apartment": rows["is_apartment"].to_numpy(dtype=bool),
+        "has_pool": rows["has_pool"].to_numpy(dtype=bool) ^ (rng.random(n_rows) < 0.05),
+        "garage": rows["garage"].to_numpy(dtype=bool) ^ (rng.random(n_rows) < 0.1),
+    })
+    price = rows["price"].to_numpy() * area_factor * price_factors[city_index] * rng.lognormal(0, 0.1, n_rows)
+    houses["price"] = np.round(price, -3).astype(np.int64)
+    return houses
+
+
+def write_houses(houses, path, chunk_size=100000):
+    """Writes NDJSON, or a JSON array when the path ends with .json, in chunks."""
+    as_array = path.endswith(".json")
+    with open(path, "w") as f:
+        if as_array:
+            f.write("[\n")
+        for start in range(0, len(houses), chunk_size):
+            chunk = houses.iloc[start:start + chunk_size].to_json(orient="records", lines=True)
+            if as_array:
+                chunk = chunk.strip().replace("\n", ",\n")
+                chunk += ",\n" if start + chunk_size < len(houses) else "\n"
+            f.write(chunk)
+        if as_array:
+            f.write("]\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--output", required=True, help="NDJSON file, or JSON array if it ends with .json")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    write_houses(generate_houses(args.rows, args.seed), args.output)
+
+
+if __name__ == "__main__":
+    main()
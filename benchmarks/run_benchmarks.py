@@ -0,0 +1,243 @@
+"""Load tests of the API and benchmarks of the training path.
+
+Replay a request mix against a running API (with its PostgreSQL):
+
+    python -m benchmarks.run_benchmarks api --base-url http://localhost:8000 --requests 5000 --concurrency 16
+
+or in process, without a server. The model is then trained on synthetic houses and only the
+endpoints of the mix that do not need the database are replayed, unless DB_HOST is set:
+
+    python -m benchmarks.run_benchmarks api --requests 2000
+
+Training time and peak memory against the dataset size, each size in its own process, and
+optionally against the number of cores the forest is fitted on:
+
+    python -m benchmarks.run_benchmarks training --sizes 1000,100000,1000000 --n-jobs 1,2,4
+
+Both commands print a table and can save the full report as JSON with --output.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from benchmarks.generate_houses import generate_houses
+
+DEFAULT_MIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "request_mix.jsonl")
+FEATURE_FIELDS = ["city", "latitude", "longitude", "age", "num_bedrooms", "num_bathrooms", "area", "is_apartment", "has_pool", "garage"]
+
+
+def load_mix(path, with_db):
+    with open(path) as f:
+        mix = [json.loads(line) for line in f if line.strip()]
+    return [entry for entry in mix if with_db or not entry.get("needs_db")]
+
+
+def percentiles(latencies):
+    values = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": round(float(values[0]), 3), "p95_ms": round(float(values[1]), 3), "p99_ms": round(float(values[2]), 3)}
+
+
+class RequestFactory:
+    """Builds the request of a mix entry from a pool of synthetic houses."""
+
+    def __init__(self, houses, seed):
+        self.houses = houses
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sample(self, size=1):
+        with self._lock:
+            return [self.houses[self.rng.randrange(len(self.houses))] for _ in range(size)]
+
+    def build(self, entry):
+        kwargs = {}
+        body = entry.get("body")
+        if body == "form_house":
+            kwargs["data"] = {field: self._sample()[0][field] for field in FEATURE_FIELDS}
+        elif body == "form_house_with_price":
+            # A new house each time, so the duplicate check does not answer 409
+            house = dict(self._sample()[0])
+            house["latitude"] = round(house["latitude"] + self.rng.uniform(-0.001, 0.001), 6)
+            kwargs["data"] = house
+        elif body == "json_houses":
+            kwargs["json"] = [{field: house[field] for field in FEATURE_FIELDS} for house in self._sample(entry.get("batch_size", 100))]
+        elif body == "ndjson_file":
+            content = "\n".join(json.dumps(house) for house in self._sample(entry.get("batch_size", 1000)))
+            kwargs["files"] = {"file_import": ("houses.ndjson", content, "application/x-ndjson")}
+        return entry["method"], entry["path"], kwargs
+
+
+def replay(client, mix, n_requests, concurrency, factory, seed):
+    rng = random.Random(seed)
+    schedule = rng.choices(mix, weights=[entry["weight"] for entry in mix], k=n_requests)
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+
+    def send(entry):
+        method, path, kwargs = factory.build(entry)
+        started_at = time.perf_counter()
+        response = client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started_at
+        with lock:
+            latencies[entry["name"]].append(elapsed)
+            statuses[entry["name"]][response.status_code] += 1
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, schedule))
+    wall_seconds = time.perf_counter() - started_at
+
+    endpoints = {}
+    for name, values in latencies.items():
+        endpoints[name] = {
+            "requests": len(values),
+            "throughput_rps": round(len(values) / wall_seconds, 1),
+            **percentiles(values),
+            "status_codes": dict(statuses[name])
+        }
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(n_requests / wall_seconds, 1),
+        "endpoints": endpoints
+    }
+
+
+def run_api(args):
+    houses = generate_houses(args.dataset_rows, args.seed)
+    factory = RequestFactory(houses.to_dict(orient="records"), args.seed)
+
+    if args.base_url:
+        import httpx
+        with httpx.Client(base_url=args.base_url, timeout=120) as client:
+            mix = load_mix(args.mix, with_db=True)
+            return replay(client, mix, args.requests, args.concurrency, factory, args.seed)
+
+    # In process stand-in: the app without a server, with a model trained on the synthetic houses
+    from fastapi.testclient import TestClient
+    import main
+    from training_model import registry, train_model
+
+    with_db = bool(os.getenv("DB_HOST"))
+    houses["seq"] = np.arange(1, len(houses) + 1)
+    registry.install(train_model(houses, registry.next_version(), registry.data_version))
+    mix = load_mix(args.mix, with_db)
+    if with_db:
+        with TestClient(main.app) as client:
+            return replay(client, mix, args.requests, args.concurrency, factory, args.seed)
+    return replay(TestClient(main.app), mix, args.requests, args.concurrency, factory, args.seed)
+
+
+def measure_training(n_rows, seed, n_jobs=None):
+    """Runs in a fresh process, so the peak RSS is the one of this dataset size only."""
+    import forest_training
+    from training_model import train_model
+
+    if n_jobs is not None:
+        forest_training.TRAINING_N_JOBS = n_jobs
+
+    houses = generate_houses(n_rows, seed)
+    houses["seq"] = np.arange(1, n_rows + 1)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    model = train_model(houses, 1, 0)
+    fit_seconds = time.perf_counter() - started_at
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    X = model.encoder.encode(houses.head(1000).to_dict(orient="records"))
+    started_at = time.perf_counter()
+    model.estimator.predict(X[:1])
+    single_predict_seconds = time.perf_counter() - started_at
+    started_at = time.perf_counter()
+    model.estimator.predict(X)
+    batch_predict_seconds = time.perf_counter() - started_at
+    compiled_seconds = {}
+    if model.forest is not None:
+        for size in (1, len(X)):
+            started_at = time.perf_counter()
+            model.forest.predict(X[:size])
+            compiled_seconds[size] = time.perf_counter() - started_at
+
+    return {
+        "rows": n_rows,
+        "cores": model.metrics["cores"],
+        "fit_seconds": round(fit_seconds, 3),
+        "rows_per_second": round(n_rows / fit_seconds, 1),
+        "peak_traced_mb": round(peak_traced / 2 ** 20, 1),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_before_fit_mb": round(rss_before / 1024, 1),
+        "tree_nodes": int(sum(tree.tree_.node_count for tree in model.estimator.estimators_)),
+        "predict_1_row_ms": round(single_predict_seconds * 1000, 3),
+        "predict_1000_rows_ms": round(batch_predict_seconds * 1000, 3),
+        "compiled_predict_1_row_ms": round(compiled_seconds[1] * 1000, 3) if compiled_seconds else None,
+        "compiled_predict_1000_rows_ms": round(compiled_seconds[len(X)] * 1000, 3) if compiled_seconds else None,
+        "forest_mb": round(model.metrics.get("forest_bytes", 0) / 2 ** 20, 1),
+        "compiled_forest_mb": round(model.metrics.get("compiled_forest_bytes", 0) / 2 ** 20, 1),
+        "oob_r2": round(model.metrics["oob_r2"], 4) if model.metrics["oob_r2"] is not None else None
+    }
+
+
+def run_training(args):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for n_rows in args.sizes:
+        for n_jobs in args.n_jobs or [None]:
+            with context.Pool(1) as pool:
+                results.append(pool.apply(measure_training, (n_rows, args.seed, n_jobs)))
+            print(f"trained on {n_rows} rows with {results[-1]['cores']} cores", flush=True)
+    return {"sizes": results}
+
+
+def print_report(command, report):
+    if command == "api":
+        print(f"{report['requests']} requests, concurrency {report['concurrency']}, {report['throughput_rps']} req/s")
+        print(f"{'endpoint':<16}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  status codes")
+        for name, stats in report["endpoints"].items():
+            print(f"{name:<16}{stats['requests']:>10}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}  {stats['status_codes']}")
+    else:
+        print(f"{'rows':>10}{'cores':>7}{'fit s':>10}{'rows/s':>12}{'peak traced MB':>16}{'peak RSS MB':>13}{'tree nodes':>12}")
+        for stats in report["sizes"]:
+            print(f"{stats['rows']:>10}{stats['cores']:>7}{stats['fit_seconds']:>10}{stats['rows_per_second']:>12}{stats['peak_traced_mb']:>16}{stats['peak_rss_mb']:>13}{stats['tree_nodes']:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Save the report as JSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    api = commands.add_parser("api", help="Replay a request mix against the API")
+    api.add_argument("--base-url", help="Running API, in process when omitted")
+    api.add_argument("--mix", default=DEFAULT_MIX, help="JSONL file, one weighted request type per line")
+    api.add_argument("--requests", type=int, default=2000)
+    api.add_argument("--concurrency", type=int, default=8)
+    api.add_argument("--dataset-rows", type=int, default=10000, help="Synthetic houses used for the requests (and the in process model)")
+
+    training = commands.add_parser("training", help="Training time and memory against the dataset size")
+    training.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1000, 100000, 1000000])
+    training.add_argument("--n-jobs", type=lambda value: [int(n_jobs) for n_jobs in value.split(",")], help="Cores to fit on, one run each (TRAINING_N_JOBS when omitted)")
+
+    args = parser.parse_args()
+    report = run_api(args) if args.command == "api" else run_training(args)
+    print_report(args.command, report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
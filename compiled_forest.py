@@ -0,0 +1,131 @@
+import time
+import os
+import numpy as np
+from lazy_import import lazy_import
+
+# Serving a compiled forest does not need scikit-learn, only compiling one does
+sklearn_tree = lazy_import("sklearn.tree._tree")
+
+# Rows evaluated together, the working arrays of a pass hold rows x trees node indexes
+COMPILED_PREDICT_CHUNK_ROWS = int(os.getenv("COMPILED_PREDICT_CHUNK_ROWS", "8192"))
+# One .npy file per array, loaded memory-mapped so the processes serving a model share its pages
+FOREST_ARRAYS = ("feature", "threshold", "children_left", "children_right", "missing_go_to_left", "value", "roots")
+
+
+class CompiledForest:
+    """The trees of a fitted RandomForestRegressor flattened into a few contiguous arrays.
+
+    Node i of the forest tests feature[i] <= threshold[i] and goes to children_left[i] or
+    children_right[i] (-1 at a leaf, whose prediction is value[i]); roots holds the first node of
+    each tree. Features and children are int32, thresholds and values float32, about a third of the
+    64 bytes sklearn keeps per node. Thresholds are rounded down to float32, which gives the same
+    decisions as sklearn on the float32 rows it (and FeatureEncoder) works with.
+    """
+
+    def __init__(self, feature, threshold, children_left, children_right, missing_go_to_left, value, roots, path=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.missing_go_to_left = missing_go_to_left
+        self.value = value
+        self.roots = roots
+        # Directory the arrays were saved to or loaded from
+        self.path = path
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        trees = [tree.tree_ for tree in estimator.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+        def children(tree_children, offset):
+            return np.where(tree_children >= 0, tree_children + offset, -1)
+
+        threshold = np.concatenate([tree.threshold for tree in trees])
+        rounded = threshold.astype(np.float32)
+        # float32 rounds to nearest, a threshold rounded up would send some rows to the left child sklearn sends right
+        rounded_up = rounded > threshold
+        rounded[rounded_up] = np.nextafter(rounded[rounded_up], np.float32(-np.inf))
+        return cls(
+            np.concatenate([tree.feature for tree in trees]).astype(np.int32),
+            rounded,
+            np.concatenate([children(tree.children_left, offset) for tree, offset in zip(trees, offsets)]).astype(np.int32),
+            np.concatenate([children(tree.children_right, offset) for tree, offset in zip(trees, offsets)]).astype(np.int32),
+            np.concatenate([tree.missing_go_to_left for tree in trees]).astype(bool),
+            np.concatenate([tree.value[:, 0, 0] for tree in trees]).astype(np.float32),
+            offsets[:-1].astype(np.int32)
+        )
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in FOREST_ARRAYS)
+
+    def predict(self, X, chunk_rows=None):
+        """Mean of the leaf values the rows of X (float32, the encoder layout) reach in each tree.
+
+        Evaluated chunk_rows rows at a time, so the memory of a call does not grow with the batch size.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        chunk_rows = max(1, COMPILED_PREDICT_CHUNK_ROWS if chunk_rows is None else chunk_rows)
+        if len(X) <= chunk_rows:
+            return self._predict_chunk(X)
+        return np.concatenate([self._predict_chunk(X[start:start + chunk_rows]) for start in range(0, len(X), chunk_rows)])
+
+    def _predict_chunk(self, X):
+        n_rows, n_trees = len(X), len(self.roots)
+        # Every (row, tree) pair walks down its tree one level per step, the pairs that reached a leaf drop out.
+        # Rows are read from the flattened X by offset, take on 1-d arrays is cheaper than 2-d fancy indexing
+        flat = X.ravel()
+        offsets = np.repeat(np.arange(n_rows, dtype=np.intp) * X.shape[1], n_trees)
+        nodes = np.tile(self.roots, n_rows)
+        active = np.flatnonzero(self.children_left.take(nodes) >= 0)
+        has_missing = np.isnan(flat).any()
+        while len(active):
+            current = nodes[active]
+            values = flat.take(offsets[active] + self.feature.take(current))
+            go_left = values <= self.threshold.take(current)
+            if has_missing:
+                go_left |= np.isnan(values) & self.missing_go_to_left.take(current)
+            current = np.where(go_left, self.children_left.take(current), self.children_right.take(current))
+            nodes[active] = current
+            active = active[self.children_left.take(current) >= 0]
+        # Summed in float64, as sklearn averages the trees
+        return self.value.take(nodes).reshape(n_rows, n_trees).sum(axis=1, dtype=np.float64) / n_trees
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in FOREST_ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        return cls(*(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in FOREST_ARRAYS), path=path)
+
+
+def sklearn_nbytes(estimator):
+    # Node structs and the value array every Tree keeps in memory
+    return int(sum(tree.tree_.node_count * sklearn_tree.NODE_DTYPE.itemsize + tree.tree_.value.nbytes for tree in estimator.estimators_))
+
+
+def compare(estimator, forest, X, repeats=5):
+    """Memory and single row latency of the compiled forest against the estimator, and the largest difference of their predictions on X."""
+    def best_time(predict):
+        timings = []
+        for _ in range(repeats):
+            started_at = time.perf_counter()
+            predict(X[:1])
+            timings.append(time.perf_counter() - started_at)
+        return min(timings)
+
+    return {
+        'forest_bytes': sklearn_nbytes(estimator),
+        'compiled_forest_bytes': forest.nbytes,
+        'predict_1_row_ms': round(best_time(estimator.predict) * 1000, 3),
+        'compiled_predict_1_row_ms': round(best_time(forest.predict) * 1000, 3),
+        'compiled_max_abs_error': float(np.max(np.abs(forest.predict(X) - estimator.predict(X)))) if len(X) else 0.0
+    }
@@ -0,0 +1,32 @@
+import json
+import pytest
+import pandas as pd
+from unittest.mock import patch
+from training_model import build_features
+
+
+@pytest.fixture
+def houses_df():
+    # The sample houses as a training frame, seq numbered in file order
+    with open('houses.json') as f:
+        df = pd.DataFrame(json.load(f))
+    df['seq'] = range(1, len(df) + 1)
+    return df
+
+
+@pytest.fixture
+def features(houses_df):
+    X, _, _ = build_features(houses_df)
+    return X, houses_df['price'].to_numpy()
+
+
+@pytest.fixture
+def house():
+    return {'city': 'Porto', 'latitude': 41.15706, 'longitude': -8.57466, 'age': 0, 'num_bedrooms': 3, 'num_bathrooms': 3, 'area': 100, 'is_apartment': True, 'has_pool': False, 'garage': False}
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    # Artifacts and the training snapshot of the test, instead of the directories of the API
+    with patch('model_store.MODEL_DIR', str(tmp_path / 'models')), patch('training_snapshot.TRAINING_SNAPSHOT_DIR', str(tmp_path / 'snapshot')):
+        yield tmp_path
@@ -0,0 +1,215 @@
+import psycopg2, logging
+import psycopg2.extensions
+import threading
+import time
+import os
+from contextlib import contextmanager
+from metrics import metrics_registry, query_operation, record_query
+
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_DATABASE = os.getenv("DB_DATABASE")
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections idle for longer than this are checked with a SELECT 1 before being handed out
+DB_POOL_CHECK_INTERVAL = float(os.getenv("DB_POOL_CHECK_INTERVAL", "30"))
+
+logger = logging.getLogger(__name__)
+
+POOL_WAIT_SECONDS = metrics_registry.histogram("house_api_db_pool_wait_seconds", "Time to get a connection from the pool")
+POOL_TIMEOUTS = metrics_registry.counter("house_api_db_pool_timeouts_total", "Requests that got no connection from the pool in time")
+POOL_CONNECTIONS = metrics_registry.gauge(
+    "house_api_db_pool_connections", "Connections of the pool", ["state"],
+    lambda: {(state,): value for state, value in pool.stats().items() if state != "min_size"} if pool is not None else None
+)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor counting and timing every statement, by kind (select, insert, copy, ...)."""
+
+    def _timed(self, query, run):
+        operation = query_operation(query)
+        started_at = time.perf_counter()
+        error = True
+        try:
+            result = run()
+            error = False
+            return result
+        finally:
+            record_query(operation, time.perf_counter() - started_at, error)
+
+    def execute(self, query, vars=None):
+        return self._timed(query, lambda: super(TimedCursor, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, lambda: super(TimedCursor, self).executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, lambda: super(TimedCursor, self).copy_expert(sql, file, size))
+
+
+class PoolTimeout(psycopg2.Error):
+    pass
+
+
+class ConnectionPool:
+    """Thread safe pool of psycopg2 connections.
+
+    Each checkout runs in its own transaction, which is rolled back when the caller did not commit it.
+    Connections that are closed, fail the health check or raise a connection error are discarded
+    and replaced by new ones on demand, so the pool recovers on its own after a database restart.
+    """
+
+    def __init__(self, min_size, max_size, timeout, check_interval, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._connect_kwargs = connect_kwargs
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._last_used = {}
+        self.in_use = 0
+        self.closed = False
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        return psycopg2.connect(**self._connect_kwargs)
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as error:
+            logger.warning(f"Discarding broken database connection: {error}")
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection pool is closed")
+        started_at = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            POOL_TIMEOUTS.inc()
+            raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    conn = self._connect()
+                elif not self._is_healthy(conn):
+                    self._discard(conn)
+                    continue
+                with self._lock:
+                    self.in_use += 1
+                POOL_WAIT_SECONDS.observe(time.perf_counter() - started_at)
+                return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            self.in_use -= 1
+        try:
+            if not close and not conn.closed:
+                try:
+                    # Leave the connection idle, whatever the caller did with it
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+            if close or conn.closed or self.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def stats(self):
+        with self._lock:
+            idle = len(self._idle)
+        return {"min_size": self.min_size, "max_size": self.max_size, "idle": idle, "in_use": self.in_use}
+
+    def close(self):
+        self.closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+def connect_kwargs():
+    return {"user": DB_USER, "password": DB_PASSWORD, "host": DB_HOST, "port": DB_PORT, "database": DB_DATABASE, "cursor_factory": TimedCursor}
+
+
+def connect():
+    """A single connection outside of the pool, for training job processes."""
+    return psycopg2.connect(**connect_kwargs())
+
+
+pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool():
+    global pool
+    with _pool_lock:
+        if pool is not None and not pool.closed:
+            return pool
+        pool = ConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_CHECK_INTERVAL, **connect_kwargs())
+        return pool
+
+
+def close_pool():
+    global pool
+    with _pool_lock:
+        if pool is not None:
+            pool.close()
+        pool = None
+
+
+@contextmanager
+def get_connection():
+    # The pool is (re)created on demand, so a request after a failed startup can still reconnect
+    current_pool = pool if pool is not None and not pool.closed else init_pool()
+    with current_pool.connection() as connection:
+        yield connection
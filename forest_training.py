@@ -0,0 +1,124 @@
+import json
+import time
+import os
+import warnings
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs, parallel_config
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import KFold
+
+# Cores a training job fits trees on, -1 for all of them. Each of the TRAINING_WORKERS job processes uses this many
+TRAINING_N_JOBS = int(os.getenv("TRAINING_N_JOBS", "-1"))
+TRAINING_N_ESTIMATORS = int(os.getenv("TRAINING_N_ESTIMATORS", "100"))
+# Maximum depth of the trees, 0 grows them until the leaves are pure
+TRAINING_MAX_DEPTH = int(os.getenv("TRAINING_MAX_DEPTH", "0"))
+# Seconds a training job may take (loading, cross-validation and every city model included), trees are then added TRAINING_BUDGET_STEP at a time until the next step would not fit. 0 has no limit
+TRAINING_TIME_BUDGET = float(os.getenv("TRAINING_TIME_BUDGET", "0"))
+TRAINING_BUDGET_STEP = int(os.getenv("TRAINING_BUDGET_STEP", "10"))
+# Share of TRAINING_TIME_BUDGET cross-validation may use, the final fit gets what it leaves
+TRAINING_CV_BUDGET_SHARE = float(os.getenv("TRAINING_CV_BUDGET_SHARE", "0.5"))
+# "cv" picks the parameters of TRAINING_CV_GRID with the lowest k-fold cross-validated error before each fit, "none" uses the ones above
+TRAINING_MODEL_SELECTION = os.getenv("TRAINING_MODEL_SELECTION", "none")
+TRAINING_CV_FOLDS = int(os.getenv("TRAINING_CV_FOLDS", "5"))
+# JSON object of parameter name to the values to try, null is sklearn's None
+TRAINING_CV_GRID = os.getenv("TRAINING_CV_GRID", '{"max_depth": [null, 16], "max_features": [1.0, 0.5]}')
+
+
+def forest_params():
+    """Forest parameters from the training configuration."""
+    return {
+        'n_estimators': TRAINING_N_ESTIMATORS,
+        'max_depth': TRAINING_MAX_DEPTH or None
+    }
+
+
+def parameter_grid(grid):
+    """Every combination of the values of a {name: [values]} grid, as parameter dicts."""
+    combinations = [{}]
+    for name, values in grid.items():
+        combinations = [{**params, name: value} for params in combinations for value in values]
+    return combinations
+
+
+def deadline(time_budget=None):
+    """The time.perf_counter() a fit started now has to end by, None without a budget."""
+    time_budget = TRAINING_TIME_BUDGET if time_budget is None else time_budget
+    return time.perf_counter() + time_budget if time_budget else None
+
+
+def fit_forest(X, y, params, n_jobs=None, deadline=None):
+    """Fits a forest with out-of-bag predictions, by the deadline (a time.perf_counter()) when one is set.
+
+    With a deadline the trees are added a step at a time (warm_start) and no step is started that the
+    time of the previous ones says would end past it, so the forest can end up with fewer trees than
+    asked for (at least one step). The out-of-bag predictions are only computed once, after the last
+    step, and skipped when the deadline has passed: the forest then has no oob_score_.
+    """
+    n_jobs = TRAINING_N_JOBS if n_jobs is None else n_jobs
+    forest = RandomForestRegressor(**params, n_jobs=n_jobs, random_state=42, oob_score=deadline is None)
+    if deadline is None:
+        forest.fit(X, y)
+        return forest
+
+    n_estimators = forest.n_estimators
+    step = max(1, TRAINING_BUDGET_STEP)
+    started_at = time.perf_counter()
+    forest.set_params(warm_start=True, n_estimators=0)
+    while forest.n_estimators < n_estimators:
+        forest.set_params(n_estimators=min(forest.n_estimators + step, n_estimators))
+        forest.fit(X, y)
+        now = time.perf_counter()
+        if started_at + (now - started_at) / forest.n_estimators * min(forest.n_estimators + step, n_estimators) > deadline:
+            break
+
+    if time.perf_counter() < deadline:
+        # Fitting again without new trees only computes the out-of-bag predictions
+        forest.set_params(oob_score=True)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            forest.fit(X, y)
+    return forest
+
+
+def _fold_error(X, y, train, test, params, deadline):
+    # Folds not started by the deadline are skipped, the ones already running finish
+    if deadline is not None and time.perf_counter() > deadline:
+        return None
+    forest = RandomForestRegressor(**params, n_jobs=1, random_state=42)
+    forest.fit(X[train], y[train])
+    return float(np.mean(np.abs(forest.predict(X[test]) - y[test])))
+
+
+def cross_validate(X, y, grid=None, folds=None, n_jobs=None, deadline=None):
+    """Mean absolute error of every parameter combination of the grid over the same k folds.
+
+    Each (combination, fold) fit is one single-threaded task, the tasks run in parallel threads
+    sharing the encoded matrix X, so nothing is copied between processes. With a deadline (a
+    time.perf_counter()), the tasks not started by it are skipped and the combinations missing a fold are reported with
+    a cv_mae of None. Returns the results, lowest error first and the skipped combinations last.
+    """
+    grid = json.loads(TRAINING_CV_GRID) if grid is None else grid
+    folds = TRAINING_CV_FOLDS if folds is None else folds
+    n_jobs = TRAINING_N_JOBS if n_jobs is None else n_jobs
+    combinations = [{**forest_params(), **params} for params in parameter_grid(grid)]
+    splits = list(KFold(n_splits=min(folds, len(X)), shuffle=True, random_state=42).split(X))
+
+    # Combination by combination, the ones started first are the ones complete when the budget runs out
+    errors = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_fold_error)(X, y, train, test, params, deadline) for params in combinations for train, test in splits
+    )
+    results = []
+    for index, params in enumerate(combinations):
+        fold_errors = errors[index * len(splits):(index + 1) * len(splits)]
+        if None in fold_errors:
+            results.append({'params': params, 'cv_mae': None, 'cv_mae_std': None})
+        else:
+            results.append({'params': params, 'cv_mae': float(np.mean(fold_errors)), 'cv_mae_std': float(np.std(fold_errors))})
+    return sorted(results, key=lambda result: (result['cv_mae'] is None, result['cv_mae'] or 0.0))
+
+
+def cores(n_jobs=None):
+    """Threads the fits run on, the forests always fit their trees in threads."""
+    # Asked of the threading backend, the default one answers 1 inside the daemon processes of a pool
+    with parallel_config(backend="threading"):
+        return effective_n_jobs(TRAINING_N_JOBS if n_jobs is None else n_jobs)
@@ -0,0 +1,184 @@
+import io
+import csv
+import json
+import codecs
+
+READ_CHUNK_SIZE = 64 * 1024
+# A record still failing to parse once this much text is buffered after it is treated as malformed
+MAX_RECORD_SIZE = 1024 * 1024
+
+HOUSE_COLUMNS = ["city", "latitude", "longitude", "age", "num_bedrooms", "num_bathrooms", "area", "is_apartment", "has_pool", "garage", "price"]
+
+
+class InvalidJSONFile(ValueError):
+    pass
+
+
+class TruncatedJSONFile(InvalidJSONFile):
+    """A JSON array that cannot be parsed past a record, the records after it are unknown."""
+
+    def __init__(self, line_number, message):
+        super().__init__(message)
+        self.line_number = line_number
+
+
+def iter_json_records(stream):
+    """Incrementally parses a JSON array or NDJSON document.
+
+    Yields (line_number, record, error) tuples, where error is None for a record that could be parsed.
+    A malformed NDJSON line only fails itself, a JSON array cannot be read past a malformed record,
+    TruncatedJSONFile is raised there. Only the record being parsed is kept in memory, so the size of the file does not matter.
+    """
+    reader = _TextReader(stream)
+    buffer = ""
+    while not buffer.strip():
+        chunk = reader.read(READ_CHUNK_SIZE)
+        if not chunk:
+            raise InvalidJSONFile("Empty file")
+        buffer += chunk
+
+    first_char = buffer.lstrip()[0]
+    if first_char == "[":
+        yield from _iter_array_records(reader, buffer)
+    elif first_char == "{":
+        yield from _iter_ndjson_records(reader, buffer)
+    else:
+        raise InvalidJSONFile("Expected a JSON array or NDJSON")
+
+
+class _TextReader:
+    # Decodes the binary upload in chunks, multi-byte characters split between chunks are kept for the next read
+    def __init__(self, stream):
+        self._stream = stream
+        # utf-8-sig drops the byte order mark some editors write, as json.loads does for bytes
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def read(self, size):
+        while True:
+            data = self._stream.read(size)
+            text = self._decoder.decode(data, final=not data)
+            if text or not data:
+                return text
+
+
+def _iter_ndjson_records(reader, buffer):
+    line_number = 0
+    eof = False
+    while True:
+        newline = buffer.find("\n")
+        if newline == -1 and not eof:
+            chunk = reader.read(READ_CHUNK_SIZE)
+            eof = not chunk
+            buffer += chunk
+            continue
+        if newline == -1:
+            line, buffer = buffer, ""
+        else:
+            line, buffer = buffer[:newline], buffer[newline + 1:]
+        line_number += 1
+
+        if line.strip():
+            try:
+                yield line_number, json.loads(line), None
+            except json.JSONDecodeError as error:
+                yield line_number, None, f"Invalid JSON: {error.msg}"
+        if eof and not buffer:
+            return
+
+
+def _refill(reader, buffer, pos):
+    # Drops the text already consumed and appends the next chunk
+    chunk = reader.read(READ_CHUNK_SIZE)
+    return buffer[pos:] + chunk, 0, not chunk
+
+
+def _iter_array_records(reader, buffer):
+    decoder = json.JSONDecoder()
+    line_number = 1
+    pos = buffer.index("[") + 1
+    line_number += buffer.count("\n", 0, pos)
+    eof = False
+    expect_separator = False
+
+    while True:
+        # Skip whitespace, keeping track of the line we are on
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            if buffer[pos] == "\n":
+                line_number += 1
+            pos += 1
+
+        if pos >= len(buffer):
+            if eof:
+                raise TruncatedJSONFile(line_number, "Invalid JSON: unterminated array")
+            buffer, pos, eof = _refill(reader, buffer, pos)
+            continue
+
+        char = buffer[pos]
+        if char == "]":
+            return
+        if expect_separator:
+            if char != ",":
+                raise TruncatedJSONFile(line_number, "Invalid JSON: expected ',' or ']'")
+            pos += 1
+            expect_separator = False
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as error:
+            if not eof and len(buffer) - pos < MAX_RECORD_SIZE:
+                buffer, pos, eof = _refill(reader, buffer, pos)
+                continue
+            raise TruncatedJSONFile(line_number, f"Invalid JSON: {error.msg}")
+
+        # A value ending exactly at the end of the buffer may have been cut in half (e.g. a number)
+        if end == len(buffer) and not eof:
+            buffer, pos, eof = _refill(reader, buffer, pos)
+            continue
+
+        yield line_number, record, None
+        line_number += buffer.count("\n", pos, end)
+        pos = end
+        expect_separator = True
+
+
+def copy_houses(cursor, houses, table="houses"):
+    """Loads validated houses with a single COPY ... FROM STDIN."""
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for house in houses:
+        writer.writerow([house[column] for column in HOUSE_COLUMNS])
+    data.seek(0)
+
+    # csv writes an empty string as an empty field, which COPY would read as NULL, FORCE_NOT_NULL keeps an empty city ''
+    cursor.copy_expert(f"COPY {table} ({', '.join(HOUSE_COLUMNS)}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (city))", data)
+
+
+def create_staging_table(cursor):
+    # Temporary table private to the session, emptied on every commit
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS houses_import (
+            city VARCHAR NOT NULL,
+            latitude FLOAT,
+            longitude FLOAT,
+            age INT,
+            num_bedrooms INT,
+            num_bathrooms INT,
+            area FLOAT,
+            is_apartment BOOLEAN,
+            has_pool BOOLEAN,
+            garage BOOLEAN,
+            price INT
+        ) ON COMMIT DELETE ROWS
+    """)
+
+
+def insert_houses(cursor, houses):
+    """COPYs the houses into the staging table and moves them to houses, skipping duplicates.
+
+    Returns the number of houses actually inserted.
+    """
+    copy_houses(cursor, houses, table="houses_import")
+    columns = ", ".join(HOUSE_COLUMNS)
+    cursor.execute(f"INSERT INTO houses ({columns}) SELECT {columns} FROM houses_import ON CONFLICT (content_hash) DO NOTHING")
+    return cursor.rowcount
@@ -0,0 +1,113 @@
+import logging
+import time
+import os
+from concurrent.futures import Future
+from psycopg2.extras import execute_values
+from house_import import HOUSE_COLUMNS
+from metrics import metrics_registry
+from windowed_queue import WindowedQueue
+
+# Milliseconds POST /house/ waits for other houses to share its insert and commit, 0 inserts and commits every house on its own
+HOUSE_WRITE_FLUSH_MS = float(os.getenv("HOUSE_WRITE_FLUSH_MS", "0"))
+# The queued houses are flushed as soon as there are this many, without waiting for the end of the window
+HOUSE_WRITE_FLUSH_ROWS = int(os.getenv("HOUSE_WRITE_FLUSH_ROWS", "500"))
+# Houses waiting to be written, callers past it wait for a flush to make room
+HOUSE_WRITE_QUEUE_SIZE = int(os.getenv("HOUSE_WRITE_QUEUE_SIZE", "10000"))
+# Types of the houses columns, the values are cast to them so the content hash is computed as for the table
+HOUSE_COLUMN_TYPES = ["varchar", "float", "float", "int", "int", "int", "float", "boolean", "boolean", "boolean", "int"]
+
+logger = logging.getLogger(__name__)
+
+FLUSH_ROWS = metrics_registry.histogram(
+    "house_api_house_write_flush_rows", "Houses written per group commit", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+FLUSH_QUEUE_SECONDS = metrics_registry.histogram("house_api_house_write_queue_seconds", "Time a house waited for its group commit to start")
+
+
+class _Write:
+    def __init__(self, house):
+        self.house = house
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+class HouseWriteBuffer:
+    """Group commit of the houses added one at a time: queued houses are written by one multi-row INSERT and one commit.
+
+    Houses wait in a WindowedQueue for flush_ms or until flush_rows are queued. Every caller waits
+    for the commit of its house and learns whether it was inserted or already in the table (the
+    content_hash conflict the single row insert uses, the first of two identical houses in a batch
+    is the one inserted). When a batch fails, its houses are written again one per transaction, so
+    a bad row only fails its own caller. close() writes what is still queued.
+    """
+
+    def __init__(self, connection_factory, content_hash_expression, on_insert=None,
+                 flush_ms=HOUSE_WRITE_FLUSH_MS, flush_rows=HOUSE_WRITE_FLUSH_ROWS, queue_size=HOUSE_WRITE_QUEUE_SIZE):
+        self.connection_factory = connection_factory
+        self.on_insert = on_insert
+        self.window = flush_ms / 1000
+        self.flush_rows = max(1, flush_rows)
+        self._queue = WindowedQueue(self.flush, self.window, self.flush_rows, max_queued=queue_size, name="house-writer")
+        columns = ", ".join(HOUSE_COLUMNS)
+        # Positions map the content hashes of the inserted rows back to the houses of the batch
+        self.query = f"""
+            WITH new_houses (position, {columns}) AS (VALUES %s),
+            inserted AS (
+                INSERT INTO houses ({columns})
+                SELECT {columns} FROM new_houses ORDER BY position
+                ON CONFLICT (content_hash) DO NOTHING
+                RETURNING content_hash
+            )
+            SELECT min(new_houses.position) FROM new_houses JOIN inserted ON inserted.content_hash = ({content_hash_expression})
+            GROUP BY inserted.content_hash
+        """
+        self.template = "(%s, " + ", ".join(f"%s::{column_type}" for column_type in HOUSE_COLUMN_TYPES) + ")"
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, house):
+        """Queues a house (the values of HOUSE_COLUMNS) and returns True once it is committed, False for a duplicate."""
+        write = _Write(house)
+        self._queue.put(write)
+        return write.future.result()
+
+    def _insert(self, batch):
+        # A failed batch is rolled back when the pool takes the connection back
+        with self.connection_factory() as connection, connection.cursor() as cursor:
+            rows = [(position, *write.house) for position, write in enumerate(batch)]
+            inserted = {row[0] for row in execute_values(cursor, self.query, rows, template=self.template, page_size=len(rows), fetch=True)}
+            connection.commit()
+        return inserted
+
+    def flush(self, batch):
+        started_at = time.perf_counter()
+        for write in batch:
+            FLUSH_QUEUE_SECONDS.observe(started_at - write.queued_at)
+        FLUSH_ROWS.observe(len(batch))
+
+        try:
+            inserted = self._insert(batch)
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].future.set_exception(error)
+                return
+            logger.warning(f"Group commit of {len(batch)} houses failed, writing them one by one: {error}")
+            inserted = set()
+            for position, write in enumerate(batch):
+                try:
+                    if self._insert([write]):
+                        inserted.add(position)
+                except Exception as row_error:
+                    write.future.set_exception(row_error)
+
+        if inserted and self.on_insert is not None:
+            self.on_insert()
+        for position, write in enumerate(batch):
+            if not write.future.done():
+                write.future.set_result(position in inserted)
+
+    def close(self):
+        """Writes the queued houses and stops the writer thread, houses added afterwards are refused."""
+        self._queue.close()
@@ -0,0 +1,22 @@
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module that is only imported the first time one of its attributes is used.
+
+    pandas and scikit-learn take over a second to import, processes that never train (or only
+    serve CRUD routes) do not pay for them. Attributes are always read from the real module, so
+    patching it (e.g. in tests) is seen through the stand-in.
+    """
+
+    def __getattr__(self, name):
+        module = self.__dict__.get("_module")
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self.__name__)
+        return getattr(module, name)
+
+
+def lazy_import(name):
+    return sys.modules.get(name) or LazyModule(name)
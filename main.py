@@ -1,35 +1,132 @@
-from fastapi import FastAPI, Form, HTTPException, UploadFile, File, Query 
+from fastapi import FastAPI, Form, HTTPException, UploadFile, File, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from training_model import *
+from training_jobs import runner
+from model_store import load_latest_model
+from prediction_cache import prediction_cache
+from prediction_batcher import prediction_batcher
+from db import get_connection
+from metrics import metrics_registry, MetricsMiddleware
+from spatial_index import spatial_index
+from house_writer import HouseWriteBuffer
+from house_import import iter_json_records, create_staging_table, insert_houses, InvalidJSONFile, TruncatedJSONFile
+import db
 import psycopg2, logging
+import importlib.util
+import asyncio
+import random
 import json
+import time
+import io
 import os
+from uuid import UUID
 
 app = FastAPI()
+# Times every request and its stages, see GET /metrics
+app.add_middleware(MetricsMiddleware)
 
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT = os.getenv("DB_PORT")
-DB_DATABASE = os.getenv("DB_DATABASE")
+IMPORT_CONTENT_TYPES = ("application/json", "application/x-ndjson")
+# Rows loaded (and committed) per COPY during an import
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+# Migration of tables filled before duplicates were rejected: deletes the duplicated houses so the unique index can be built.
+# Off by default, houses are never deleted on start unless asked for
+DEDUPLICATE_HOUSES = os.getenv("DEDUPLICATE_HOUSES", "false").lower() == "true"
+# Seconds before retrying to connect to the database at startup, doubled after every failure up to DB_CONNECT_MAX_DELAY
+DB_CONNECT_INITIAL_DELAY = float(os.getenv("DB_CONNECT_INITIAL_DELAY", "0.5"))
+DB_CONNECT_MAX_DELAY = float(os.getenv("DB_CONNECT_MAX_DELAY", "30"))
+# Predicts a house of every city once the model is loaded, so the first requests do not pay for paging it in
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() == "true"
+
+# Origin of the time to ready, the ML stack is only imported once something needs it so the API starts quickly
+STARTED_AT = time.monotonic()
+ready_seconds = None
  
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TIME_TO_READY = metrics_registry.gauge("house_api_time_to_ready_seconds", "Seconds from the start of the API until it was first ready", function=lambda: ready_seconds)
+
 @app.on_event("startup")
 async def startup_event():
-    while not connect_db():
-        continue
+    # Prepared in the background: /healthz answers right away, /readyz once the database and a model are there
+    app.state.startup_task = asyncio.create_task(prepare_service())
+
+async def prepare_service():
+    delay = DB_CONNECT_INITIAL_DELAY
+    while not await run_in_threadpool(connect_db):
+        # Jittered, so the workers of a deployment do not retry in lockstep
+        wait = random.uniform(delay / 2, delay)
+        logger.info(f"Retrying to connect to the database in {wait:.1f}s")
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, DB_CONNECT_MAX_DELAY)
+
+    await run_in_threadpool(load_model_artifact)
+    if registry.model is None:
+        # Nothing saved yet, a first model is trained from the database
+        try:
+            await asyncio.wrap_future(runner.submit("startup")["done"])
+        except Exception as error:
+            logger.error(f"No model to serve yet: {error}")
+    if MODEL_WARMUP and registry.model is not None:
+        await run_in_threadpool(warm_up_model, registry.model)
+    await run_in_threadpool(readiness)
+
+def warm_up_model(model):
+    """Predicts a house of each city the model knows, loading what the first prediction would otherwise load."""
+    started_at = time.perf_counter()
+    houses = [
+        {"city": city, "latitude": 0.0, "longitude": 0.0, "age": 0, "num_bedrooms": 1, "num_bathrooms": 1, "area": 1.0, "is_apartment": False, "has_pool": False, "garage": False}
+        for city in model.cities
+    ]
+    try:
+        if houses:
+            model.predict(houses)
+        logger.info(f"Warmed up model version {model.version} in {time.perf_counter() - started_at:.3f}s")
+    except Exception as error:
+        logger.error(f"Could not warm up model version {model.version}: {error}")
 
-# Database Connection
+def readiness():
+    """Whether the database answers and a model can serve predictions, the first time both are true is the time to ready."""
+    global ready_seconds
+    try:
+        with get_connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        database = True
+    except psycopg2.Error as error:
+        logger.warning(f"Database not ready: {error}")
+        database = False
+    model = registry.model is not None and registry.model.predictor is not None
+
+    ready = database and model
+    if ready and ready_seconds is None:
+        ready_seconds = round(time.monotonic() - STARTED_AT, 3)
+        logger.info(f"Ready {ready_seconds}s after starting")
+    return {"ready": ready, "database": database, "model": model, "time_to_ready_seconds": ready_seconds}
+
+@app.on_event("shutdown")
+def shutdown_event():
+    startup_task = getattr(app.state, "startup_task", None)
+    if startup_task is not None and not startup_task.done():
+        startup_task.cancel()
+    # Houses still waiting for their group commit are written before the pool closes
+    house_writer.close()
+    runner.shutdown()
+    db.close_pool()
+
+# Database Connection Pool
+# Route handlers that talk to the database are plain "def" functions, FastAPI runs them in its
+# threadpool so a slow query only holds one worker thread and one pooled connection
 def connect_db():
-    global connection, cursor
     try:
-        connection = psycopg2.connect(user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT, database=DB_DATABASE)
+        db.init_pool()
 
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT version();")
-            db_version = cursor.fetchone()
+        with get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT version();")
+                db_version = cursor.fetchone()
             
         logger.info(f"Connected to {db_version[0]}")
         create_tables()
@@ -39,11 +136,50 @@ def connect_db():
         logger.error(f"Error while connecting to PostgreSQL: {error}")
         return False
     
-def create_tables():
+# Generated column expression, every function used is immutable so PostgreSQL accepts it in a STORED column.
+# Coordinates are rounded to 6 decimals (~10cm) and the area to 2, so float noise does not hide a duplicate
+CONTENT_HASH_EXPRESSION = """
+    md5(
+        lower(trim(city))
+        || '|' || coalesce(round(latitude::numeric, 6)::text, '')
+        || '|' || coalesce(round(longitude::numeric, 6)::text, '')
+        || '|' || coalesce(age::text, '')
+        || '|' || coalesce(num_bedrooms::text, '')
+        || '|' || coalesce(num_bathrooms::text, '')
+        || '|' || coalesce(round(area::numeric, 2)::text, '')
+        || '|' || coalesce(is_apartment::text, '')
+        || '|' || coalesce(has_pool::text, '')
+        || '|' || coalesce(garage::text, '')
+        || '|' || coalesce(price::text, '')
+    )
+"""
+
+def load_model_artifact():
+    # A saved model serves right away instead of training one from the database on every start
+    model = load_latest_model()
+    if model is None:
+        return
+
     try:
-        global connection, cursor
+        with get_connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT count(*), coalesce(max(seq), 0) FROM houses")
+            row_count, watermark = cursor.fetchone()
+    except psycopg2.Error as error:
+        logger.error(f"Could not check the houses table against the saved model: {error}")
+        row_count, watermark = None, None
 
-        with connection.cursor() as cursor:
+    # Trained on exactly the rows in the table it is current, otherwise it serves until a retrain replaces it
+    fresh = (row_count, watermark) == (model.n_rows, model.watermark)
+    model.data_version = registry.data_version if fresh else -1
+    registry.install(model)
+    logger.info(f"Serving model version {model.version} from {model.artifact_path}{'' if fresh else ' until it is retrained'}")
+
+# Group commit of POST /house/, off unless HOUSE_WRITE_FLUSH_MS is set
+house_writer = HouseWriteBuffer(get_connection, CONTENT_HASH_EXPRESSION, on_insert=lambda: registry.mark_stale())
+
+def create_tables():
+    try:
+        with get_connection() as connection, connection.cursor() as cursor:
             # Create the 'users' table
             create_users_table = """
                 CREATE TABLE IF NOT EXISTS houses (
@@ -62,6 +198,16 @@ def create_tables():
                 );
             """
             cursor.execute(create_users_table)
+            
+            # Normalized hash of every column but the id, used to reject duplicate houses through a unique index
+            cursor.execute(f"ALTER TABLE houses ADD COLUMN IF NOT EXISTS content_hash TEXT GENERATED ALWAYS AS ({CONTENT_HASH_EXPRESSION}) STORED")
+            cursor.execute("SELECT to_regclass('houses_content_hash_key')")
+            if cursor.fetchone()[0] is None:
+                create_content_hash_index(cursor)
+            
+            # Insertion order, the watermark of incremental retrains. Existing rows are numbered when the column is added
+            cursor.execute("ALTER TABLE houses ADD COLUMN IF NOT EXISTS seq BIGSERIAL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS houses_seq_idx ON houses (seq)")
             connection.commit()
             logger.info("Table houses created successfully in PostgreSQL database")
 
@@ -69,8 +215,25 @@ def create_tables():
         logger.error(f"Error creating table: {error}")
 
 
+def create_content_hash_index(cursor):
+    """Builds the unique index on content_hash, which a table filled by older imports may have duplicates against."""
+    cursor.execute("SELECT count(*) - count(DISTINCT content_hash) FROM houses")
+    duplicates = cursor.fetchone()[0]
+    if duplicates and not DEDUPLICATE_HOUSES:
+        logger.error(
+            f"The houses table has {duplicates} duplicated houses, the unique index on content_hash is not built and adding houses fails "
+            "until they are removed. Start once with DEDUPLICATE_HOUSES=true to keep one copy of each (the lowest house_id)"
+        )
+        return
+    if duplicates:
+        # The copy kept does not depend on the physical order of the rows
+        cursor.execute("DELETE FROM houses a USING houses b WHERE a.content_hash = b.content_hash AND a.house_id > b.house_id")
+        logger.warning(f"DEDUPLICATE_HOUSES: deleted {cursor.rowcount} duplicated houses, keeping the lowest house_id of each")
+    cursor.execute("CREATE UNIQUE INDEX houses_content_hash_key ON houses (content_hash)")
+
+
 @app.post("/house/predict/")
-async def predict_house_price(
+def predict_house_price(
     city: str = Form(None),
     latitude: float = Form(None),
     longitude: float = Form(None),
@@ -82,22 +245,191 @@ async def predict_house_price(
     has_pool: bool = Form(None),
     garage: bool = Form(None)
 ):
-    global connection 
-    
     if city is None or latitude is None or longitude is None or age is None or num_bedrooms is None or num_bathrooms is None or area is None or is_apartment is None or has_pool is None or garage is None:
         raise HTTPException(status_code=400, detail="All fields must be filled")
     
-    # Train the model to get the price
-    house_price = price_predict(city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, connection)
+    # Predict with the cached model, a stale model keeps serving while a training job replaces it
+    house_price, model_version = price_predict(city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage)
     if house_price:
-        return {'price': house_price}
+        return {'price': house_price, 'model_version': model_version}
     
     raise HTTPException(status_code=500, detail="Could not estimate the house price")
 
 
+HOUSE_FIELD_TYPES = {
+    "city": (str,),
+    "latitude": (float, int),
+    "longitude": (float, int),
+    "age": (int,),
+    "num_bedrooms": (int,),
+    "num_bathrooms": (int,),
+    "area": (float, int),
+    "is_apartment": (bool,),
+    "has_pool": (bool,),
+    "garage": (bool,)
+}
+
+IMPORT_FIELD_TYPES = {**HOUSE_FIELD_TYPES, "price": (int,)}
+# Range of the INT columns of the houses table, a value outside it would fail the COPY of its whole chunk
+INT_COLUMN_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+def validate_house(house, field_types=HOUSE_FIELD_TYPES):
+    """Returns an error message for an invalid house, or None when it has every field with the right type."""
+    if not isinstance(house, dict):
+        return "House must be a JSON object"
+
+    missing_fields = [field for field in field_types if house.get(field) is None]
+    if missing_fields:
+        return f"Missing fields: {', '.join(missing_fields)}"
+
+    for field, types in field_types.items():
+        # bool is a subclass of int, so it has to be rejected explicitly for the numeric fields
+        value = house[field]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            return f"Invalid value for {field}: {value!r}"
+    return None
+
+def validate_import_house(house):
+    """validate_house for an imported house, which also has a price and has to fit the table columns."""
+    error = validate_house(house, IMPORT_FIELD_TYPES)
+    if error:
+        return error
+    for field, types in IMPORT_FIELD_TYPES.items():
+        if types == (int,) and not INT_COLUMN_RANGE[0] <= house[field] <= INT_COLUMN_RANGE[1]:
+            return f"Value out of range for {field}: {house[field]!r}"
+    return None
+
+
+# Predict the price of many houses, sent as a JSON array or as NDJSON (one house per line)
+@app.post("/houses/predict/batch")
+async def predict_house_price_batch(request: Request):
+    content = await request.body()
+    # Parsing and validating a large batch takes as long as predicting it, none of it runs on the event loop
+    ndjson = request.headers.get("content-type", "").startswith("application/x-ndjson")
+    return await run_in_threadpool(predict_batch_body, content, ndjson)
+
+
+def predict_batch_body(content, ndjson):
+    # Errors of the NDJSON lines that are not JSON, by index, those lines fail on their own
+    parse_errors = {}
+    if ndjson:
+        houses = []
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                houses.append(json.loads(line))
+            except json.JSONDecodeError as error:
+                parse_errors[len(houses)] = f"Invalid JSON: {error.msg}"
+                houses.append(None)
+    else:
+        try:
+            houses = json.loads(content)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+    if not isinstance(houses, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array or NDJSON of houses")
+
+    results = []
+    valid_houses = []
+    for index, house in enumerate(houses):
+        error = parse_errors.get(index) or validate_house(house)
+        results.append({"index": index, "error": error} if error else {"index": index})
+        if not error:
+            valid_houses.append(house)
+
+    model_version = None
+    if valid_houses:
+        predictions, model_version = batch_predict(valid_houses)
+        valid_results = [result for result in results if "error" not in result]
+        for result, prediction in zip(valid_results, predictions):
+            result.update(prediction)
+
+    return {"model_version": model_version, "results": results}
+
+
+# Start a training job, the current model keeps serving until the job installs the new one
+@app.post("/model/train", status_code=202)
+def train_model_job(full: bool = Query(False)):
+    job = runner.submit("manual", full=full)
+    # At most one job is pending, an incremental one already queued or running cannot become a full rebuild
+    if full and not job["full"]:
+        raise HTTPException(status_code=409, detail=f"Training job {job['job_id']} is pending and is not a full rebuild, retry once it has finished")
+    return runner.get(job["job_id"])
+
+
+@app.get("/model/train/{job_id}")
+def get_training_job(job_id: str):
+    job = runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Training job not found")
+    return job
+
+
+# Liveness, the process answers requests
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", "uptime_seconds": round(time.monotonic() - STARTED_AT, 3)}
+
+
+# Readiness, the database answers and a model is loaded
+@app.get("/readyz")
+def readyz():
+    state = readiness()
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content=state)
+    return state
+
+
+# Counters of the prediction cache, to size it
+@app.get("/model/cache")
+def get_prediction_cache_stats():
+    return prediction_cache.stats()
+
+
+# Batching of concurrent /house/predict/ calls, to tune PREDICT_BATCH_WINDOW_MS
+@app.get("/model/batching")
+def get_prediction_batching_stats():
+    return prediction_batcher.stats()
+
+
+# Stage timings, database and model metrics in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Model currently used for the predictions
+@app.get("/model")
+def get_active_model():
+    model = registry.model
+    if model is None:
+        return {"model_version": None, "stale": True, "training_job_id": runner.pending_job_id}
+
+    return {
+        "model_version": model.version,
+        "data_version": model.data_version,
+        "stale": registry.is_stale(model),
+        "trained_at": model.trained_at,
+        "n_rows": model.n_rows,
+        "watermark": model.watermark,
+        "training_mode": model.training_mode,
+        "artifact_path": model.artifact_path,
+        "n_features": len(model.feature_columns),
+        "cities": model.cities,
+        "metrics": model.metrics,
+        "shards": {
+            city: {"model_version": shard.version, "trained_at": shard.trained_at, "n_rows": shard.n_rows, "metrics": shard.metrics}
+            for city, shard in sorted(model.shards.items())
+        },
+        "training_job_id": runner.pending_job_id
+    }
+
+
 # Add a House
 @app.post("/house/")
-async def add_house(
+def add_house(
     city: str = Form(None),
     latitude: float = Form(None),
     longitude: float = Form(None),
@@ -114,37 +446,37 @@ async def add_house(
         raise HTTPException(status_code=400, detail="All fields must be filled")
     
     # Add the house to the database
-    global connection 
+    if house_writer.enabled:
+        try:
+            # Written with the houses of concurrent requests in one transaction
+            inserted = house_writer.add((city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price))
+        except (psycopg2.Error, RuntimeError) as error:
+            logger.error(f"Error adding house to the database: {error}")
+            raise HTTPException(status_code=500, detail="Could not add the house to the database")
+        if not inserted:
+            raise HTTPException(status_code=409, detail="House already exists in the database.")
+        return {"message": "House added successfully."}
+
     try:
-        with connection.cursor() as cursor:
+        with get_connection() as connection, connection.cursor() as cursor:
+            # The unique index on content_hash makes the duplicate check and the insert a single atomic statement
             cursor.execute(
                 """
-                SELECT house_id FROM houses 
-                WHERE city = %s 
-                AND latitude = %s 
-                AND longitude = %s 
-                AND age = %s 
-                AND num_bedrooms = %s 
-                AND num_bathrooms = %s 
-                AND area = %s 
-                AND is_apartment = %s 
-                AND has_pool = %s 
-                AND garage = %s 
-                AND price = %s
+                INSERT INTO houses (city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (content_hash) DO NOTHING
+                RETURNING house_id
                 """,
                 (city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price)
             )
-            existing_house = cursor.fetchone()
+            inserted_house = cursor.fetchone()
             
             #Check if the house already exists in the database
-            if existing_house:
+            if not inserted_house:
                 raise HTTPException(status_code=409, detail="House already exists in the database.")
             else:
-                cursor.execute(
-                    "INSERT INTO houses (city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    (city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price)
-                )
                 connection.commit()
+                registry.mark_stale()
                 return {"message": "House added successfully."}
             
     except psycopg2.Error as error:
@@ -154,74 +486,242 @@ async def add_house(
 
 # Add houses inside of a json file to the database
 @app.post("/houses/import/")
-async def import_houses(file_import: UploadFile = File(...)):
-    global connection
-    
-    #Check if it is a JSON file
-    if file_import.content_type != "application/json":
+def import_houses(file_import: UploadFile = File(...)):
+    #Check if it is a JSON (array) or NDJSON file
+    if file_import.content_type not in IMPORT_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail="Only JSON files are allowed")
     
+    start_time = time.perf_counter()
+    accepted = 0
+    rejected = 0
+    duplicates = 0
+    errors = []
+    chunk = []
+    truncated = None
+
     try:
-        content = await file_import.read()
-        list_houses_import = json.loads(content) 
-        
-        with connection.cursor() as cursor:
-            for house in list_houses_import:
-                required_fields = ["city", "latitude", "longitude", "age", "num_bedrooms", "num_bathrooms", "area", "is_apartment", "has_pool", "garage", "price"]
-                if not all(field in house for field in required_fields):
-                    raise HTTPException(status_code=400, detail=f"Missing fields in house data: {house}")
-                
-                cursor.execute(
-                    """
-                    INSERT INTO houses (city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        house["city"], house["latitude"], house["longitude"], house["age"], house["num_bedrooms"],
-                        house["num_bathrooms"], house["area"], house["is_apartment"],
-                        house["has_pool"], house["garage"], house["price"]
-                    )
-                )
-            connection.commit()
-        
-        return {"message": "Houses imported successfully."}
+        with get_connection() as connection, connection.cursor() as cursor:
+            create_staging_table(cursor)
+
+            # Records are parsed, validated and loaded in chunks of IMPORT_CHUNK_SIZE, committing each one,
+            # so neither the file nor the list of houses is ever fully in memory
+            try:
+                for line_number, house, error in iter_json_records(file_import.file):
+                    error = error or validate_import_house(house)
+                    if error:
+                        rejected += 1
+                        if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                            errors.append({"line": line_number, "error": error})
+                        continue
+
+                    chunk.append(house)
+                    if len(chunk) >= IMPORT_CHUNK_SIZE:
+                        inserted = insert_houses(cursor, chunk)
+                        connection.commit()
+                        accepted += inserted
+                        duplicates += len(chunk) - inserted
+                        chunk = []
+            except TruncatedJSONFile as error:
+                # The houses before the malformed record are imported, the ones after it could not be read
+                truncated = error
+
+            if chunk:
+                inserted = insert_houses(cursor, chunk)
+                connection.commit()
+                accepted += inserted
+                duplicates += len(chunk) - inserted
 
-    except json.JSONDecodeError:
+    except InvalidJSONFile:
         raise HTTPException(status_code=400, detail="Invalid JSON file")
     except (Exception, psycopg2.Error) as error:
-        logger.error(f"Error importing houses: {error}")
+        logger.error(f"Error importing houses after {accepted} rows: {error}")
         raise HTTPException(status_code=500, detail="Could not import houses into the database")
+    finally:
+        if accepted:
+            registry.mark_stale()
+
+    elapsed = time.perf_counter() - start_time
+    result = {
+        "message": "Houses imported successfully." if not rejected else "Houses imported with errors.",
+        "accepted": accepted,
+        "rejected": rejected,
+        "duplicates": duplicates,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(accepted / elapsed, 1) if elapsed > 0 else None,
+        "errors": errors
+    }
+    if truncated is not None:
+        result.update({
+            "message": f"Houses imported up to line {truncated.line_number}, the file could not be read past it.",
+            "truncated_at_line": truncated.line_number,
+            "error": str(truncated)
+        })
+        return JSONResponse(status_code=422, content=result)
+    return result
     
     
 @app.delete("/houses/")
-async def remove_houses():
-    global connection
-    
+def remove_houses():
     try:
-        with connection.cursor() as cursor:
+        with get_connection() as connection, connection.cursor() as cursor:
             cursor.execute("DELETE FROM houses")
             connection.commit()
+        registry.mark_stale(rows_deleted=True)
         return {"message": "All houses removed successfully."}
     
     except (Exception, psycopg2.Error) as error:
         logger.error(f"Error removing houses: {error}")
         raise HTTPException(status_code=500, detail="Could not remove the houses from the database")
 
-# Get all Houses (Auxiliary function)
+HOUSE_EXPORT_COLUMNS = ["house_id", "city", "latitude", "longitude", "age", "num_bedrooms", "num_bathrooms", "area", "is_apartment", "has_pool", "garage", "price"]
+# Rows fetched per round trip by the server side cursor when streaming
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+
+def build_houses_filter(after, city, min_price, max_price, min_latitude, max_latitude, min_longitude, max_longitude):
+    """Returns the WHERE clause and its parameters for the houses listing filters."""
+    conditions = []
+    params = []
+    for condition, value in (
+        ("house_id > %s", str(after) if after else None),
+        ("city = %s", city),
+        ("price >= %s", min_price),
+        ("price <= %s", max_price),
+        ("latitude >= %s", min_latitude),
+        ("latitude <= %s", max_latitude),
+        ("longitude >= %s", min_longitude),
+        ("longitude <= %s", max_longitude),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+
+def stream_houses(query, params, export_format):
+    # A named (server side) cursor keeps only one batch of rows in memory, however big the table is
+    try:
+        with get_connection() as connection, connection.cursor(name="houses_export") as cursor:
+            cursor.itersize = EXPORT_BATCH_SIZE
+            cursor.execute(query, params)
+            
+            encode_batch = encode_ndjson_batch if export_format == "ndjson" else ArrowBatchEncoder()
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield encode_batch(rows)
+            
+            if export_format == "arrow":
+                yield encode_batch.close()
+    except (Exception, psycopg2.Error) as error:
+        # The status code has already been sent, the client sees a truncated stream
+        logger.error(f"Error streaming houses from the database: {error}")
+        raise
+
+
+def encode_ndjson_batch(rows):
+    return "".join(json.dumps(dict(zip(HOUSE_EXPORT_COLUMNS, row))) + "\n" for row in rows).encode("utf-8")
+
+
+class ArrowBatchEncoder:
+    """Encodes row batches as an Arrow IPC stream, one record batch per database batch."""
+
+    def __init__(self):
+        import pyarrow as pa
+        self._pa = pa
+        self._schema = pa.schema([
+            ("house_id", pa.string()), ("city", pa.string()), ("latitude", pa.float64()), ("longitude", pa.float64()),
+            ("age", pa.int32()), ("num_bedrooms", pa.int32()), ("num_bathrooms", pa.int32()), ("area", pa.float64()),
+            ("is_apartment", pa.bool_()), ("has_pool", pa.bool_()), ("garage", pa.bool_()), ("price", pa.int32())
+        ])
+        self._sink = io.BytesIO()
+        self._writer = pa.ipc.new_stream(self._sink, self._schema)
+
+    def _flush(self):
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+    def __call__(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        self._writer.write_batch(self._pa.record_batch(columns, schema=self._schema))
+        return self._flush()
+
+    def close(self):
+        self._writer.close()
+        return self._flush()
+
+
+# List the houses, a page at a time (keyset pagination on house_id) or streamed as NDJSON / Arrow
 @app.get("/houses/")
-def get_houses():
+def get_houses(
+    limit: int = Query(100, ge=1, le=1000),
+    after: UUID = Query(None),
+    city: str = Query(None),
+    min_price: int = Query(None),
+    max_price: int = Query(None),
+    min_latitude: float = Query(None),
+    max_latitude: float = Query(None),
+    min_longitude: float = Query(None),
+    max_longitude: float = Query(None),
+    format: str = Query("json", pattern="^(json|ndjson|arrow)$")
+):
+    where, params = build_houses_filter(after, city, min_price, max_price, min_latitude, max_latitude, min_longitude, max_longitude)
+    query = f"SELECT {', '.join(HOUSE_EXPORT_COLUMNS)} FROM houses {where} ORDER BY house_id"
+
+    if format != "json":
+        if format == "arrow" and importlib.util.find_spec("pyarrow") is None:
+            raise HTTPException(status_code=400, detail="Arrow export requires pyarrow to be installed")
+        media_type = "application/x-ndjson" if format == "ndjson" else "application/vnd.apache.arrow.stream"
+        return StreamingResponse(stream_houses(query, params, format), media_type=media_type)
+
     try:
-        global connection
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT * FROM houses")
-            houses = cursor.fetchall()
-            return houses
+        with get_connection() as connection, connection.cursor() as cursor:
+            # One extra row tells whether there is a next page
+            cursor.execute(f"{query} LIMIT %s", params + [limit + 1])
+            rows = cursor.fetchall()
     except (Exception, psycopg2.Error) as error:
         logger.error(f"Error getting houses from the database: {error}")
         raise HTTPException(status_code=500, detail="Could not get the houses from the database")
 
+    houses = [dict(zip(HOUSE_EXPORT_COLUMNS, row)) for row in rows[:limit]]
+    next_after = houses[-1]["house_id"] if len(rows) > limit else None
+    return {"houses": houses, "next_after": next_after}
 
 
+# The k houses nearest to a point, e.g. comparable sales for an appraisal. Distances are great-circle (haversine) distances
+@app.get("/houses/nearby")
+def get_nearby_houses(
+    latitude: float = Query(..., ge=-90, le=90),
+    longitude: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=1000),
+    radius_km: float = Query(None, gt=0),
+    city: str = Query(None),
+    min_price: int = Query(None),
+    max_price: int = Query(None),
+    num_bedrooms: int = Query(None),
+    is_apartment: bool = Query(None)
+):
+    try:
+        # The index catches up with the inserts made since the last query, like the model it follows the data version
+        snapshot = spatial_index.refresh(registry.data_version, registry.full_rebuild_version)
+        nearest = spatial_index.nearest(latitude, longitude, k, radius_km, city, min_price, max_price, num_bedrooms, is_apartment, snapshot=snapshot)
+        if not nearest:
+            return {"houses": []}
 
+        # Only the nearest houses are read from the table, through the seq index
+        with get_connection() as connection, connection.cursor() as cursor:
+            cursor.execute(f"SELECT seq, {', '.join(HOUSE_EXPORT_COLUMNS)} FROM houses WHERE seq = ANY(%s)", ([seq for seq, _ in nearest],))
+            rows = {row[0]: row[1:] for row in cursor.fetchall()}
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error getting nearby houses: {error}")
+        raise HTTPException(status_code=500, detail="Could not get the nearby houses")
 
-
+    houses = [
+        {**dict(zip(HOUSE_EXPORT_COLUMNS, rows[seq])), "distance_km": round(distance_km, 4)}
+        for seq, distance_km in nearest if seq in rows
+    ]
+    return {"houses": houses}
@@ -0,0 +1,278 @@
+import contextvars
+import threading
+import time
+import os
+from contextlib import contextmanager
+
+# Request header asking for the stage breakdown of that request in a Server-Timing response header, empty disables it
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+# Upper bounds (seconds) of the histogram buckets, from sub-millisecond cache hits to full retrains
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Query kinds used as label values, anything else is counted as "other"
+QUERY_OPERATIONS = ("select", "insert", "update", "delete", "copy", "create", "alter", "declare", "fetch")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(labelnames, labelvalues)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Gauge(Metric):
+    """A value set by the code, or read from a function at every scrape.
+
+    The function returns a number, a {label values tuple: number} dict, or None when there is nothing to report.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            with self._lock:
+                values = sorted(self._values.items())
+        else:
+            value = self.function()
+            if value is None:
+                return []
+            values = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum of the observed values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+
+        samples = []
+        for key, counts in values:
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [("le", _format_value(bound))]), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), counts[-1]))
+            samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self._lock:
+            # Modules can ask for the same metric more than once, they share it
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+
+STAGE_SECONDS = metrics_registry.histogram("house_api_stage_seconds", "Time spent in each stage of the hot paths, per request", ["stage"])
+REQUEST_SECONDS = metrics_registry.histogram("house_api_request_seconds", "Time to answer a request", ["method", "route"])
+REQUESTS = metrics_registry.counter("house_api_requests_total", "Answered requests", ["method", "route", "status"])
+DB_QUERY_SECONDS = metrics_registry.histogram("house_api_db_query_seconds", "Time of each database statement", ["operation"])
+DB_QUERIES = metrics_registry.counter("house_api_db_queries_total", "Database statements run", ["operation"])
+DB_QUERY_ERRORS = metrics_registry.counter("house_api_db_query_errors_total", "Database statements that raised an error", ["operation"])
+
+# Stage times of the request being handled, None outside of a profiled block
+_profile = contextvars.ContextVar("profile", default=None)
+
+
+@contextmanager
+def profile():
+    """Collects the stage times of a block (a request, a training job) in a dict instead of the histograms.
+
+    The owner of the block decides what to do with them, e.g. observe them once the request is answered.
+    The dict is shared with the threads the block hands work to, as they copy its context.
+    """
+    stages = {}
+    token = _profile.set(stages)
+    try:
+        yield stages
+    finally:
+        _profile.reset(token)
+
+
+def add_stage_time(name, seconds):
+    stages = _profile.get()
+    if stages is None:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    else:
+        # A stage run more than once in a request (e.g. several queries) adds up
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - started_at)
+
+
+def observe_stages(stages):
+    for name, seconds in stages.items():
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def query_operation(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    if not isinstance(query, str):
+        return "other"
+    words = query.lstrip().split(None, 1)
+    operation = words[0].lower() if words else ""
+    return operation if operation in QUERY_OPERATIONS else "other"
+
+
+def record_query(operation, seconds, error=False):
+    DB_QUERIES.inc(operation=operation)
+    DB_QUERY_SECONDS.observe(seconds, operation=operation)
+    if error:
+        DB_QUERY_ERRORS.inc(operation=operation)
+    # Per request, all the database time is a single "db" stage
+    stages = _profile.get()
+    if stages is not None:
+        stages["db"] = stages.get("db", 0.0) + seconds
+
+
+def server_timing(stages):
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in stages.items())
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every request and the stages run while answering it.
+
+    With the profile header set on a request, its stage breakdown comes back in a Server-Timing header.
+    """
+
+    def __init__(self, app, profile_header=PROFILE_HEADER):
+        self.app = app
+        self.profile_header = profile_header.lower().encode("latin-1") if profile_header else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profiled = self.profile_header is not None and any(
+            name == self.profile_header and value not in (b"", b"0", b"false") for name, value in scope.get("headers", [])
+        )
+        status = 500
+        started_at = time.perf_counter()
+
+        with profile() as stages:
+            async def send_wrapper(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    if profiled:
+                        total = {**stages, "total": time.perf_counter() - started_at}
+                        headers = list(message.get("headers", [])) + [(b"server-timing", server_timing(total).encode("latin-1"))]
+                        message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                elapsed = time.perf_counter() - started_at
+                # The route template, not the path, so ids in the path do not make new series
+                route = getattr(scope.get("route"), "path", "unmatched")
+                REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=route)
+                REQUESTS.inc(method=scope["method"], route=route, status=status)
+                observe_stages(stages)
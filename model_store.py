@@ -0,0 +1,208 @@
+import json
+import re
+import logging
+import shutil
+import time
+import os
+import importlib.metadata
+from lazy_import import lazy_import
+import training_model
+from training_model import TrainedModel, FEATURE_FIELDS
+from compiled_forest import CompiledForest, FOREST_ARRAYS
+
+# Directory holding one sub directory per trained model
+MODEL_DIR = os.getenv("MODEL_DIR", "models")
+# Artifacts kept on disk, older ones are deleted after each save
+MODEL_ARTIFACTS_KEEP = int(os.getenv("MODEL_ARTIFACTS_KEEP", "5"))
+# Bumped whenever the layout of an artifact changes, older artifacts are then ignored
+ARTIFACT_FORMAT = 2
+# <trained_at milliseconds>-v<model version>, the name save_model gives an artifact directory
+ARTIFACT_NAME = re.compile(r"^\d+-v\d+$")
+
+logger = logging.getLogger(__name__)
+
+# Only needed for models served by their sklearn estimator, imported on first use
+joblib = lazy_import("joblib")
+
+
+def sklearn_version():
+    # From the package metadata, checking an artifact does not import scikit-learn
+    return importlib.metadata.version("scikit-learn")
+
+
+def save_model(model, model_dir=None):
+    """Writes the estimator, its compiled forest and its metadata to a new artifact directory and returns its path.
+
+    The artifact is written to a temporary directory and renamed, so readers never see a partial one.
+    """
+    model_dir = model_dir or MODEL_DIR
+    name = f"{int(model.trained_at * 1000)}-v{model.version}"
+    path = os.path.join(model_dir, name)
+    tmp_path = os.path.join(model_dir, f".{name}.tmp")
+    os.makedirs(tmp_path, exist_ok=True)
+
+    _save_estimator(model, tmp_path, "estimator.joblib")
+    shards = {}
+    for index, (city, shard) in enumerate(sorted(model.shards.items())):
+        os.makedirs(os.path.join(tmp_path, "shards"), exist_ok=True)
+        shards[city] = {
+            "file": f"shards/{index}.joblib",
+            "version": shard.version,
+            "trained_at": shard.trained_at,
+            "feature_columns": shard.feature_columns,
+            "n_rows": shard.n_rows,
+            "metrics": shard.metrics
+        }
+        _save_estimator(shard, tmp_path, shards[city]["file"])
+    metadata = {
+        "format": ARTIFACT_FORMAT,
+        "sklearn_version": sklearn_version(),
+        "feature_fields": FEATURE_FIELDS,
+        "version": model.version,
+        "trained_at": model.trained_at,
+        "feature_columns": model.feature_columns,
+        "cities": model.cities,
+        "n_rows": model.n_rows,
+        "watermark": model.watermark,
+        "training_mode": model.training_mode,
+        "metrics": model.metrics,
+        "shards": shards
+    }
+    with open(os.path.join(tmp_path, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+    os.rename(tmp_path, path)
+    _saved_to(model, os.path.join(path, "estimator.joblib"))
+    for city, shard in model.shards.items():
+        _saved_to(shard, os.path.join(path, shards[city]["file"]))
+    prune_artifacts(model_dir)
+    return path
+
+
+def forest_path(estimator_file):
+    # The compiled forest of an estimator sits next to it, e.g. estimator.forest/ for estimator.joblib
+    return os.path.splitext(estimator_file)[0] + ".forest"
+
+
+def _link(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _save_estimator(model, directory, name):
+    target = os.path.join(directory, name)
+    forest = model.forest
+    if model.estimator_file is not None and os.path.exists(model.estimator_file):
+        # Unchanged since an earlier artifact (e.g. a city model that was not retrained), linked instead of written again
+        _link(model.estimator_file, target)
+    else:
+        # Uncompressed, so the arrays can be memory-mapped when loading
+        joblib.dump(model.estimator, target)
+
+    if forest is None:
+        return
+    if forest.path is not None and os.path.isdir(forest.path):
+        os.makedirs(forest_path(target))
+        for name in FOREST_ARRAYS:
+            _link(os.path.join(forest.path, f"{name}.npy"), os.path.join(forest_path(target), f"{name}.npy"))
+    else:
+        forest.save(forest_path(target))
+
+
+def _saved_to(model, estimator_file):
+    model.estimator_file = estimator_file
+    if model.forest is not None:
+        model.forest.path = forest_path(estimator_file)
+
+
+def load_estimator(path):
+    # mmap_mode maps the arrays of the pickle from the page cache instead of reading them into memory first
+    return joblib.load(os.path.join(path, "estimator.joblib"), mmap_mode="r")
+
+
+def _load_predictor(model, estimator_file):
+    """Loads the compiled forest of a model saved with one, the estimator otherwise.
+
+    The estimator is not needed to serve a compiled forest, and unlike the forest arrays its trees
+    are copied into memory by each process loading it, memory-mapped or not.
+    """
+    model.estimator_file = estimator_file
+    if training_model.MODEL_PREDICTOR == "compiled" and os.path.isdir(forest_path(estimator_file)):
+        model.forest = CompiledForest.load(forest_path(estimator_file))
+    else:
+        model.estimator = joblib.load(estimator_file, mmap_mode="r")
+
+
+def load_estimators(model):
+    """Loads the estimators (or forests) of a model returned by a training job, which saved them to its artifact."""
+    _load_predictor(model, os.path.join(model.artifact_path, "estimator.joblib"))
+    for shard in model.shards.values():
+        _load_predictor(shard, shard.estimator_file)
+
+
+def read_metadata(path):
+    with open(os.path.join(path, "metadata.json")) as f:
+        return json.load(f)
+
+
+def is_compatible(metadata):
+    return (
+        metadata.get("format") == ARTIFACT_FORMAT
+        and metadata.get("sklearn_version") == sklearn_version()
+        and metadata.get("feature_fields") == FEATURE_FIELDS
+    )
+
+
+def list_artifacts(model_dir=None):
+    """Artifact directories, newest first."""
+    model_dir = model_dir or MODEL_DIR
+    if not os.path.isdir(model_dir):
+        return []
+    # Anything else in the directory (lost+found on a volume, stray files) is left alone
+    names = [name for name in os.listdir(model_dir) if ARTIFACT_NAME.match(name)]
+    return [os.path.join(model_dir, name) for name in sorted(names, key=lambda name: int(name.split("-")[0]), reverse=True)]
+
+
+def load_model(path):
+    metadata = read_metadata(path)
+    model = TrainedModel(None, metadata["feature_columns"], metadata["cities"], metadata["version"], None)
+    model.trained_at = metadata["trained_at"]
+    model.n_rows = metadata["n_rows"]
+    model.watermark = metadata["watermark"]
+    model.training_mode = metadata["training_mode"]
+    model.metrics = metadata["metrics"]
+    model.artifact_path = path
+    _load_predictor(model, os.path.join(path, "estimator.joblib"))
+    for city, shard_metadata in metadata.get("shards", {}).items():
+        shard = TrainedModel(None, shard_metadata["feature_columns"], [city], shard_metadata["version"], None)
+        shard.trained_at = shard_metadata["trained_at"]
+        shard.n_rows = shard_metadata["n_rows"]
+        shard.metrics = shard_metadata["metrics"]
+        _load_predictor(shard, os.path.join(path, shard_metadata["file"]))
+        model.shards[city] = shard
+    return model
+
+
+def load_latest_model(model_dir=None):
+    """Loads the newest artifact this code can use, or returns None when there is none."""
+    for path in list_artifacts(model_dir):
+        try:
+            if not is_compatible(read_metadata(path)):
+                logger.info(f"Skipping incompatible model artifact {path}")
+                continue
+            started_at = time.perf_counter()
+            model = load_model(path)
+            logger.info(f"Loaded model version {model.version} from {path} in {time.perf_counter() - started_at:.3f}s")
+            return model
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"Could not load model artifact {path}: {error}")
+    return None
+
+
+def prune_artifacts(model_dir=None, keep=None):
+    # Workers still using a deleted artifact keep their mapping, the file is only freed once they let go
+    keep = MODEL_ARTIFACTS_KEEP if keep is None else keep
+    for path in list_artifacts(model_dir)[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,105 @@
+import time
+import os
+from concurrent.futures import Future
+from metrics import metrics_registry
+from windowed_queue import WindowedQueue
+
+# Milliseconds a single house prediction waits for others to share its predict call, 0 predicts every request on its own
+PREDICT_BATCH_WINDOW_MS = float(os.getenv("PREDICT_BATCH_WINDOW_MS", "0"))
+# A batch is run as soon as it has this many houses, without waiting for the end of the window
+PREDICT_BATCH_MAX_SIZE = int(os.getenv("PREDICT_BATCH_MAX_SIZE", "64"))
+
+BATCH_SIZE = metrics_registry.histogram(
+    "house_api_predict_batch_size", "Houses per batched predict call", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+BATCH_QUEUE_SECONDS = metrics_registry.histogram(
+    "house_api_predict_batch_queue_seconds", "Time a house waited for its batch to start",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+
+
+class _Request:
+    def __init__(self, model, house):
+        self.model = model
+        self.house = house
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+class PredictionBatcher:
+    """Coalesces the single house predictions of concurrent requests into one predict call.
+
+    Houses wait in a WindowedQueue for window_ms or until max_batch_size are queued. Houses of
+    different model versions (a model installed mid-window) are predicted separately, and when a
+    batch fails each of its houses is predicted again on its own, so an error (e.g. an unknown
+    city) only reaches its own caller.
+    """
+
+    def __init__(self, window_ms=PREDICT_BATCH_WINDOW_MS, max_batch_size=PREDICT_BATCH_MAX_SIZE):
+        self.window = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue = WindowedQueue(self._predict, self.window, self.max_batch_size, name="prediction-batcher")
+        self.batches = 0
+        self.requests = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.max_batch = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def predict(self, model, house):
+        """Returns the price of one house, predicted in a batch with the houses of other requests."""
+        request = _Request(model, house)
+        self._queue.put(request)
+        return request.future.result()
+
+    def _predict(self, batch):
+        started_at = time.perf_counter()
+        groups = {}
+        for request in batch:
+            queue_seconds = started_at - request.queued_at
+            BATCH_QUEUE_SECONDS.observe(queue_seconds)
+            self.queue_seconds += queue_seconds
+            self.max_queue_seconds = max(self.max_queue_seconds, queue_seconds)
+            groups.setdefault(id(request.model), []).append(request)
+
+        for requests in groups.values():
+            BATCH_SIZE.observe(len(requests))
+            self.batches += 1
+            self.requests += len(requests)
+            self.max_batch = max(self.max_batch, len(requests))
+            try:
+                prices = requests[0].model.predict([request.house for request in requests])
+            except Exception as error:
+                if len(requests) == 1:
+                    requests[0].future.set_exception(error)
+                else:
+                    for request in requests:
+                        self._predict_one(request)
+                continue
+            for request, price in zip(requests, prices):
+                request.future.set_result(float(price))
+
+    def _predict_one(self, request):
+        try:
+            request.future.set_result(float(request.model.predict([request.house])[0]))
+        except Exception as error:
+            request.future.set_exception(error)
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": round(self.requests / self.batches, 2) if self.batches else None,
+            "max_batch": self.max_batch,
+            "mean_queue_ms": round(self.queue_seconds / self.requests * 1000, 3) if self.requests else None,
+            "max_queue_ms": round(self.max_queue_seconds * 1000, 3),
+            "queued": len(self._queue)
+        }
+
+
+prediction_batcher = PredictionBatcher()
@@ -0,0 +1,108 @@
+import threading
+import time
+import os
+from collections import OrderedDict
+
+# Predictions kept in memory, 0 disables the cache
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))
+# Seconds a prediction stays valid, 0 keeps it until it is evicted or the model changes
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "3600"))
+# Coordinates are rounded to this many decimals in the key (5 decimals is about 1 meter)
+PREDICTION_CACHE_COORD_DECIMALS = int(os.getenv("PREDICTION_CACHE_COORD_DECIMALS", "5"))
+
+
+class PredictionCache:
+    """LRU cache of predicted prices, keyed on the normalized house and the model version.
+
+    Only one model version is cached at a time, the first lookup made with a new version empties the cache.
+    """
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, coord_decimals=PREDICTION_CACHE_COORD_DECIMALS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.coord_decimals = coord_decimals
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._model_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, house):
+        return (
+            house['city'],
+            round(float(house['latitude']), self.coord_decimals),
+            round(float(house['longitude']), self.coord_decimals),
+            int(house['age']),
+            int(house['num_bedrooms']),
+            int(house['num_bathrooms']),
+            round(float(house['area']), 2),
+            bool(house['is_apartment']),
+            bool(house['has_pool']),
+            bool(house['garage'])
+        )
+
+    def _check_version(self, model_version):
+        if model_version != self._model_version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._model_version = model_version
+
+    def get(self, model_version, house):
+        if self.max_size <= 0:
+            return None
+
+        key = self.key(house)
+        with self._lock:
+            self._check_version(model_version)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl > 0 and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, model_version, house, price):
+        if self.max_size <= 0:
+            return
+
+        key = self.key(house)
+        with self._lock:
+            self._check_version(model_version)
+            self._entries[key] = (price, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "model_version": self._model_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+
+prediction_cache = PredictionCache()
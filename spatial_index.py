@@ -0,0 +1,251 @@
+import logging
+import threading
+import time
+import os
+import numpy as np
+from db import get_connection
+from metrics import metrics_registry, stage
+from lazy_import import lazy_import
+
+# Rows added since the last build are searched by brute force, past this many the tree is rebuilt in the background
+SPATIAL_INDEX_MAX_DELTA = int(os.getenv("SPATIAL_INDEX_MAX_DELTA", "50000"))
+# Rows fetched per round trip while (re)building the index
+SPATIAL_INDEX_BATCH_SIZE = int(os.getenv("SPATIAL_INDEX_BATCH_SIZE", "50000"))
+SPATIAL_INDEX_QUERY = "SELECT seq, latitude, longitude, city, price, num_bedrooms, is_apartment FROM houses WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+# Mean Earth radius, haversine distances come out in radians
+EARTH_RADIUS_KM = 6371.0088
+
+logger = logging.getLogger(__name__)
+
+# Imported on the first build of the index
+neighbors = lazy_import("sklearn.neighbors")
+
+
+class _Rows:
+    """Columns of the indexed houses, only what is needed to search and filter them.
+
+    The houses themselves are read from the table by seq once the nearest ones are known.
+    """
+
+    def __init__(self, seq, coordinates, city, price, num_bedrooms, is_apartment):
+        self.seq = seq
+        # (latitude, longitude) in radians, the layout BallTree expects for haversine
+        self.coordinates = coordinates
+        self.city = city
+        self.price = price
+        self.num_bedrooms = num_bedrooms
+        self.is_apartment = is_apartment
+
+    def __len__(self):
+        return len(self.seq)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, np.int64), np.empty((0, 2)), np.empty(0, np.int32), np.empty(0, np.float64), np.empty(0, np.float64), np.empty(0, np.float64))
+
+    @classmethod
+    def from_records(cls, records, city_codes):
+        if not records:
+            return cls.empty()
+        seq, latitude, longitude, city, price, num_bedrooms, is_apartment = zip(*records)
+        # Cities are stored as small integer codes, a string per row would cost more than the rest of the columns together
+        city = np.array([city_codes.setdefault(name, len(city_codes)) for name in city], dtype=np.int32)
+        coordinates = np.radians(np.column_stack([np.array(latitude, dtype=np.float64), np.array(longitude, dtype=np.float64)]))
+        # None (NULL) becomes NaN, which no filter matches
+        as_float = lambda values: np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        return cls(np.array(seq, dtype=np.int64), coordinates, city, as_float(price), as_float(num_bedrooms), as_float(is_apartment))
+
+    def concat(self, other):
+        return _Rows(*(np.concatenate([getattr(self, name), getattr(other, name)]) for name in ("seq", "coordinates", "city", "price", "num_bedrooms", "is_apartment")))
+
+    def mask(self, indices, city_code, min_price, max_price, num_bedrooms, is_apartment):
+        keep = np.ones(len(indices), dtype=bool)
+        if city_code is not None:
+            keep &= self.city[indices] == city_code
+        if min_price is not None:
+            keep &= self.price[indices] >= min_price
+        if max_price is not None:
+            keep &= self.price[indices] <= max_price
+        if num_bedrooms is not None:
+            keep &= self.num_bedrooms[indices] == num_bedrooms
+        if is_apartment is not None:
+            keep &= self.is_apartment[indices] == float(is_apartment)
+        return keep
+
+
+class _Snapshot:
+    """The indexed rows at one point in time: a tree over the bulk of them, plus the rows added after it was built."""
+
+    def __init__(self, base, tree, delta, city_codes, watermark):
+        self.base = base
+        self.tree = tree
+        self.delta = delta
+        self.city_codes = city_codes
+        self.watermark = watermark
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+
+def haversine(point, coordinates):
+    """Distances in radians between a (latitude, longitude) point and rows of coordinates, all in radians."""
+    dlat = coordinates[:, 0] - point[0]
+    dlon = coordinates[:, 1] - point[1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(point[0]) * np.cos(coordinates[:, 0]) * np.sin(dlon / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    """In memory haversine index of the houses, for nearest neighbour queries on latitude and longitude.
+
+    A BallTree is built over every row, then rows inserted afterwards (read by seq past the watermark)
+    go to a small delta searched by brute force, so an insert never waits for a rebuild. Once the delta
+    grows past max_delta a new tree is built in a background thread while the current one keeps serving.
+    Like the model registry it follows the data version: a stale index catches up on its next query,
+    and deleting rows makes it rebuild from scratch. A row committed with a seq below the watermark
+    after the index read past it is only picked up by the next rebuild.
+    """
+
+    def __init__(self, connection_factory, max_delta=SPATIAL_INDEX_MAX_DELTA):
+        self.connection_factory = connection_factory
+        self.max_delta = max_delta
+        # Data version the index is up to date with, and the one of its last build from scratch
+        self.data_version = None
+        self.built_version = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    def _load(self, after_seq=0):
+        records = []
+        with self.connection_factory() as connection, connection.cursor(name="spatial_index") as cursor:
+            cursor.itersize = SPATIAL_INDEX_BATCH_SIZE
+            cursor.execute(f"{SPATIAL_INDEX_QUERY} AND seq > %s ORDER BY seq", (after_seq,))
+            while True:
+                batch = cursor.fetchmany(SPATIAL_INDEX_BATCH_SIZE)
+                if not batch:
+                    break
+                records.extend(batch)
+        return records
+
+    def build(self, records, city_codes=None):
+        """Returns a snapshot with a tree over the given (seq, latitude, longitude, city, price, num_bedrooms, is_apartment) rows."""
+        city_codes = dict(city_codes or {})
+        base = _Rows.from_records(records, city_codes)
+        tree = neighbors.BallTree(base.coordinates, metric="haversine") if len(base) else None
+        watermark = int(base.seq.max()) if len(base) else 0
+        return _Snapshot(base, tree, _Rows.empty(), city_codes, watermark)
+
+    def extend(self, snapshot, records):
+        """Returns a snapshot with the given rows added to the delta of the current one."""
+        city_codes = dict(snapshot.city_codes)
+        delta = snapshot.delta.concat(_Rows.from_records(records, city_codes))
+        watermark = max(snapshot.watermark, int(delta.seq.max())) if len(delta) else snapshot.watermark
+        return _Snapshot(snapshot.base, snapshot.tree, delta, city_codes, watermark)
+
+    def install(self, snapshot, data_version, built=False):
+        self._snapshot = snapshot
+        self.data_version = data_version
+        if built:
+            self.built_version = data_version
+
+    def refresh(self, data_version, full_rebuild_version=0):
+        """Brings the index up to the given data version, it is built again from scratch when rows were deleted after the last build."""
+        rebuild = self.built_version is None or self.built_version < full_rebuild_version
+        if not rebuild and self.data_version == data_version:
+            return self._snapshot
+
+        with self._lock:
+            # Another request may have refreshed the index while this one waited
+            rebuild = self.built_version is None or self.built_version < full_rebuild_version
+            snapshot = self._snapshot
+            if rebuild:
+                started_at = time.perf_counter()
+                snapshot = self.build(self._load())
+                self.install(snapshot, data_version, built=True)
+                logger.info(f"Built spatial index of {len(snapshot)} houses in {time.perf_counter() - started_at:.3f}s")
+            elif self.data_version != data_version:
+                snapshot = self.extend(snapshot, self._load(snapshot.watermark))
+                self.install(snapshot, data_version)
+
+            if len(snapshot.delta) > self.max_delta and not self._rebuilding:
+                self._rebuilding = True
+                threading.Thread(target=self._rebuild, args=(data_version,), daemon=True).start()
+            return snapshot
+
+    def _rebuild(self, data_version):
+        try:
+            started_at = time.perf_counter()
+            snapshot = self.build(self._load(), self._snapshot.city_codes)
+            with self._lock:
+                # Rows that refreshes added during the build are past its watermark, the next refresh reads them again
+                self.install(snapshot, data_version if self.data_version == data_version else None)
+                self.built_version = data_version
+            logger.info(f"Rebuilt spatial index of {len(snapshot)} houses in {time.perf_counter() - started_at:.3f}s")
+        except Exception as error:
+            logger.error(f"Could not rebuild the spatial index: {error}")
+        finally:
+            self._rebuilding = False
+
+    def nearest(self, latitude, longitude, k, radius_km=None, city=None, min_price=None, max_price=None, num_bedrooms=None, is_apartment=None, snapshot=None):
+        """Returns up to k (seq, distance_km) pairs, nearest first, of the houses matching the filters."""
+        snapshot = snapshot or self._snapshot
+        if snapshot is None:
+            return []
+
+        city_code = None
+        if city is not None:
+            city_code = snapshot.city_codes.get(city)
+            if city_code is None:
+                return []
+        filters = (city_code, min_price, max_price, num_bedrooms, is_apartment)
+        point = np.radians([latitude, longitude])
+        radius = radius_km / EARTH_RADIUS_KM if radius_km is not None else None
+
+        with stage("nearby_search"):
+            seq, distances = self._search_base(snapshot, point, k, radius, filters)
+            # The delta is small, every row of it is a candidate
+            delta_distances = haversine(point, snapshot.delta.coordinates)
+            keep = snapshot.delta.mask(np.arange(len(snapshot.delta)), *filters)
+            if radius is not None:
+                keep &= delta_distances <= radius
+            seq = np.concatenate([seq, snapshot.delta.seq[keep]])
+            distances = np.concatenate([distances, delta_distances[keep]])
+
+            order = np.argsort(distances, kind="stable")[:k]
+            return [(int(seq[index]), float(distances[index] * EARTH_RADIUS_KM)) for index in order]
+
+    def _search_base(self, snapshot, point, k, radius, filters):
+        base = snapshot.base
+        if snapshot.tree is None:
+            return np.empty(0, np.int64), np.empty(0)
+
+        if radius is not None:
+            indices, distances = snapshot.tree.query_radius([point], r=radius, return_distance=True, sort_results=True)
+            indices, distances = indices[0], distances[0]
+            keep = base.mask(indices, *filters)
+            return base.seq[indices[keep]], distances[keep]
+
+        # The k nearest rows may not match the filters, more candidates are asked for until k of them do
+        candidates = k
+        while True:
+            candidates = min(candidates * 4, len(base))
+            distances, indices = snapshot.tree.query([point], k=candidates)
+            indices, distances = indices[0], distances[0]
+            keep = base.mask(indices, *filters)
+            if keep.sum() >= k or candidates == len(base):
+                return base.seq[indices[keep]], distances[keep]
+
+    def stats(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {"rows": 0, "tree_rows": 0, "delta_rows": 0, "watermark": None, "data_version": self.data_version}
+        return {"rows": len(snapshot), "tree_rows": len(snapshot.base), "delta_rows": len(snapshot.delta), "watermark": snapshot.watermark, "data_version": self.data_version}
+
+
+spatial_index = SpatialIndex(get_connection)
+
+metrics_registry.gauge(
+    "house_api_spatial_index_rows", "Houses in the spatial index, in the tree and in the delta searched by brute force", ["part"],
+    lambda: {("tree",): spatial_index.stats()["tree_rows"], ("delta",): spatial_index.stats()["delta_rows"]}
+)
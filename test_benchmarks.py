@@ -0,0 +1,51 @@
+import json
+import pytest
+from benchmarks.generate_houses import generate_houses, write_houses
+from benchmarks.run_benchmarks import load_mix, percentiles, RequestFactory, DEFAULT_MIX
+from house_import import iter_json_records
+
+
+def test_generated_houses_look_like_the_sample():
+    with open('houses.json') as f:
+        sample = json.load(f)
+
+    houses = generate_houses(500, seed=1)
+
+    assert list(houses.columns) == list(sample[0].keys())
+    assert len(houses) == 500
+    assert houses['price'].min() > 0
+    assert houses['num_bathrooms'].min() >= 1
+    assert houses.equals(generate_houses(500, seed=1))
+
+
+@pytest.mark.parametrize("filename", ["houses.json", "houses.ndjson"])
+def test_written_houses_can_be_imported(tmp_path, filename):
+    houses = generate_houses(250, seed=1)
+    path = str(tmp_path / filename)
+
+    write_houses(houses, path, chunk_size=100)
+
+    with open(path, 'rb') as f:
+        records = list(iter_json_records(f))
+    assert [error for _, _, error in records] == [None] * 250
+    assert records[-1][1] == json.loads(houses.tail(1).to_json(orient='records'))[0]
+
+
+def test_mix_without_database():
+    mix = load_mix(DEFAULT_MIX, with_db=False)
+
+    assert {entry['name'] for entry in mix} == {'predict', 'predict_batch', 'model'}
+
+
+def test_percentiles():
+    assert percentiles([0.001 * i for i in range(1, 101)]) == {'p50_ms': 50.5, 'p95_ms': 95.05, 'p99_ms': 99.01}
+
+
+def test_request_factory_builds_batch():
+    factory = RequestFactory(generate_houses(10).to_dict(orient='records'), seed=1)
+
+    method, path, kwargs = factory.build({"method": "POST", "path": "/houses/predict/batch", "body": "json_houses", "batch_size": 5})
+
+    assert (method, path) == ("POST", "/houses/predict/batch")
+    assert len(kwargs['json']) == 5
+    assert 'price' not in kwargs['json'][0]
@@ -0,0 +1,52 @@
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from compiled_forest import CompiledForest, compare
+
+
+def test_compiled_forest_matches_estimator(features):
+    X, y = features
+    estimator = RandomForestRegressor(n_estimators=20, random_state=0).fit(X, y)
+    forest = CompiledForest.from_estimator(estimator)
+
+    assert forest.node_count == sum(tree.tree_.node_count for tree in estimator.estimators_)
+    assert forest.threshold.dtype == np.float32 and forest.children_left.dtype == np.int32
+    assert np.allclose(forest.predict(X), estimator.predict(X), rtol=1e-6)
+    # Rows set to the float32 nearest to a threshold, which can be just above it, go the same way as in sklearn
+    tree = estimator.estimators_[0].tree_
+    split_nodes = np.flatnonzero(tree.children_left >= 0)
+    near_threshold = np.repeat(X[:1], len(split_nodes), axis=0)
+    near_threshold[np.arange(len(split_nodes)), tree.feature[split_nodes]] = tree.threshold[split_nodes].astype(np.float32)
+    assert np.allclose(forest.predict(near_threshold), estimator.predict(near_threshold), rtol=1e-6)
+
+def test_compiled_forest_handles_missing_values(features):
+    X, y = features
+    X = X.copy()
+    X[::4, 2] = np.nan
+    estimator = RandomForestRegressor(n_estimators=20, random_state=0).fit(X, y)
+    forest = CompiledForest.from_estimator(estimator)
+
+    assert np.allclose(forest.predict(X), estimator.predict(X), rtol=1e-6)
+
+
+def test_compiled_forest_is_memory_mapped_from_disk(features, tmp_path):
+    X, y = features
+    estimator = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, y)
+    forest = CompiledForest.from_estimator(estimator)
+    forest.save(str(tmp_path / "forest"))
+
+    loaded = CompiledForest.load(str(tmp_path / "forest"))
+    report = compare(estimator, loaded, X)
+
+    assert isinstance(loaded.threshold, np.memmap)
+    assert np.array_equal(loaded.predict(X), forest.predict(X))
+    assert report['compiled_forest_bytes'] < report['forest_bytes']
+    assert report['compiled_max_abs_error'] < 1e-6 * np.abs(y).max()
+
+
+def test_compiled_forest_predicts_in_chunks(features):
+    X, y = features
+    estimator = RandomForestRegressor(n_estimators=10, random_state=0).fit(X, y)
+    forest = CompiledForest.from_estimator(estimator)
+
+    # A last chunk shorter than the others
+    assert np.array_equal(forest.predict(X, chunk_rows=7), forest.predict(X, chunk_rows=len(X)))
@@ -0,0 +1,63 @@
+import pytest
+import psycopg2
+from unittest.mock import patch, MagicMock
+from db import ConnectionPool, PoolTimeout
+
+
+@pytest.fixture
+def mock_connect():
+    with patch('db.psycopg2.connect') as mock_connect:
+        mock_connect.side_effect = lambda **kwargs: MagicMock(closed=0)
+        yield mock_connect
+
+
+def test_pool_reuses_connections(mock_connect):
+    pool = ConnectionPool(1, 2, timeout=1, check_interval=30)
+
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+
+    assert first is second
+    assert mock_connect.call_count == 1
+    # Uncommitted work is never left open on a pooled connection
+    first.rollback.assert_called()
+
+
+def test_pool_grows_up_to_max_size_then_times_out(mock_connect):
+    pool = ConnectionPool(0, 2, timeout=0.05, check_interval=30)
+
+    first = pool.getconn()
+    second = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    assert first is not second
+    pool.putconn(first)
+    assert pool.getconn() is first
+
+
+def test_pool_discards_broken_connections(mock_connect):
+    pool = ConnectionPool(1, 2, timeout=1, check_interval=30)
+
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    broken.close.assert_called_once()
+    with pool.connection() as connection:
+        assert connection is not broken
+    assert mock_connect.call_count == 2
+
+
+def test_pool_health_checks_idle_connections(mock_connect):
+    pool = ConnectionPool(1, 1, timeout=1, check_interval=0)
+
+    with pool.connection() as stale:
+        pass
+    stale.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError("terminating connection")
+
+    with pool.connection() as connection:
+        assert connection is not stale
+    stale.close.assert_called_once()
@@ -0,0 +1,74 @@
+import numpy as np
+from unittest.mock import patch
+from sklearn.ensemble import RandomForestRegressor
+from forest_training import fit_forest, cross_validate, parameter_grid, deadline
+from training_model import train_model
+
+
+def test_fit_forest_matches_a_single_threaded_fit(features):
+    X, y = features
+    expected = RandomForestRegressor(n_estimators=20, random_state=42).fit(X, y)
+
+    forest = fit_forest(X, y, {'n_estimators': 20, 'max_depth': None}, n_jobs=2)
+    stepped = fit_forest(X, y, {'n_estimators': 20, 'max_depth': None}, n_jobs=2, deadline=deadline(3600))
+
+    assert np.array_equal(forest.predict(X), expected.predict(X))
+    # Grown a few trees at a time, the same trees
+    assert np.array_equal(stepped.predict(X), expected.predict(X))
+    assert stepped.oob_score_ == forest.oob_score_
+
+
+def test_time_budget_stops_adding_trees(features):
+    X, y = features
+
+    with patch('forest_training.TRAINING_BUDGET_STEP', 5):
+        forest = fit_forest(X, y, {'n_estimators': 100, 'max_depth': None}, deadline=deadline(1e-9))
+
+    assert len(forest.estimators_) == 5
+    # Past the deadline, the out-of-bag predictions are not computed
+    assert not hasattr(forest, 'oob_score_')
+
+
+def test_parameter_grid():
+    assert parameter_grid({'max_depth': [None, 8], 'max_features': [1.0]}) == [
+        {'max_depth': None, 'max_features': 1.0},
+        {'max_depth': 8, 'max_features': 1.0}
+    ]
+
+
+def test_cross_validate_ranks_the_grid(features):
+    X, y = features
+
+    with patch('forest_training.TRAINING_N_ESTIMATORS', 10):
+        results = cross_validate(X, y, grid={'max_depth': [1, None]}, folds=3, n_jobs=2)
+
+    assert sorted(str(result['params']['max_depth']) for result in results) == ['1', 'None']
+    assert results[0]['cv_mae'] <= results[1]['cv_mae']
+    assert all(result['params']['n_estimators'] == 10 for result in results)
+
+
+def test_model_selection_fits_the_best_parameters(houses_df):
+    with patch('forest_training.TRAINING_MODEL_SELECTION', 'cv'), patch('forest_training.TRAINING_CV_FOLDS', 3), \
+            patch('forest_training.TRAINING_CV_GRID', '{"max_depth": [2, 4]}'), patch('forest_training.TRAINING_N_ESTIMATORS', 10):
+        model = train_model(houses_df, 1, 0)
+
+    metrics = model.metrics
+    assert metrics['params'] == metrics['cv_results'][0]['params']
+    assert metrics['cv_mae'] == metrics['cv_results'][0]['cv_mae']
+    assert metrics['cv_folds'] == 3
+    assert len(model.estimator.estimators_) == 10
+    assert model.estimator.max_depth == metrics['params']['max_depth']
+
+
+def test_cross_validation_counts_against_the_time_budget(houses_df):
+    with patch('forest_training.TRAINING_MODEL_SELECTION', 'cv'), patch('forest_training.TRAINING_CV_FOLDS', 3), \
+            patch('forest_training.TRAINING_CV_GRID', '{"max_depth": [2, 4]}'), patch('forest_training.TRAINING_N_ESTIMATORS', 20), \
+            patch('forest_training.TRAINING_TIME_BUDGET', 1e-9), patch('forest_training.TRAINING_BUDGET_STEP', 5):
+        model = train_model(houses_df, 1, 0)
+
+    metrics = model.metrics
+    # No fold started within the budget, the configured parameters are fitted with what is left of it
+    assert metrics['cv_scored'] == 0
+    assert all(result['cv_mae'] is None for result in metrics['cv_results'])
+    assert metrics['params'] == {'n_estimators': 5, 'max_depth': None}
+    assert metrics['oob_r2'] is None
@@ -0,0 +1,84 @@
+import io
+import codecs
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+from house_import import iter_json_records, copy_houses, insert_houses, InvalidJSONFile, TruncatedJSONFile
+
+
+def parse(text):
+    return list(iter_json_records(io.BytesIO(text.encode('utf-8'))))
+
+
+def test_iter_json_records_array_line_numbers():
+    text = '[\n  {"city": "Porto"},\n  {"city": "Braga",\n   "age": 3},\n  {"city": "Lisboa"}\n]\n'
+
+    assert parse(text) == [
+        (2, {"city": "Porto"}, None),
+        (3, {"city": "Braga", "age": 3}, None),
+        (5, {"city": "Lisboa"}, None)
+    ]
+
+
+def test_iter_json_records_ndjson_with_bad_line():
+    text = '{"city": "Porto"}\n\n{"city": \n{"city": "Lisboa"}'
+
+    records = parse(text)
+
+    assert records[0] == (1, {"city": "Porto"}, None)
+    assert records[1][0] == 3 and records[1][2].startswith("Invalid JSON")
+    assert records[2] == (4, {"city": "Lisboa"}, None)
+
+
+def test_iter_json_records_across_read_chunks():
+    houses = [{"city": "Vila Nova de Gaia", "price": 100000 + i, "area": 75.5} for i in range(200)]
+
+    # Tiny reads split records, numbers and multi-byte characters between chunks
+    with patch('house_import.READ_CHUNK_SIZE', 7):
+        records = parse(json.dumps(houses, indent=1).replace("Gaia", "Gaiã"))
+
+    assert [record for _, record, _ in records] == [{**house, "city": "Vila Nova de Gaiã"} for house in houses]
+
+
+def test_iter_json_records_malformed_array_is_truncated():
+    records = iter_json_records(io.BytesIO(b'[{"city": "Porto"},\n {"city": },\n {"city": "Lisboa"}]'))
+
+    assert next(records) == (1, {"city": "Porto"}, None)
+    with pytest.raises(TruncatedJSONFile) as error:
+        next(records)
+    assert error.value.line_number == 2
+
+
+def test_iter_json_records_skips_byte_order_mark():
+    records = list(iter_json_records(io.BytesIO(codecs.BOM_UTF8 + b'[{"city": "Porto"}]')))
+
+    assert records == [(1, {"city": "Porto"}, None)]
+
+
+def test_iter_json_records_not_json():
+    with pytest.raises(InvalidJSONFile):
+        parse("This is not a JSON file")
+
+
+def test_copy_houses_writes_csv():
+    mock_cursor = MagicMock()
+    house = {"city": "Porto, Foz", "latitude": 41.1, "longitude": -8.6, "age": 1, "num_bedrooms": 2, "num_bathrooms": 1, "area": 80.0, "is_apartment": True, "has_pool": False, "garage": False, "price": 200000}
+
+    copy_houses(mock_cursor, [house])
+
+    query, data = mock_cursor.copy_expert.call_args[0]
+    assert query.startswith("COPY houses (city, latitude")
+    assert query.endswith("WITH (FORMAT csv, FORCE_NOT_NULL (city))")
+    assert data.getvalue() == '"Porto, Foz",41.1,-8.6,1,2,1,80.0,True,False,False,200000\r\n'
+
+
+def test_insert_houses_skips_duplicates_through_staging_table():
+    mock_cursor = MagicMock()
+    mock_cursor.rowcount = 1
+    house = {"city": "Porto", "latitude": 41.1, "longitude": -8.6, "age": 1, "num_bedrooms": 2, "num_bathrooms": 1, "area": 80.0, "is_apartment": True, "has_pool": False, "garage": False, "price": 200000}
+
+    inserted = insert_houses(mock_cursor, [house, house])
+
+    assert inserted == 1
+    assert mock_cursor.copy_expert.call_args[0][0].startswith("COPY houses_import (")
+    assert mock_cursor.execute.call_args[0][0].endswith("FROM houses_import ON CONFLICT (content_hash) DO NOTHING")
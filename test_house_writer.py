@@ -0,0 +1,107 @@
+import threading
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+from house_writer import HouseWriteBuffer
+
+
+class FakeTable:
+    """Stands in for the multi-row insert: a house is inserted unless an identical one already is."""
+
+    def __init__(self, houses=()):
+        self.houses = set(houses)
+        self.connection = MagicMock()
+        self.batches = []
+
+    @contextmanager
+    def connect(self):
+        yield self.connection
+
+    def execute_values(self, cursor, query, rows, template, page_size, fetch):
+        self.batches.append(rows)
+        if any(row[-1] < 0 for row in rows):
+            raise ValueError("negative price")
+        inserted = []
+        for position, *house in rows:
+            if tuple(house) not in self.houses:
+                self.houses.add(tuple(house))
+                inserted.append((position,))
+        return inserted
+
+
+def house(price):
+    return ('Porto', 41.1, -8.6, 10, 2, 1, 80.0, True, False, False, price)
+
+
+@pytest.fixture
+def table():
+    table = FakeTable()
+    with patch('house_writer.execute_values', side_effect=table.execute_values):
+        yield table
+
+
+def add_concurrently(writer, houses):
+    barrier = threading.Barrier(len(houses))
+    def add(house):
+        barrier.wait()
+        try:
+            return writer.add(house)
+        except ValueError as error:
+            return error
+    with ThreadPoolExecutor(max_workers=len(houses)) as executor:
+        return list(executor.map(add, houses))
+
+
+def test_concurrent_houses_share_a_commit(table):
+    on_insert = MagicMock()
+    writer = HouseWriteBuffer(table.connect, "md5(city)", on_insert=on_insert, flush_ms=200)
+
+    results = add_concurrently(writer, [house(price) for price in range(5)])
+
+    assert results == [True] * 5
+    assert len(table.batches) < 5
+    assert table.connection.commit.call_count == len(table.batches)
+    assert on_insert.call_count == len(table.batches)
+
+
+def test_duplicates_get_false(table):
+    table.houses.add(house(1))
+    writer = HouseWriteBuffer(table.connect, "md5(city)", flush_ms=200)
+
+    results = add_concurrently(writer, [house(1), house(2), house(2)])
+
+    assert results[0] is False
+    assert sorted(results[1:]) == [False, True]
+
+
+def test_failed_batch_is_written_row_by_row(table):
+    writer = HouseWriteBuffer(table.connect, "md5(city)", flush_ms=200)
+
+    results = add_concurrently(writer, [house(1), house(-1), house(3)])
+
+    assert results[0] is True and results[2] is True
+    assert isinstance(results[1], ValueError)
+    assert house(1) in table.houses and house(3) in table.houses
+
+
+def test_full_batch_is_flushed_without_waiting(table):
+    writer = HouseWriteBuffer(table.connect, "md5(city)", flush_ms=10000, flush_rows=3)
+
+    started_at = time.perf_counter()
+    assert add_concurrently(writer, [house(price) for price in range(3)]) == [True] * 3
+    assert time.perf_counter() - started_at < 5
+
+
+def test_close_flushes_the_queue(table):
+    writer = HouseWriteBuffer(table.connect, "md5(city)", flush_ms=60000)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        result = executor.submit(writer.add, house(1))
+        while not writer._queue:
+            time.sleep(0.01)
+        writer.close()
+        assert result.result(timeout=5) is True
+
+    with pytest.raises(RuntimeError):
+        writer.add(house(2))
@@ -1,9 +1,12 @@
 import pytest
+import asyncio
 import json
 from uuid import uuid4
 from fastapi.testclient import TestClient
 from unittest.mock import patch, MagicMock
-from main import app, connect_db
+import main
+from main import app, connect_db, load_model_artifact
+from metrics import stage, REQUESTS
 
 
 @pytest.fixture
@@ -17,9 +20,12 @@ def mock_db_connection():
         mock_cursor = MagicMock()
         
         mock_cursor.__enter__.return_value = mock_cursor
+        mock_connection.closed = 0
         mock_connect.return_value = mock_connection
         
-        yield mock_connection, mock_cursor
+        # Every test gets a fresh pool, filled with the mocked connection
+        with patch('db.pool', None):
+            yield mock_connection, mock_cursor
         
         
 @pytest.fixture(autouse=True)
@@ -38,6 +44,27 @@ def test_connect_db_success(mock_db_connection):
     result = connect_db()
 
     assert result is True
+
+
+
+@pytest.mark.parametrize("duplicates, deduplicate, deleted, indexed", [
+    (0, False, False, True),
+    (2, False, False, False),
+    (2, True, True, True),
+])
+def test_connect_db_creates_content_hash_index(mock_db_connection, duplicates, deduplicate, deleted, indexed):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.side_effect = [("PostgreSQL 13",), (None,), (duplicates,)]  # Version, no index yet, duplicated houses
+
+    with patch('main.DEDUPLICATE_HOUSES', deduplicate):
+        assert connect_db() is True
+
+    queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+    assert any("ADD COLUMN IF NOT EXISTS content_hash" in query for query in queries)
+    # Houses are only deleted when the migration is asked for
+    assert any(query.startswith("DELETE FROM houses a USING houses b") for query in queries) is deleted
+    assert ("CREATE UNIQUE INDEX houses_content_hash_key ON houses (content_hash)" in queries) is indexed
     
     
 @pytest.mark.parametrize("city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, expected_status", [
@@ -51,7 +78,7 @@ def test_predict_house_price_success(test_client, city, latitude, longitude, age
     
     # Simulation of the behavior of the predict_house_price function
     with patch('main.price_predict') as mock_predict_price:
-        mock_predict_price.return_value = 300000  # Simulated price
+        mock_predict_price.return_value = (300000, 1)  # Simulated price and model version
         
         form_data = {
             'city': city,
@@ -66,14 +93,14 @@ def test_predict_house_price_success(test_client, city, latitude, longitude, age
             'garage': garage
         }
         
-        with patch('main.connection', mock_connection):
-            response = test_client.post("/house/predict/", data=form_data)
+        response = test_client.post("/house/predict/", data=form_data)
 
     assert response.status_code == expected_status
     
     if response.status_code == 200:
         assert "price" in response.json()
         assert response.json()["price"] == 300000
+        assert response.json()["model_version"] == 1
         
         
 @pytest.mark.parametrize("city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, expected_status, expected_message", [
@@ -111,8 +138,7 @@ def test_predict_house_price_bad_request(test_client, city, latitude, longitude,
     if garage is not None:
         form_data['garage'] = garage 
     
-    with patch('main.connection', mock_connection):
-        response = test_client.post("/house/predict/", data=form_data)
+    response = test_client.post("/house/predict/", data=form_data)
     
     assert response.status_code == expected_status
     assert response.json()["detail"] == expected_message
@@ -140,15 +166,16 @@ def test_add_house_success(test_client, city, latitude, longitude, age, num_bedr
         'price': price
     }
     
-    mock_cursor.fetchone.return_value = None  # No house with the same parameters
+    mock_cursor.fetchone.return_value = (str(uuid4()),)  # Inserted, no house with the same content hash
     mock_connection.cursor.return_value = mock_cursor
     
-    with patch('main.connection', mock_connection):
-        response = test_client.post("/house/", data=form_data)
+    response = test_client.post("/house/", data=form_data)
     
     assert response.status_code == expected_status
     if response.status_code == 200:
         assert response.json()["message"] == "House added successfully."
+        assert "ON CONFLICT (content_hash) DO NOTHING" in mock_cursor.execute.call_args[0][0]
+        mock_connection.commit.assert_called_once()
  
        
        
@@ -187,8 +214,7 @@ def test_add_house_bad_request(test_client, city, latitude, longitude, age, num_
     
     mock_connection.cursor.return_value = mock_cursor
     
-    with patch('main.connection', mock_connection):
-        response = test_client.post("/house/", data=form_data)
+    response = test_client.post("/house/", data=form_data)
     
     assert response.status_code == expected_status
     assert response.json()["detail"] == expected_message
@@ -215,13 +241,31 @@ def test_add_house_already_exist(test_client, city, latitude, longitude, age, nu
         'price': price
     }
     
+    mock_cursor.fetchone.return_value = None  # ON CONFLICT DO NOTHING returned no row
     mock_connection.cursor.return_value = mock_cursor
     
-    with patch('main.connection', mock_connection):
-        response = test_client.post("/house/", data=form_data)
+    response = test_client.post("/house/", data=form_data)
     
     assert response.status_code == expected_status
     assert response.json()["detail"] == "House already exists in the database."
+    mock_connection.commit.assert_not_called()
+
+
+def test_add_house_through_write_buffer(test_client):
+    form_data = {
+        'city': 'Porto', 'latitude': 41.15706, 'longitude': -8.57466, 'age': 0, 'num_bedrooms': 3, 'num_bathrooms': 3,
+        'area': 100, 'is_apartment': True, 'has_pool': False, 'garage': False, 'price': 300000
+    }
+
+    with patch('main.house_writer') as mock_writer:
+        mock_writer.enabled = True
+        mock_writer.add.side_effect = [True, False]
+        added = test_client.post("/house/", data=form_data)
+        duplicate = test_client.post("/house/", data=form_data)
+
+    assert added.status_code == 200
+    assert duplicate.status_code == 409
+    assert mock_writer.add.call_args[0][0] == ('Porto', 41.15706, -8.57466, 0, 3, 3, 100.0, True, False, False, 300000)
     
     
 def test_import_houses_json_success(test_client, mock_db_connection):
@@ -257,8 +301,9 @@ def test_import_houses_json_success(test_client, mock_db_connection):
     ]
   
     mock_cursor.execute.return_value = None
+    mock_cursor.rowcount = 2
 
-    with patch('main.connection', mock_connection), patch('main.UploadFile.read', return_value=json.dumps(json_data).encode('utf-8')):
+    with patch('main.UploadFile.read', return_value=json.dumps(json_data).encode('utf-8')):
         response = test_client.post("/houses/import/", files={'file_import': ('houses.json', json.dumps(json_data), 'application/json')})
 
     assert response.status_code == 200
@@ -277,11 +322,383 @@ def import_houses_json_bad_request(test_client, mock_db_connection):
 def test_remove_houses_success(test_client, mock_db_connection):
     mock_connection, mock_cursor = mock_db_connection
     
-    with patch('main.connection', mock_connection):
-        response = test_client.delete("/houses/")
+    response = test_client.delete("/houses/")
     
     assert response.status_code == 200
     assert response.json()["message"] == "All houses removed successfully."
     
 
     
+def test_predict_house_price_batch_per_row_errors(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+
+    houses = [
+        {"city": "Porto", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False},
+        {"city": "Porto", "latitude": 41.23706, "age": 0, "num_bedrooms": 2, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False},
+        {"city": "Porto", "latitude": 41.23706, "longitude": -8.37652, "age": 0, "num_bedrooms": 2, "num_bathrooms": 2, "area": 100, "is_apartment": False, "has_pool": True, "garage": True}
+    ]
+
+    with patch('main.batch_predict', return_value=([{"price": 300000.0}, {"price": 250000.0}], 1)) as mock_batch_predict:
+        response = test_client.post("/houses/predict/batch", json=houses)
+
+    assert response.status_code == 200
+    # Only the valid rows reach the model, in a single call
+    mock_batch_predict.assert_called_once_with([houses[0], houses[2]])
+    assert response.json() == {
+        "model_version": 1,
+        "results": [
+            {"index": 0, "price": 300000.0},
+            {"index": 1, "error": "Missing fields: longitude"},
+            {"index": 2, "price": 250000.0}
+        ]
+    }
+
+
+def test_predict_house_price_batch_ndjson(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+
+    house = {"city": "Porto", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": "no"}
+    content = json.dumps(house) + "\n" + json.dumps({**house, "garage": False}) + "\n"
+
+    with patch('main.batch_predict', return_value=([{"price": 300000.0}], 1)):
+        response = test_client.post("/houses/predict/batch", content=content, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"index": 0, "error": "Invalid value for garage: 'no'"},
+        {"index": 1, "price": 300000.0}
+    ]
+    
+    
+def test_predict_house_price_batch_ndjson_invalid_line(test_client, mock_db_connection):
+    house = {"city": "Porto", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False}
+    content = json.dumps(house) + "\n{broken\n" + json.dumps(house) + "\n"
+
+    with patch('main.batch_predict', return_value=([{"price": 300000.0}, {"price": 300000.0}], 1)):
+        response = test_client.post("/houses/predict/batch", content=content, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0] == {"index": 0, "price": 300000.0}
+    assert results[1]["index"] == 1 and results[1]["error"].startswith("Invalid JSON")
+    assert results[2] == {"index": 2, "price": 300000.0}
+
+
+def test_predict_house_price_batch_invalid_body(test_client):
+    response = test_client.post("/houses/predict/batch", content="not json", headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid JSON body"
+
+
+def test_import_houses_reports_rejected_rows(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+
+    house = {"city": "Porto", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False, "price": 250000}
+    lines = [json.dumps(house), json.dumps({**house, "price": None}), json.dumps(house), "{not json", json.dumps(house)]
+
+    # The second chunk holds a house already in the database
+    mock_cursor.rowcount = 2
+    with patch('main.IMPORT_CHUNK_SIZE', 2), patch('main.insert_houses', side_effect=[2, 0]) as mock_insert_houses:
+        response = test_client.post("/houses/import/", files={'file_import': ('houses.ndjson', "\n".join(lines), 'application/x-ndjson')})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["message"] == "Houses imported with errors."
+    assert body["accepted"] == 2
+    assert body["rejected"] == 2
+    assert body["duplicates"] == 1
+    assert [error["line"] for error in body["errors"]] == [2, 4]
+    # One staged insert and one commit per chunk
+    assert mock_insert_houses.call_count == 2
+    assert mock_connection.commit.call_count == 2
+
+
+def test_import_houses_rejects_values_out_of_the_column_range(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+
+    house = {"city": "", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False, "price": 250000}
+    lines = [json.dumps(house), json.dumps({**house, "price": 2 ** 31}), json.dumps({**house, "age": -2 ** 40})]
+
+    with patch('main.insert_houses', return_value=1) as mock_insert_houses:
+        response = test_client.post("/houses/import/", files={'file_import': ('houses.ndjson', "\n".join(lines), 'application/x-ndjson')})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == 1 and body["rejected"] == 2
+    assert body["errors"] == [
+        {"line": 2, "error": "Value out of range for price: 2147483648"},
+        {"line": 3, "error": f"Value out of range for age: {-2 ** 40}"}
+    ]
+    # An empty city is a valid house, COPY keeps it as ''
+    assert mock_insert_houses.call_args[0][1] == [house]
+
+
+def test_import_houses_reports_truncated_array(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+
+    house = {"city": "Porto", "latitude": 41.15706, "longitude": -8.57466, "age": 0, "num_bedrooms": 3, "num_bathrooms": 3, "area": 100, "is_apartment": True, "has_pool": False, "garage": False, "price": 250000}
+    content = "[\n" + json.dumps(house) + ",\n{broken},\n" + json.dumps(house) + "\n]"
+
+    with patch('main.insert_houses', return_value=1) as mock_insert_houses:
+        response = test_client.post("/houses/import/", files={'file_import': ('houses.json', content, 'application/json')})
+
+    assert response.status_code == 422
+    body = response.json()
+    assert body["truncated_at_line"] == 3
+    assert body["accepted"] == 1
+    # The houses before the malformed record are still imported
+    assert mock_insert_houses.call_args[0][1] == [house]
+
+
+HOUSE_ROW = ("Porto", 41.15706, -8.57466, 0, 3, 3, 100.0, True, False, False, 250000)
+
+
+def test_get_houses_paginated_with_filters(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    house_ids = [str(uuid4()) for _ in range(3)]
+    mock_cursor.fetchall.return_value = [(house_id,) + HOUSE_ROW for house_id in house_ids]
+
+    after = str(uuid4())
+    response = test_client.get("/houses/", params={"limit": 2, "after": after, "city": "Porto", "min_price": 200000, "min_latitude": 41.0})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [house["house_id"] for house in body["houses"]] == house_ids[:2]
+    assert body["houses"][0]["city"] == "Porto"
+    assert body["next_after"] == house_ids[1]
+
+    query, params = mock_cursor.execute.call_args[0]
+    assert "WHERE house_id > %s AND city = %s AND price >= %s AND latitude >= %s ORDER BY house_id LIMIT %s" in query
+    assert params == [after, "Porto", 200000, 41.0, 3]
+
+
+def test_get_houses_last_page(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [(str(uuid4()),) + HOUSE_ROW]
+
+    response = test_client.get("/houses/")
+
+    assert response.status_code == 200
+    assert len(response.json()["houses"]) == 1
+    assert response.json()["next_after"] is None
+
+
+def test_get_houses_stream_ndjson(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    house_ids = [str(uuid4()) for _ in range(3)]
+    mock_cursor.fetchmany.side_effect = [[(house_ids[0],) + HOUSE_ROW, (house_ids[1],) + HOUSE_ROW], [(house_ids[2],) + HOUSE_ROW], []]
+
+    response = test_client.get("/houses/", params={"format": "ndjson", "max_price": 300000})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    houses = [json.loads(line) for line in response.text.splitlines()]
+    assert [house["house_id"] for house in houses] == house_ids
+    # Server side cursor
+    mock_connection.cursor.assert_called_with(name="houses_export")
+
+
+def test_get_houses_stream_arrow(test_client, mock_db_connection):
+    pa = pytest.importorskip("pyarrow")
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchmany.side_effect = [[(str(uuid4()),) + HOUSE_ROW], [(str(uuid4()),) + HOUSE_ROW], []]
+
+    response = test_client.get("/houses/", params={"format": "arrow"})
+
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.num_rows == 2
+    assert table.column("price").to_pylist() == [250000, 250000]
+
+
+def test_train_model_job(test_client):
+    job = {"job_id": "1234", "status": "queued"}
+
+    with patch('main.runner.submit', return_value=job), patch('main.runner.get', return_value=job):
+        response = test_client.post("/model/train")
+
+    assert response.status_code == 202
+    assert response.json() == job
+
+
+def test_full_train_conflicts_with_a_pending_incremental_job(test_client):
+    job = {"job_id": "1234", "status": "running", "full": False}
+
+    with patch('main.runner.submit', return_value=job):
+        response = test_client.post("/model/train", params={"full": "true"})
+
+    assert response.status_code == 409
+    assert "not a full rebuild" in response.json()["detail"]
+
+
+def test_get_training_job_not_found(test_client):
+    response = test_client.get("/model/train/unknown")
+
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Training job not found"
+
+
+def test_get_active_model_without_model(test_client):
+    with patch('main.registry.model', None):
+        response = test_client.get("/model")
+
+    assert response.status_code == 200
+    assert response.json()["model_version"] is None
+
+
+@pytest.mark.parametrize("table_state, fresh", [
+    ((30, 30), True),
+    ((31, 31), False),
+])
+def test_load_model_artifact_on_startup(mock_db_connection, table_state, fresh):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = table_state
+    model = MagicMock(version=7, n_rows=30, watermark=30)
+
+    with patch('main.load_latest_model', return_value=model), patch('main.registry.install') as mock_install:
+        load_model_artifact()
+
+    mock_install.assert_called_once_with(model)
+    assert (model.data_version == main.registry.data_version) is fresh
+
+
+def test_get_prediction_cache_stats(test_client):
+    response = test_client.get("/model/cache")
+
+    assert response.status_code == 200
+    assert {"hits", "misses", "evictions", "size"} <= set(response.json())
+
+
+def test_profile_header_returns_stage_breakdown(test_client):
+    def profiled_predict(*args):
+        with stage('predict'):
+            return 300000, 1
+
+    form_data = {'city': 'Porto', 'latitude': 41.15, 'longitude': -8.57, 'age': 0, 'num_bedrooms': 3, 'num_bathrooms': 3, 'area': 100, 'is_apartment': True, 'has_pool': False, 'garage': False}
+    with patch('main.price_predict', side_effect=profiled_predict):
+        profiled = test_client.post("/house/predict/", data=form_data, headers={"X-Profile": "1"})
+        plain = test_client.post("/house/predict/", data=form_data)
+
+    assert profiled.status_code == 200
+    timings = dict(entry.split(";dur=") for entry in profiled.headers["server-timing"].split(", "))
+    assert set(timings) == {"predict", "total"}
+    assert float(timings["predict"]) <= float(timings["total"])
+    assert "server-timing" not in plain.headers
+
+
+def test_metrics_endpoint(test_client):
+    requests_before = REQUESTS.value(method="POST", route="/house/predict/", status="400")
+    test_client.post("/house/predict/", data={'city': 'Porto'})
+
+    response = test_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE house_api_stage_seconds histogram" in response.text
+    assert "# TYPE house_api_db_queries_total counter" in response.text
+    # Labelled with the route template, not the requested path
+    assert REQUESTS.value(method="POST", route="/house/predict/", status="400") == requests_before + 1
+
+
+def test_get_nearby_houses(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+    first_id, second_id = str(uuid4()), str(uuid4())
+    # Rows come back from the table in any order, the response keeps the distance order
+    mock_cursor.fetchall.return_value = [
+        (7, second_id, "Porto", 41.16, -8.6, 5, 2, 1, 80.0, True, False, False, 200000),
+        (3, first_id, "Porto", 41.15, -8.6, 5, 2, 1, 80.0, True, False, False, 210000),
+    ]
+
+    with patch('main.spatial_index') as mock_index:
+        mock_index.nearest.return_value = [(3, 0.12345), (7, 1.5)]
+        response = test_client.get("/houses/nearby", params={"latitude": 41.15, "longitude": -8.6, "k": 2, "city": "Porto"})
+
+    assert response.status_code == 200
+    houses = response.json()["houses"]
+    assert [house["house_id"] for house in houses] == [first_id, second_id]
+    assert [house["distance_km"] for house in houses] == [0.1235, 1.5]
+    assert mock_index.nearest.call_args[0][:5] == (41.15, -8.6, 2, None, "Porto")
+    assert mock_cursor.execute.call_args[0][1] == ([3, 7],)
+
+
+def test_get_nearby_houses_validates_coordinates(test_client):
+    response = test_client.get("/houses/nearby", params={"latitude": 95, "longitude": -8.6})
+
+    assert response.status_code == 422
+
+
+def test_healthz(test_client):
+    response = test_client.get("/healthz")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+
+
+def test_readyz_not_ready_without_model(test_client):
+    with patch('main.registry.model', None):
+        response = test_client.get("/readyz")
+
+    assert response.status_code == 503
+    assert response.json()["database"] is True
+    assert response.json()["model"] is False
+
+
+def test_readyz_ready_records_time_to_ready(test_client, mock_db_connection):
+    mock_connection, mock_cursor = mock_db_connection
+    mock_connection.cursor.return_value = mock_cursor
+
+    with patch('main.registry.model', MagicMock()), patch('main.ready_seconds', None):
+        response = test_client.get("/readyz")
+        ready_seconds = main.ready_seconds
+
+    assert response.status_code == 200
+    assert response.json()["ready"] is True
+    assert response.json()["time_to_ready_seconds"] == ready_seconds > 0
+    mock_cursor.execute.assert_called_once_with("SELECT 1")
+
+
+def test_prepare_service_backs_off_until_database_is_up():
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    with patch('main.connect_db', side_effect=[False, False, False, True]) as mock_connect, \
+            patch('main.asyncio.sleep', side_effect=sleep), \
+            patch('main.load_model_artifact'), patch('main.readiness'), \
+            patch('main.registry.model', MagicMock()), patch('main.MODEL_WARMUP', False), \
+            patch('main.DB_CONNECT_INITIAL_DELAY', 1), patch('main.DB_CONNECT_MAX_DELAY', 3):
+        asyncio.run(main.prepare_service())
+
+    assert mock_connect.call_count == 4
+    # Jittered in [delay / 2, delay], the delay doubles up to the maximum
+    for delay, maximum in zip(delays, [1, 2, 3]):
+        assert maximum / 2 <= delay <= maximum
+
+
+def test_warm_up_model_predicts_a_house_per_city():
+    model = MagicMock(cities=["Porto", "Lisboa"])
+
+    main.warm_up_model(model)
+
+    houses = model.predict.call_args[0][0]
+    assert sorted(house["city"] for house in houses) == ["Lisboa", "Porto"]
+
+
+def test_predict_house_price_batch_runs_off_the_event_loop(test_client):
+    with patch('main.run_in_threadpool', side_effect=main.run_in_threadpool) as mock_run_in_threadpool:
+        response = test_client.post("/houses/predict/batch", content="not json", headers={"Content-Type": "application/json"})
+
+    # Parsing happens in the threadpool too
+    assert response.status_code == 400
+    assert mock_run_in_threadpool.call_args[0][0] is main.predict_batch_body
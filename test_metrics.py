@@ -0,0 +1,65 @@
+import pytest
+from unittest.mock import MagicMock
+from metrics import MetricsRegistry, profile, stage, add_stage_time, query_operation, record_query, server_timing, STAGE_SECONDS
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ["stage"], buckets=(0.1, 1))
+
+    histogram.observe(0.05, stage="fit")
+    histogram.observe(0.5, stage="fit")
+    histogram.observe(5, stage="fit")
+
+    lines = registry.render().splitlines()
+    assert lines[:2] == ["# HELP latency_seconds Latency", "# TYPE latency_seconds histogram"]
+    assert 'latency_seconds_bucket{stage="fit",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{stage="fit",le="1"} 2' in lines
+    assert 'latency_seconds_bucket{stage="fit",le="+Inf"} 3' in lines
+    assert 'latency_seconds_sum{stage="fit"} 5.55' in lines
+    assert 'latency_seconds_count{stage="fit"} 3' in lines
+
+
+def test_counter_and_gauges_render():
+    registry = MetricsRegistry()
+    registry.counter("queries_total", "Queries", ["operation"]).inc(operation='sel"ect')
+    registry.gauge("model_rows", "Rows", function=lambda: 1234)
+    registry.gauge("no_model", "Nothing yet", function=lambda: None)
+
+    text = registry.render()
+
+    assert 'queries_total{operation="sel\\"ect"} 1' in text
+    assert "model_rows 1234" in text
+    assert "# TYPE no_model gauge" in text and "\nno_model " not in text
+
+
+def test_stages_are_collected_by_profile_instead_of_observed():
+    count_before = STAGE_SECONDS.count(stage="test_stage")
+
+    with profile() as stages:
+        with stage("test_stage"):
+            pass
+        add_stage_time("test_stage", 0.5)
+        record_query("select", 0.25)
+
+    assert stages["test_stage"] >= 0.5
+    assert stages["db"] == 0.25
+    assert STAGE_SECONDS.count(stage="test_stage") == count_before
+
+    add_stage_time("test_stage", 0.5)
+    assert STAGE_SECONDS.count(stage="test_stage") == count_before + 1
+
+
+@pytest.mark.parametrize("query, operation", [
+    ("SELECT 1", "select"),
+    ("\n    INSERT INTO houses VALUES (%s)", "insert"),
+    (b"COPY houses FROM STDIN", "copy"),
+    ("VACUUM houses", "other"),
+    (MagicMock(), "other"),
+])
+def test_query_operation(query, operation):
+    assert query_operation(query) == operation
+
+
+def test_server_timing():
+    assert server_timing({"encode": 0.0001, "predict": 0.0125}) == "encode;dur=0.100, predict;dur=12.500"
@@ -0,0 +1,100 @@
+import json
+import os
+import pytest
+import numpy as np
+from unittest.mock import patch
+from training_model import train_model, train_sharded_model
+import model_store
+
+
+@pytest.fixture
+def model(houses_df):
+    return train_model(houses_df, 3, 0)
+
+
+def test_save_and_load_model(tmp_path, model):
+    path = model_store.save_model(model, str(tmp_path))
+    loaded = model_store.load_latest_model(str(tmp_path))
+
+    assert loaded.artifact_path == path
+    assert loaded.version == 3
+    assert loaded.feature_columns == model.feature_columns
+    assert loaded.cities == model.cities
+    assert loaded.watermark == 30
+    assert loaded.n_rows == 30
+    # Same forest, same predictions
+    houses = model.training_frame.drop(columns=['price', 'seq']).to_dict(orient='records')
+    assert list(loaded.predict(houses)) == list(model.predict(houses))
+
+
+def test_load_latest_skips_incompatible_artifacts(tmp_path, model):
+    old_path = model_store.save_model(model, str(tmp_path))
+    model.version, model.trained_at = 4, model.trained_at + 1
+    new_path = model_store.save_model(model, str(tmp_path))
+
+    metadata = model_store.read_metadata(new_path)
+    metadata["sklearn_version"] = "0.0.1"
+    with open(os.path.join(new_path, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+    assert model_store.load_latest_model(str(tmp_path)).artifact_path == old_path
+
+
+def test_prune_keeps_newest_artifacts(tmp_path, model):
+    paths = []
+    for version in range(1, 5):
+        model.version, model.trained_at = version, model.trained_at + 1
+        with patch('model_store.MODEL_ARTIFACTS_KEEP', 2):
+            paths.append(model_store.save_model(model, str(tmp_path)))
+
+    assert model_store.list_artifacts(str(tmp_path)) == [paths[3], paths[2]]
+
+
+def test_load_latest_without_artifacts(tmp_path):
+    assert model_store.load_latest_model(str(tmp_path / "missing")) is None
+
+
+def test_sharded_model_links_unchanged_shards(tmp_path, houses_df):
+    df = houses_df
+    df['city'] = ['Braga'] * 15 + ['Porto'] * 15
+    with patch('training_model.SHARD_MIN_ROWS', 10):
+        model = train_sharded_model(df, 1, 0)
+        path = model_store.save_model(model, str(tmp_path))
+        loaded = model_store.load_latest_model(str(tmp_path))
+        retrained = train_sharded_model(df, 2, 1, loaded, changed_cities={'Porto'})
+        retrained.trained_at += 1
+        new_path = model_store.save_model(retrained, str(tmp_path))
+
+    houses = df.drop(columns=['price', 'seq']).to_dict(orient='records')
+    assert list(loaded.predict(houses)) == list(model.predict(houses))
+    assert {city: shard.version for city, shard in loaded.shards.items()} == {'Braga': 1, 'Porto': 1}
+    # The Braga model was not fitted again, the new artifact shares its file with the previous one
+    braga_file = model_store.read_metadata(new_path)["shards"]["Braga"]["file"]
+    assert os.path.samefile(os.path.join(path, braga_file), os.path.join(new_path, braga_file))
+    assert model_store.read_metadata(new_path)["shards"]["Porto"]["version"] == 2
+
+
+def test_compiled_forest_is_served_without_the_estimator(tmp_path, model):
+    path = model_store.save_model(model, str(tmp_path))
+    loaded = model_store.load_latest_model(str(tmp_path))
+    with patch('training_model.MODEL_PREDICTOR', 'sklearn'):
+        loaded_estimator = model_store.load_latest_model(str(tmp_path))
+
+    assert os.path.isfile(os.path.join(path, "estimator.forest", "threshold.npy"))
+    assert loaded.estimator is None and loaded.forest is not None
+    assert loaded_estimator.forest is None and loaded_estimator.estimator is not None
+    assert loaded.tree_nodes == loaded_estimator.tree_nodes
+    houses = model.training_frame.drop(columns=['price', 'seq']).to_dict(orient='records')
+    assert np.allclose(loaded.predict(houses), loaded_estimator.predict(houses), rtol=1e-6)
+
+
+def test_other_entries_of_the_model_dir_are_ignored(tmp_path, model):
+    (tmp_path / "lost+found").mkdir()
+    (tmp_path / "notes.txt").write_text("not an artifact")
+
+    with patch('model_store.MODEL_ARTIFACTS_KEEP', 1):
+        path = model_store.save_model(model, str(tmp_path))
+
+    assert model_store.list_artifacts(str(tmp_path)) == [path]
+    assert model_store.load_latest_model(str(tmp_path)).artifact_path == path
+    assert (tmp_path / "lost+found").is_dir() and (tmp_path / "notes.txt").exists()
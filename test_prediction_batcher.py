@@ -0,0 +1,75 @@
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from prediction_batcher import PredictionBatcher
+
+
+def make_model():
+    model = MagicMock()
+    def predict(houses):
+        if any(house['area'] < 0 for house in houses):
+            raise ValueError("negative area")
+        return np.array([house['area'] * 2 for house in houses], dtype=np.float64)
+    model.predict.side_effect = predict
+    return model
+
+
+def predict_concurrently(batcher, requests):
+    barrier = threading.Barrier(len(requests))
+    def predict(request):
+        model, house = request
+        barrier.wait()
+        try:
+            return batcher.predict(model, house)
+        except ValueError as error:
+            return error
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        return list(executor.map(predict, requests))
+
+
+def test_concurrent_predictions_share_a_predict_call():
+    batcher = PredictionBatcher(window_ms=200, max_batch_size=64)
+    model = make_model()
+
+    prices = predict_concurrently(batcher, [(model, {'area': area}) for area in range(10)])
+
+    assert prices == [area * 2.0 for area in range(10)]
+    assert model.predict.call_count < 10
+    stats = batcher.stats()
+    assert stats['requests'] == 10
+    assert stats['max_batch'] > 1
+    assert stats['mean_queue_ms'] is not None
+
+
+def test_full_batch_does_not_wait_for_the_window():
+    batcher = PredictionBatcher(window_ms=10000, max_batch_size=4)
+    model = make_model()
+
+    started_at = time.perf_counter()
+    prices = predict_concurrently(batcher, [(model, {'area': area}) for area in range(4)])
+
+    assert prices == [0.0, 2.0, 4.0, 6.0]
+    assert time.perf_counter() - started_at < 5
+
+
+def test_error_only_reaches_its_own_caller():
+    batcher = PredictionBatcher(window_ms=200)
+    model = make_model()
+
+    results = predict_concurrently(batcher, [(model, {'area': 1}), (model, {'area': -1}), (model, {'area': 3})])
+
+    assert results[0] == 2.0 and results[2] == 6.0
+    assert isinstance(results[1], ValueError)
+
+
+def test_houses_of_different_models_are_predicted_separately():
+    batcher = PredictionBatcher(window_ms=200)
+    old_model, new_model = make_model(), make_model()
+
+    prices = predict_concurrently(batcher, [(old_model, {'area': 1}), (new_model, {'area': 2}), (old_model, {'area': 3})])
+
+    assert prices == [2.0, 4.0, 6.0]
+    assert all(len(call[0][0]) <= 2 for call in old_model.predict.call_args_list)
+    assert sum(len(call[0][0]) for call in new_model.predict.call_args_list) == 1
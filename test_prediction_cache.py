@@ -0,0 +1,52 @@
+from unittest.mock import patch
+from prediction_cache import PredictionCache
+
+
+def test_hit_on_nearly_identical_house(house):
+    cache = PredictionCache(max_size=10, ttl=0, coord_decimals=4)
+    cache.put(1, house, 300000.0)
+
+    assert cache.get(1, {**house, 'latitude': 41.157061, 'area': 100.0}) == 300000.0
+    assert cache.get(1, {**house, 'num_bedrooms': 4}) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_new_model_version_invalidates(house):
+    cache = PredictionCache(max_size=10, ttl=0)
+    cache.put(1, house, 300000.0)
+
+    assert cache.get(2, house) is None
+    assert cache.stats()['size'] == 0
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_lru_eviction(house):
+    cache = PredictionCache(max_size=2, ttl=0)
+    cache.put(1, {**house, 'age': 1}, 1.0)
+    cache.put(1, {**house, 'age': 2}, 2.0)
+    cache.get(1, {**house, 'age': 1})
+    cache.put(1, {**house, 'age': 3}, 3.0)
+
+    # age=2 was the least recently used
+    assert cache.get(1, {**house, 'age': 2}) is None
+    assert cache.get(1, {**house, 'age': 1}) == 1.0
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_expiration(house):
+    cache = PredictionCache(max_size=10, ttl=60)
+
+    with patch('prediction_cache.time.monotonic', return_value=1000):
+        cache.put(1, house, 300000.0)
+    with patch('prediction_cache.time.monotonic', return_value=1061):
+        assert cache.get(1, house) is None
+
+    assert cache.stats()['expirations'] == 1
+
+
+def test_disabled_cache(house):
+    cache = PredictionCache(max_size=0)
+    cache.put(1, house, 300000.0)
+
+    assert cache.get(1, house) is None
@@ -0,0 +1,89 @@
+import time
+import numpy as np
+import pytest
+from spatial_index import SpatialIndex, haversine, EARTH_RADIUS_KM
+
+
+def make_houses(n, seed=0, first_seq=1):
+    rng = np.random.default_rng(seed)
+    cities = ["Porto", "Braga", "Lisboa"]
+    return [
+        (seq, float(41 + rng.normal(0, 0.5)), float(-8.5 + rng.normal(0, 0.5)), cities[seq % 3], int(rng.integers(100000, 500000)), int(rng.integers(1, 5)), bool(seq % 2))
+        for seq in range(first_seq, first_seq + n)
+    ]
+
+
+@pytest.fixture
+def table():
+    return make_houses(2000)
+
+
+@pytest.fixture
+def index(table):
+    index = SpatialIndex(connection_factory=None, max_delta=1000)
+    index._load = lambda after_seq=0: [row for row in table if row[0] > after_seq]
+    return index
+
+
+def brute_force(table, latitude, longitude, k, radius_km=None, city=None, min_price=None):
+    rows = [row for row in table if (city is None or row[3] == city) and (min_price is None or row[4] >= min_price)]
+    coordinates = np.radians([[row[1], row[2]] for row in rows])
+    distances = haversine(np.radians([latitude, longitude]), coordinates) * EARTH_RADIUS_KM
+    order = [i for i in np.argsort(distances) if radius_km is None or distances[i] <= radius_km][:k]
+    return [(rows[i][0], distances[i]) for i in order]
+
+
+@pytest.mark.parametrize("k, radius_km, city, min_price", [
+    (10, None, None, None),
+    (25, None, "Braga", 300000),
+    (1000, 20, None, None),
+    (5, 50, "Lisboa", None),
+])
+def test_nearest_matches_brute_force(table, index, k, radius_km, city, min_price):
+    # Half of the rows in the tree, half in the delta searched by brute force
+    index.install(index.build(table[:1000]), 0, built=True)
+    index.refresh(1)
+    assert index.stats()["delta_rows"] == 1000
+
+    nearest = index.nearest(41.1, -8.6, k, radius_km, city, min_price)
+    expected = brute_force(table, 41.1, -8.6, k, radius_km, city, min_price)
+
+    assert [seq for seq, _ in nearest] == [seq for seq, _ in expected]
+    assert np.allclose([distance for _, distance in nearest], [distance for _, distance in expected])
+
+
+def test_refresh_follows_the_data_version(table, index):
+    index.refresh(0)
+    assert index.stats() == {"rows": 2000, "tree_rows": 2000, "delta_rows": 0, "watermark": 2000, "data_version": 0}
+
+    table.extend(make_houses(10, seed=1, first_seq=2001))
+    assert len(index.refresh(0)) == 2000
+    index.refresh(1)
+    assert index.stats()["delta_rows"] == 10
+    assert index.nearest(table[-1][1], table[-1][2], 1)[0] == (2010, 0.0)
+
+    # Rows were deleted: built again from scratch
+    del table[:1500]
+    index.refresh(2, full_rebuild_version=2)
+    assert index.stats()["rows"] == 510
+    assert index.stats()["delta_rows"] == 0
+
+
+def test_large_delta_is_merged_in_the_background(table, index):
+    index.max_delta = 5
+    index.refresh(0)
+
+    table.extend(make_houses(10, seed=1, first_seq=2001))
+    index.refresh(1)
+
+    deadline = time.monotonic() + 5
+    while index.stats()["delta_rows"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.stats()["tree_rows"] == 2010
+    assert index.stats()["data_version"] == 1
+
+
+def test_unknown_city_has_no_neighbours(table, index):
+    index.refresh(0)
+
+    assert index.nearest(41.1, -8.6, 5, city="Faro") == []
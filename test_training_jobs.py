@@ -0,0 +1,108 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+from training_model import ModelRegistry, train_model
+from training_jobs import TrainingJobRunner
+
+
+pytestmark = pytest.mark.usefixtures("model_dir")
+
+
+@pytest.fixture
+def runner():
+    registry = ModelRegistry()
+    runner = TrainingJobRunner(registry, executor=ThreadPoolExecutor(max_workers=1))
+    registry.trainer = runner.request
+    with patch('training_model.db.connect'):
+        yield runner
+
+
+def test_previous_model_serves_while_retraining(runner, houses_df):
+    registry = runner.registry
+    release = threading.Event()
+
+    def slow_load(*args, **kwargs):
+        release.wait(5)
+        return houses_df
+
+    with patch('training_model.load_training_data', return_value=houses_df):
+        first = registry.get_model()
+
+    registry.mark_stale()
+    with patch('training_model.load_training_data', side_effect=slow_load):
+        # The stale model is returned right away and a single job is started
+        assert registry.get_model() is first
+        job_id = runner.pending_job_id
+        assert registry.get_model() is first
+        assert runner.pending_job_id == job_id
+
+        release.set()
+        runner.request().result(5)
+
+    job = runner.get(job_id)
+    assert job["status"] == "succeeded"
+    assert job["reason"] == "stale"
+    assert {"started_at", "load_seconds", "fit_seconds", "save_seconds", "mode", "rows_loaded"} <= set(job["timings"])
+    # The estimator was saved by the job and loaded back from its artifact
+    assert registry.model.artifact_path is not None
+    assert job["metrics"]["n_rows"] == len(houses_df)
+    assert registry.model.version == job["model_version"]
+    assert not registry.is_stale(registry.model)
+
+
+def test_failed_job_is_reported(runner):
+    with patch('training_model.load_training_data', side_effect=RuntimeError("connection refused")):
+        job = runner.submit()
+        with pytest.raises(RuntimeError):
+            job["done"].result(5)
+
+    assert runner.get(job["job_id"])["status"] == "failed"
+    assert runner.get(job["job_id"])["error"] == "connection refused"
+    assert runner.registry.model is None
+    assert runner.pending_job_id is None
+
+
+def test_install_keeps_newest_model():
+    registry = ModelRegistry()
+
+    class FakeModel:
+        def __init__(self, version):
+            self.version = version
+
+    assert registry.install(FakeModel(2))
+    assert not registry.install(FakeModel(1))
+    assert registry.model.version == 2
+
+
+def test_deleted_rows_force_full_rebuild(houses_df):
+    registry = ModelRegistry()
+    registry.install(train_model(houses_df, registry.next_version(), registry.data_version))
+    mock_executor = MagicMock()
+    runner = TrainingJobRunner(registry, executor=mock_executor)
+
+    # Only new rows since the model was trained, the job appends them to the training snapshot
+    registry.mark_stale()
+    runner.submit()
+    assert mock_executor.submit.call_args[0][3] is False
+
+    runner._pending = None
+    registry.mark_stale(rows_deleted=True)
+    job = runner.submit()
+    assert mock_executor.submit.call_args[0][3] is True
+    assert runner.get(job["job_id"])["full"] is True
+
+
+def test_stale_artifact_does_not_force_full_rebuild(houses_df):
+    registry = ModelRegistry()
+    model = train_model(houses_df, registry.next_version(), registry.data_version)
+    # Loaded from disk without matching the table, as load_model_artifact installs it
+    model.data_version = -1
+    registry.install(model)
+    mock_executor = MagicMock()
+    runner = TrainingJobRunner(registry, executor=mock_executor)
+
+    job = runner.submit("stale")
+
+    assert mock_executor.submit.call_args[0][3] is False
+    assert runner.get(job["job_id"])["full"] is False
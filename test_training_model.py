@@ -0,0 +1,341 @@
+import pytest
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import numpy as np
+from fastapi import HTTPException
+import forest_training
+from training_model import ModelRegistry, TRAINING_QUERY, FEATURE_FIELDS, train_model, train_sharded_model, train_from_database, price_predict, batch_predict, load_training_data, concat_frames, stratified_sample
+from training_jobs import TrainingJobRunner
+from prediction_cache import PredictionCache
+from prediction_batcher import PredictionBatcher
+from training_snapshot import write_snapshot, open_snapshot
+
+
+pytestmark = pytest.mark.usefixtures("model_dir")
+
+
+@pytest.fixture(autouse=True)
+def mock_connect():
+    with patch('training_model.db.connect') as mock_connect:
+        yield mock_connect
+
+
+@pytest.fixture(autouse=True)
+def prediction_cache():
+    # Models of different tests share version numbers, each test gets its own cache
+    with patch('training_model.prediction_cache', PredictionCache()) as cache:
+        yield cache
+
+
+@pytest.fixture
+def registry():
+    # Jobs run in a thread instead of a process, so the patches of the tests apply to them
+    registry = ModelRegistry()
+    runner = TrainingJobRunner(registry, executor=ThreadPoolExecutor(max_workers=1))
+    registry.trainer = runner.request
+    return registry
+
+
+TRAINING_COLUMNS = ['city', 'latitude', 'longitude', 'age', 'num_bedrooms', 'num_bathrooms', 'area', 'is_apartment', 'has_pool', 'garage', 'price', 'seq']
+
+
+def set_row_count(mock_connect, row_count):
+    mock_cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchone.return_value = (row_count,)
+
+
+def set_training_rows(mock_connect, *frames):
+    # Every load reads one frame through the server side cursor, as a single chunk
+    mock_cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    chunks = []
+    for frame in frames:
+        rows = list(frame[TRAINING_COLUMNS].itertuples(index=False, name=None))
+        chunks += [rows, []] if rows else [[]]
+    mock_cursor.fetchmany.side_effect = chunks
+    return mock_cursor
+
+
+def training_queries(mock_cursor):
+    return [call for call in mock_cursor.execute.call_args_list if call[0][0].startswith(TRAINING_QUERY)]
+
+
+def test_registry_reuses_model_until_stale(registry, houses_df, mock_connect):
+    mock_cursor = set_training_rows(mock_connect, houses_df, houses_df.iloc[:0])
+    # Nothing to serve yet, the first call waits for the training job
+    first = registry.get_model()
+    second = registry.get_model()
+
+    assert first is second
+    assert [call[0][0] for call in training_queries(mock_cursor)] == [TRAINING_QUERY]
+
+    set_row_count(mock_connect, len(houses_df))
+    registry.mark_stale()
+    registry.get_model()
+    registry.trainer("test").result(5)
+    third = registry.get_model()
+
+    assert len(training_queries(mock_cursor)) == 2
+    assert third.training_mode == 'incremental'
+    assert third is not first
+    assert third.version == first.version + 1
+    assert third.data_version == registry.data_version
+
+
+def test_trained_model_keeps_columns_and_cities(registry, houses_df, house, mock_connect):
+    set_training_rows(mock_connect, houses_df)
+    model = registry.get_model()
+
+    assert model.cities == ['Porto']
+    assert 'price' not in model.feature_columns
+    assert model.n_rows == len(houses_df)
+    assert set(model.metrics) == {
+        'oob_r2', 'oob_mae', 'fit_rows', 'params', 'cores', 'fit_seconds',
+        'forest_bytes', 'compiled_forest_bytes', 'predict_1_row_ms', 'compiled_predict_1_row_ms', 'compiled_max_abs_error'
+    }
+    assert len(model.predict([house])) == 1
+
+
+def dataframe_features(model, houses):
+    # The get_dummies + reindex path the FeatureEncoder replaces
+    house_df = pd.DataFrame(houses, columns=FEATURE_FIELDS)
+    city_dummies = pd.get_dummies(house_df.pop('city'), prefix='city')
+    house_df = pd.concat([house_df, city_dummies], axis=1)
+    return house_df.reindex(columns=model.feature_columns, fill_value=0)
+
+
+def test_encoder_matches_dataframe_path(houses_df, house):
+    houses_df = pd.concat([houses_df, houses_df.head(5).assign(city='Braga'), houses_df.tail(5).assign(city='Aveiro')], ignore_index=True)
+    model = train_model(houses_df, 1, 0)
+    houses = houses_df.drop(columns=['price', 'seq']).to_dict(orient='records') + [house]
+
+    X = model.encoder.encode(houses)
+
+    assert X.dtype == np.float32
+    assert np.array_equal(X, dataframe_features(model, houses).to_numpy(dtype=np.float32))
+    assert np.array_equal(model.predict(houses), model.estimator.predict(dataframe_features(model, houses).to_numpy(dtype=np.float32)))
+    # The baseline city has no column but is known
+    assert 'city_Aveiro' not in model.feature_columns
+    assert model.encoder.unknown_city_error({**house, 'city': 'Aveiro'}) is None
+
+
+def test_batch_predict_matches_single_predictions(houses_df, house):
+    houses = [house, {**house, 'area': 250, 'num_bedrooms': 5}, {**house, 'age': 40}]
+    model = train_model(houses_df, 1, 0)
+
+    batch_prices = model.predict(houses)
+    single_prices = [model.predict([h])[0] for h in houses]
+
+    assert list(batch_prices) == single_prices
+
+
+def test_unknown_city_policy(houses_df, house):
+    model = train_model(houses_df, 1, 0)
+    registry = ModelRegistry()
+    registry.install(model)
+    lisboa = {**house, 'city': 'Lisboa'}
+
+    with patch('training_model.registry', registry):
+        with pytest.raises(HTTPException) as error:
+            price_predict(*lisboa.values())
+        assert error.value.status_code == 400
+        assert error.value.detail == "Unknown city: Lisboa"
+
+        results, version = batch_predict([lisboa, house])
+        assert results[0] == {'error': "Unknown city: Lisboa"}
+        assert 'price' in results[1]
+
+        with patch('training_model.UNKNOWN_CITY_POLICY', 'baseline'):
+            price, version = price_predict(*lisboa.values())
+        assert price == model.predict([{**house, 'city': 'Porto'}])[0]
+
+
+def test_incremental_retrain_reads_only_new_rows(houses_df, mock_connect):
+    base, delta = houses_df.iloc[:25], houses_df.iloc[25:]
+    write_snapshot(base, 0)
+    set_row_count(mock_connect, len(base))
+
+    mock_cursor = set_training_rows(mock_connect, delta)
+    model, timings = train_from_database(2, 1)
+
+    query, params = training_queries(mock_cursor)[-1][0]
+    assert query.endswith("WHERE seq > %(after_seq)s")
+    assert params == {'after_seq': 25}
+    assert timings['mode'] == 'incremental'
+    assert timings['rows_loaded'] == 5
+    assert model.n_rows == len(houses_df)
+    assert model.watermark == 30
+    # The new rows were appended to the snapshot
+    assert (open_snapshot().rows, open_snapshot().watermark, open_snapshot().data_version) == (30, 30, 1)
+
+
+@pytest.mark.parametrize("kept_rows, loads", [
+    (24, 1),   # A row was deleted, the snapshot is not used
+    (25, 2),   # 5 new rows on top of 25 is past the 20% drift threshold
+])
+def test_full_retrain_when_cache_can_not_be_reused(houses_df, mock_connect, kept_rows, loads):
+    write_snapshot(houses_df.iloc[:25], 0)
+    set_row_count(mock_connect, kept_rows)
+
+    frames = [houses_df.iloc[25:], houses_df][-loads:]
+    mock_cursor = set_training_rows(mock_connect, *frames)
+    with patch('training_model.TRAINING_DRIFT_THRESHOLD', 0.1):
+        model, timings = train_from_database(2, 1)
+
+    assert training_queries(mock_cursor)[-1][0] == (TRAINING_QUERY,)
+    assert timings['mode'] == 'full'
+    assert model.n_rows == len(houses_df)
+    assert open_snapshot().rows == len(houses_df)
+
+
+def test_full_retrain_asked_for_skips_the_snapshot(houses_df, mock_connect):
+    write_snapshot(houses_df.iloc[:25], 0)
+    mock_cursor = set_training_rows(mock_connect, houses_df)
+
+    model, timings = train_from_database(2, 1, full=True)
+
+    assert [call[0] for call in mock_cursor.execute.call_args_list] == [(TRAINING_QUERY,)]
+    assert timings['mode'] == 'full'
+
+
+def test_price_predict_uses_prediction_cache(houses_df, house):
+    registry = ModelRegistry()
+    registry.install(train_model(houses_df, 1, 0))
+
+    with patch('training_model.registry', registry), patch('training_model.prediction_cache', PredictionCache(max_size=10)) as cache, \
+            patch.object(registry.model, 'predict', wraps=registry.model.predict) as mock_predict:
+        first = price_predict(*house.values())
+        second = price_predict(*house.values())
+
+    assert first == second
+    assert mock_predict.call_count == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_training_data_is_loaded_in_chunks_with_compact_types(houses_df, mock_connect):
+    mock_cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    rows = list(houses_df.assign(city=['Porto', 'Braga'] * 15)[TRAINING_COLUMNS].itertuples(index=False, name=None))
+    rows[3] = rows[3][:3] + (None,) + rows[3][4:]  # NULL age
+    mock_cursor.fetchmany.side_effect = [rows[:20], rows[20:], []]
+
+    df = load_training_data(mock_connect.return_value)
+
+    mock_connect.return_value.cursor.assert_called_with(name='training_data')
+    assert len(df) == 30
+    assert isinstance(df['city'].dtype, pd.CategoricalDtype)
+    assert list(df['city'].cat.categories) == ['Porto', 'Braga']
+    assert df['latitude'].dtype == np.float32
+    assert df['num_bedrooms'].dtype == np.int32
+    assert df['garage'].dtype == bool
+    assert df['seq'].dtype == np.int64
+    # A NULL turns the column into float32 NaN in its chunk
+    assert df['age'].dtype == np.float32 and np.isnan(df['age'][3])
+
+
+def test_features_match_get_dummies(houses_df):
+    houses_df = houses_df.assign(city=['Porto', 'Braga', 'Aveiro'] * 10)
+    categorical = concat_frames(houses_df.iloc[:15].astype({'city': 'category'}), houses_df.iloc[15:].astype({'city': 'category'}))
+    dummies = pd.get_dummies(houses_df.drop(columns=['seq', 'price']), columns=['city'], drop_first=True)
+
+    model = train_model(categorical, 1, 0)
+
+    assert isinstance(categorical['city'].dtype, pd.CategoricalDtype)
+    assert model.feature_columns == list(dummies.columns)
+    assert np.array_equal(model.encoder.encode(houses_df.to_dict(orient='records')), dummies.to_numpy(dtype=np.float32))
+
+
+def test_training_rows_are_capped_by_city(houses_df):
+    houses_df = houses_df.assign(city=['Porto'] * 24 + ['Braga'] * 6)
+
+    positions = stratified_sample(houses_df['city'], 10)
+    with patch('training_model.TRAINING_MAX_ROWS', 10):
+        model = train_model(houses_df, 1, 0)
+
+    assert list(houses_df['city'].iloc[positions].value_counts().sort_index()) == [2, 8]
+    assert model.metrics['fit_rows'] == 10
+    assert model.n_rows == 30
+    assert model.cities == ['Braga', 'Porto']
+
+
+@pytest.fixture
+def sharded_df(houses_df):
+    # Braga and Porto get their own model with SHARD_MIN_ROWS at 10, Aveiro goes to the fallback
+    return houses_df.assign(city=['Braga'] * 12 + ['Aveiro'] * 3 + ['Porto'] * 15)
+
+
+def test_sharded_model_routes_houses_by_city(sharded_df, house):
+    with patch('training_model.SHARD_MIN_ROWS', 10):
+        model = train_sharded_model(sharded_df, 1, 0)
+    porto = train_model(sharded_df[sharded_df['city'] == 'Porto'], 1, 0)
+    houses = [house, {**house, 'city': 'Aveiro'}, {**house, 'city': 'Braga'}]
+
+    prices = model.predict(houses)
+
+    assert sorted(model.shards) == ['Braga', 'Porto']
+    assert model.shards['Porto'].feature_columns == FEATURE_FIELDS[1:]
+    assert model.cities == ['Aveiro', 'Braga', 'Porto']
+    assert prices[0] == porto.predict([house])[0]
+    assert prices[1] == model.estimator.predict(model.encoder.encode([houses[1]]))[0]
+    assert prices[2] == model.shards['Braga'].predict([houses[2]])[0]
+
+
+def test_sharded_model_refits_only_changed_cities(sharded_df):
+    with patch('training_model.SHARD_MIN_ROWS', 10):
+        previous = train_sharded_model(sharded_df, 1, 0)
+        model = train_sharded_model(sharded_df, 2, 1, previous, changed_cities={'Porto'})
+        small_city_changed = train_sharded_model(sharded_df, 3, 2, previous, changed_cities={'Aveiro'})
+
+    assert model.shards['Braga'] is previous.shards['Braga']
+    assert model.shards['Porto'].version == 2
+    assert model.estimator is previous.estimator
+    assert small_city_changed.estimator is not previous.estimator
+    assert small_city_changed.shards['Porto'] is previous.shards['Porto']
+
+
+def test_sharded_fits_share_the_deadline_and_the_cores(sharded_df):
+    calls = []
+
+    def fit_forest(X, y, params, n_jobs=None, deadline=None):
+        calls.append((n_jobs, deadline))
+        return real_fit_forest(X, y, params, n_jobs=1)
+
+    real_fit_forest = forest_training.fit_forest
+    with patch('training_model.SHARD_MIN_ROWS', 10), patch('training_model.SHARD_TRAINING_THREADS', 2), \
+            patch('forest_training.TRAINING_N_JOBS', 4), patch('forest_training.TRAINING_TIME_BUDGET', 60), \
+            patch('forest_training.fit_forest', side_effect=fit_forest):
+        train_sharded_model(sharded_df, 1, 0)
+
+    # Braga, Porto and the fallback, two cores each and one deadline for all of them
+    assert len(calls) == 3
+    assert {n_jobs for n_jobs, _ in calls} == {2}
+    assert len({deadline for _, deadline in calls}) == 1
+
+
+def test_incremental_retrain_refits_shards_of_new_rows(sharded_df, mock_connect):
+    base, delta = sharded_df.iloc[:25], sharded_df.iloc[25:]
+    write_snapshot(base, 0)
+    set_row_count(mock_connect, len(base))
+    set_training_rows(mock_connect, delta)
+
+    with patch('training_model.MODEL_SHARDING', 'city'), patch('training_model.SHARD_MIN_ROWS', 10):
+        previous = train_sharded_model(base, 1, 0)
+        model, timings = train_from_database(2, 1, previous=previous)
+
+    assert timings['mode'] == 'incremental'
+    assert timings['shards_trained'] == ['Porto']
+    assert model.shards['Porto'].n_rows == 15
+
+
+def test_price_predict_goes_through_the_batcher(houses_df, house):
+    registry = ModelRegistry()
+    registry.install(train_model(houses_df, 1, 0))
+    batcher = PredictionBatcher(window_ms=1)
+
+    with patch('training_model.registry', registry), patch('training_model.prediction_batcher', batcher):
+        price, version = price_predict(*house.values())
+        with pytest.raises(HTTPException) as error:
+            price_predict(*{**house, 'city': 'Lisboa'}.values())
+
+    assert price == registry.model.predict([house])[0]
+    assert batcher.stats()['requests'] == 2
+    assert error.value.status_code == 400
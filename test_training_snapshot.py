@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import numpy as np
+import pytest
+from unittest.mock import patch
+from training_model import frame_from_chunks
+from training_snapshot import write_snapshot, open_snapshot, snapshot_lock
+
+COLUMNS = ['city', 'latitude', 'longitude', 'age', 'num_bedrooms', 'num_bathrooms', 'area', 'is_apartment', 'has_pool', 'garage', 'price', 'seq']
+
+
+def is_mapped(array):
+    while array is not None and not isinstance(array, np.memmap):
+        array = array.base
+    return array is not None
+
+
+@pytest.fixture
+def rows():
+    with open('houses.json') as f:
+        houses = json.load(f)
+    return [tuple(house[column] for column in COLUMNS[:-1]) + (seq,) for seq, house in enumerate(houses, start=1)]
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path):
+    return str(tmp_path / 'snapshot')
+
+
+def test_snapshot_round_trip(rows, snapshot_dir):
+    df = frame_from_chunks([rows])
+
+    snapshot = write_snapshot(df, 3, snapshot_dir)
+    frame = open_snapshot(snapshot_dir).frame()
+
+    assert (snapshot.rows, snapshot.watermark, snapshot.data_version) == (30, 30, 3)
+    # Mapped from the files, not read into memory
+    assert all(is_mapped(frame[column].to_numpy()) for column in COLUMNS[1:])
+    assert list(frame.columns) == list(df.columns)
+    assert list(frame['city']) == list(df['city'])
+    for column in COLUMNS[1:]:
+        assert frame[column].dtype == df[column].dtype
+        assert np.array_equal(np.asarray(frame[column]), df[column].to_numpy())
+
+
+def test_append_new_city_and_nulls(rows, snapshot_dir):
+    snapshot = write_snapshot(frame_from_chunks([rows[:20]]), 0, snapshot_dir)
+    delta_rows = [('Braga',) + row[1:] for row in rows[20:]]
+    delta_rows[0] = delta_rows[0][:3] + (None,) + delta_rows[0][4:]  # NULL age
+
+    snapshot = snapshot.append(frame_from_chunks([delta_rows]), 1)
+    frame = open_snapshot(snapshot_dir).frame()
+
+    assert (snapshot.rows, snapshot.watermark, snapshot.data_version) == (30, 30, 1)
+    assert list(frame['city'][18:22]) == ['Porto', 'Porto', 'Braga', 'Braga']
+    # The age column became float32 to hold the NULL
+    assert frame['age'].dtype == np.float32 and np.isnan(frame['age'][20])
+    assert frame['age'][0] == rows[0][3]
+
+
+def test_append_to_a_float_column_does_not_rewrite_it(rows, snapshot_dir):
+    null_age = [rows[0][:3] + (None,) + rows[0][4:]] + rows[1:20]
+    snapshot = write_snapshot(frame_from_chunks([null_age]), 0, snapshot_dir)
+    age_path = snapshot._column_path('age')
+    inode = os.stat(age_path).st_ino
+
+    # Integer ages are appended to the float32 file in place
+    snapshot = snapshot.append(frame_from_chunks([rows[20:]]), 1)
+
+    assert snapshot._column_path('age') == age_path and os.stat(age_path).st_ino == inode
+    assert list(snapshot.frame()['age'][20:]) == [row[3] for row in rows[20:]]
+
+
+def test_interrupted_column_rewrite_is_ignored(rows, snapshot_dir):
+    snapshot = write_snapshot(frame_from_chunks([rows[:20]]), 0, snapshot_dir)
+    delta_rows = [rows[20][:3] + (None,) + rows[20][4:]] + rows[21:]
+
+    # Killed after rewriting the age column as float32, before the metadata was replaced
+    with patch('training_snapshot._write_metadata', side_effect=OSError("killed")):
+        with pytest.raises(OSError):
+            snapshot.append(frame_from_chunks([delta_rows]), 1)
+
+    frame = open_snapshot(snapshot_dir).frame()
+    assert list(frame['age']) == [row[3] for row in rows[:20]]
+    snapshot = open_snapshot(snapshot_dir).append(frame_from_chunks([delta_rows]), 1)
+    assert snapshot.frame()['age'].dtype == np.float32 and np.isnan(snapshot.frame()['age'][20])
+    assert not os.path.exists(os.path.join(snapshot_dir, 'age.bin'))
+
+
+def test_interrupted_append_is_ignored(rows, snapshot_dir):
+    snapshot = write_snapshot(frame_from_chunks([rows[:20]]), 0, snapshot_dir)
+    # Bytes past the recorded rows, as left by a job killed before it replaced the metadata
+    with open(os.path.join(snapshot_dir, 'price.bin'), 'ab') as f:
+        f.write(b'\0' * 12)
+
+    assert len(open_snapshot(snapshot_dir).frame()) == 20
+    snapshot = snapshot.append(frame_from_chunks([rows[20:]]), 1)
+    assert list(snapshot.frame()['price']) == [row[10] for row in rows]
+
+
+def test_snapshot_in_another_format_is_ignored(rows, snapshot_dir):
+    write_snapshot(frame_from_chunks([rows]), 0, snapshot_dir)
+    with open(os.path.join(snapshot_dir, 'metadata.json')) as f:
+        metadata = json.load(f)
+    with open(os.path.join(snapshot_dir, 'metadata.json'), 'w') as f:
+        json.dump({**metadata, 'format': 0}, f)
+
+    assert open_snapshot(snapshot_dir) is None
+    assert open_snapshot(snapshot_dir + '-missing') is None
+
+
+def test_snapshot_lock_is_exclusive(snapshot_dir):
+    entered = threading.Event()
+
+    def other_job():
+        with snapshot_lock(snapshot_dir):
+            entered.set()
+
+    with snapshot_lock(snapshot_dir):
+        thread = threading.Thread(target=other_job)
+        thread.start()
+        assert not entered.wait(0.2)
+    thread.join(5)
+    assert entered.is_set()
+
+
+def test_write_snapshot_leaves_other_temporary_directories(rows, snapshot_dir):
+    # Left by another writer, e.g. one that was killed
+    os.makedirs(f"{snapshot_dir}.tmp")
+    df = frame_from_chunks([rows])
+
+    snapshot = write_snapshot(df, 1, snapshot_dir)
+
+    assert snapshot.rows == len(rows)
+    assert os.path.isdir(f"{snapshot_dir}.tmp")
+    assert sorted(os.listdir(os.path.dirname(snapshot_dir))) == ["snapshot", "snapshot.tmp"]
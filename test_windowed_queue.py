@@ -0,0 +1,50 @@
+import threading
+import time
+import pytest
+from windowed_queue import WindowedQueue
+
+
+class Item:
+    def __init__(self, value):
+        self.value = value
+        self.queued_at = time.perf_counter()
+
+
+def test_batches_are_cut_at_max_batch():
+    batches = []
+    queue = WindowedQueue(lambda batch: batches.append([item.value for item in batch]), window=60, max_batch=2)
+    for value in range(5):
+        queue.put(Item(value))
+    # The last item only goes once its window ends or the queue is closed
+    queue.close()
+
+    assert [value for batch in batches for value in batch] == list(range(5))
+    assert all(len(batch) <= 2 for batch in batches)
+
+
+def test_put_waits_for_room_and_close_refuses_items():
+    release = threading.Event()
+    handled = []
+
+    def handle_batch(batch):
+        release.wait(5)
+        handled.extend(item.value for item in batch)
+
+    queue = WindowedQueue(handle_batch, window=0.001, max_batch=1, max_queued=1)
+    queue.put(Item(0))
+    # Taken by the worker, which waits in handle_batch
+    while len(queue):
+        time.sleep(0.01)
+    queue.put(Item(1))
+
+    putter = threading.Thread(target=queue.put, args=(Item(2),))
+    putter.start()
+    putter.join(0.2)
+    assert putter.is_alive()
+
+    release.set()
+    putter.join(5)
+    queue.close()
+    assert handled == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        queue.put(Item(3))
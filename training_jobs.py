@@ -0,0 +1,187 @@
+import logging
+import multiprocessing
+import threading
+import time
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
+from training_model import registry, train_from_database
+import training_model
+import model_store
+from metrics import metrics_registry, observe_stages, stage
+
+# Number of processes fitting models, each job trains one model on one core
+TRAINING_WORKERS = int(os.getenv("TRAINING_WORKERS", "1"))
+# Finished jobs kept for GET /model/train/{job_id}
+TRAINING_JOBS_HISTORY = int(os.getenv("TRAINING_JOBS_HISTORY", "100"))
+
+logger = logging.getLogger(__name__)
+
+TRAINING_JOBS = metrics_registry.counter("house_api_training_jobs_total", "Finished training jobs", ["status", "mode"])
+TRAINING_DURATION = metrics_registry.gauge("house_api_training_duration_seconds", "Duration of the last successful training job, from submit to install")
+
+
+def load_previous_model(base_artifact):
+    # City models of the previous model are reused when their rows did not change
+    if base_artifact is None or training_model.MODEL_SHARDING != 'city':
+        return None
+    try:
+        return model_store.load_model(base_artifact)
+    except (OSError, ValueError, KeyError) as error:
+        logger.warning(f"Could not load the previous model from {base_artifact}, every city model is fitted again: {error}")
+        return None
+
+
+def run_training_job(version, data_version, full=False, base_artifact=None):
+    """Entry point of the training processes.
+
+    The fitted estimators are saved as an artifact and loaded back by the API process from disk,
+    instead of being pickled through the process pool. The training rows stay in the training snapshot.
+    """
+    previous = None if full else load_previous_model(base_artifact)
+    model, timings = train_from_database(version, data_version, full, previous)
+    model.training_frame = None
+    try:
+        started_at = time.time()
+        model.artifact_path = model_store.save_model(model)
+        # The API process loads the estimators (or their compiled forests) back from the artifact
+        for fitted in [model, *model.shards.values()]:
+            fitted.estimator = None
+            fitted.forest = None
+        timings['save_seconds'] = round(time.time() - started_at, 3)
+    except OSError as error:
+        logger.error(f"Could not save model version {version}: {error}")
+    return model, timings
+
+
+class TrainingJobRunner:
+    """Runs training jobs in a process pool, so fitting never holds the GIL of the API process.
+
+    The model returned by a finished job is installed in the registry, the model served until then
+    is the previous one. At most one job is pending at a time, asking for a retrain while one is
+    queued or running returns that job instead of starting another.
+    """
+
+    def __init__(self, registry, executor=None, max_workers=TRAINING_WORKERS):
+        self.registry = registry
+        self.max_workers = max_workers
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._pending = None
+
+    def _get_executor(self):
+        # Created on first use, so importing the API does not start processes. "spawn" avoids forking
+        # a process that already runs threads and holds database connections
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def submit(self, reason="manual", full=False):
+        with self._lock:
+            if self._pending is not None:
+                return self._pending
+
+            data_version = self.registry.data_version
+            version = self.registry.next_version()
+            # Rows deleted since the current model was trained are still in the training snapshot, it is rebuilt.
+            # A stale model loaded from disk has data version -1, the rows deleted while the API was down are
+            # caught by the row count check of the snapshot
+            base = self.registry.model
+            full = full or self.registry.full_rebuild_version > (max(base.data_version, 0) if base is not None else 0)
+            base_artifact = base.artifact_path if base is not None else None
+            job = {
+                "job_id": str(uuid4()),
+                "status": "queued",
+                "reason": reason,
+                "full": full,
+                "model_version": version,
+                "data_version": data_version,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "duration_seconds": None,
+                "timings": None,
+                "metrics": None,
+                "error": None,
+                "done": Future()
+            }
+            self._jobs[job["job_id"]] = job
+            self._pending = job
+            self._forget_old_jobs()
+
+        try:
+            future = self._get_executor().submit(run_training_job, version, data_version, full, base_artifact)
+        except Exception as error:
+            future = Future()
+            future.set_exception(error)
+        future.add_done_callback(lambda future: self._finish(job, future))
+        job["future"] = future
+        return job
+
+    def request(self, reason="stale"):
+        """Used by the registry when its model is stale, returns a future set once the new model is installed."""
+        return self.submit(reason)["done"]
+
+    def _finish(self, job, future):
+        try:
+            model, timings = future.result()
+            if model.predictor is None:
+                with stage('artifact_load'):
+                    model_store.load_estimators(model)
+            self.registry.install(model)
+            # Stage times measured in the job process
+            observe_stages(timings.get('stages', {}))
+            if timings.get('save_seconds') is not None:
+                observe_stages({'training_save': timings['save_seconds']})
+            job.update(status="succeeded", timings=timings, metrics=dict(model.metrics, n_rows=model.n_rows), started_at=timings["started_at"])
+            logger.info(f"Training job {job['job_id']} installed model version {model.version}")
+        except Exception as error:
+            job.update(status="failed", error=str(error))
+            logger.error(f"Training job {job['job_id']} failed: {error}")
+            if isinstance(error, BrokenProcessPool):
+                # A worker died (e.g. killed for using too much memory), the next job gets a new pool
+                self._executor = None
+
+        job["finished_at"] = time.time()
+        job["duration_seconds"] = round(job["finished_at"] - job["submitted_at"], 3)
+        TRAINING_JOBS.inc(status=job["status"], mode=(job["timings"] or {}).get("mode", "unknown"))
+        if job["status"] == "succeeded":
+            TRAINING_DURATION.set(job["duration_seconds"])
+        with self._lock:
+            if self._pending is job:
+                self._pending = None
+
+        if job["status"] == "succeeded":
+            job["done"].set_result(job["model_version"])
+        else:
+            job["done"].set_exception(RuntimeError(f"Training job failed: {job['error']}"))
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - TRAINING_JOBS_HISTORY)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+
+        status = job["status"]
+        if status == "queued" and job.get("future") is not None and job["future"].running():
+            status = "running"
+        return {key: value for key, value in job.items() if key not in ("done", "future")} | {"status": status}
+
+    @property
+    def pending_job_id(self):
+        pending = self._pending
+        return pending["job_id"] if pending else None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+runner = TrainingJobRunner(registry)
+registry.trainer = runner.request
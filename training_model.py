@@ -1,22 +1,555 @@
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
 import psycopg2
 import numpy as np
+import threading
+import logging
+import time
+import os
+import db
+import training_snapshot
+from lazy_import import lazy_import
+from compiled_forest import CompiledForest, compare
+from prediction_cache import prediction_cache
+from prediction_batcher import prediction_batcher
+from metrics import metrics_registry, profile, stage
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
 
-def price_predict(city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, connection):
+# Only needed to train, imported on first use
+pd = lazy_import("pandas")
+forest_training = lazy_import("forest_training")
+
+FEATURE_FIELDS = ['city', 'latitude', 'longitude', 'age', 'num_bedrooms', 'num_bathrooms', 'area', 'is_apartment', 'has_pool', 'garage']
+TRAINING_QUERY = "SELECT city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price, seq FROM houses"
+# An incremental retrain is only done while the new rows are at most this fraction of the cached ones
+TRAINING_DRIFT_THRESHOLD = float(os.getenv("TRAINING_DRIFT_THRESHOLD", "0.2"))
+# What to do with a city the model was not trained on: "reject" it, or predict it like the "baseline" city (all city columns 0)
+UNKNOWN_CITY_POLICY = os.getenv("UNKNOWN_CITY_POLICY", "reject")
+# Rows fetched per round trip by the server side cursor reading the training data
+TRAINING_CHUNK_SIZE = int(os.getenv("TRAINING_CHUNK_SIZE", "50000"))
+# The forest is fitted on at most this many rows, sampled per city in proportion to its size. 0 fits on every row
+TRAINING_MAX_ROWS = int(os.getenv("TRAINING_MAX_ROWS", "0"))
+# "city" fits one model per city having at least SHARD_MIN_ROWS rows, the other cities are predicted by a fallback model
+MODEL_SHARDING = os.getenv("MODEL_SHARDING", "none")
+SHARD_MIN_ROWS = int(os.getenv("SHARD_MIN_ROWS", "1000"))
+# The fallback model is fitted on every row of the small cities and at most this many rows of the sharded ones
+SHARD_FALLBACK_ROWS = int(os.getenv("SHARD_FALLBACK_ROWS", "20000"))
+# City models fitted at the same time, the trees release the GIL while they are built
+SHARD_TRAINING_THREADS = int(os.getenv("SHARD_TRAINING_THREADS", str(os.cpu_count() or 1)))
+# "compiled" serves predictions from the trees flattened into arrays (compiled_forest.py), "sklearn" from the fitted estimator
+MODEL_PREDICTOR = os.getenv("MODEL_PREDICTOR", "compiled")
+# Smallest types holding the values of each column, the features end up as float32 in the forest anyway
+TRAINING_DTYPES = {
+    'latitude': np.float32,
+    'longitude': np.float32,
+    'age': np.int32,
+    'num_bedrooms': np.int32,
+    'num_bathrooms': np.int32,
+    'area': np.float32,
+    'is_apartment': np.bool_,
+    'has_pool': np.bool_,
+    'garage': np.bool_,
+    'price': np.int32,
+    'seq': np.int64
+}
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownCityError(ValueError):
+    pass
+
+
+class FeatureEncoder:
+    """Writes houses straight into a float32 feature matrix laid out like the training columns.
+
+    It replaces building a DataFrame, calling get_dummies and reindexing it for every request:
+    each numeric field goes to its precomputed column and each city to its one-hot column.
+    The city dropped by get_dummies(drop_first=True) is known but has no column, it is all zeros.
+    """
+
+    def __init__(self, feature_columns, cities):
+        self.n_features = len(feature_columns)
+        self.numeric_columns = [(field, feature_columns.index(field)) for field in FEATURE_FIELDS[1:] if field in feature_columns]
+        self.city_columns = {column[len('city_'):]: index for index, column in enumerate(feature_columns) if column.startswith('city_')}
+        self.cities = set(cities)
+
+    def unknown_city_error(self, house):
+        if house['city'] not in self.cities and UNKNOWN_CITY_POLICY == 'reject':
+            return f"Unknown city: {house['city']}"
+        return None
+
+    def encode(self, houses):
+        X = np.zeros((len(houses), self.n_features), dtype=np.float32)
+        for row, house in zip(X, houses):
+            for field, index in self.numeric_columns:
+                row[index] = house[field]
+            index = self.city_columns.get(house['city'])
+            if index is not None:
+                row[index] = 1
+            elif self.unknown_city_error(house):
+                raise UnknownCityError(self.unknown_city_error(house))
+        return X
+
+
+class TrainedModel:
+    """A fitted model together with everything needed to build its input rows.
+
+    With sharding, shards maps a city to its own model (without city columns), the estimator of
+    this model is then the fallback used for the other cities.
+    """
+
+    def __init__(self, estimator, feature_columns, cities, version, data_version):
+        self.estimator = estimator
+        self.feature_columns = feature_columns
+        self.cities = cities
+        self.version = version
+        self.data_version = data_version
+        self.trained_at = time.time()
+        self.n_rows = None
+        self.metrics = {}
+        # Highest houses.seq seen by the model, and the raw rows it was fitted on
+        self.watermark = 0
+        self.training_frame = None
+        self.training_mode = 'full'
+        self.artifact_path = None
+        # File the estimator was saved to, an unchanged estimator is linked from there into the next artifact
+        self.estimator_file = None
+        # Compiled copy of the estimator, predictions come from it when it is set
+        self.forest = None
+        self.encoder = FeatureEncoder(feature_columns, cities)
+        self.shards = {}
+
+    def _predict(self, houses):
+        with stage('encode'):
+            X = self.encoder.encode(houses)
+        with stage('predict'):
+            return self.predictor.predict(X)
+
+    @property
+    def predictor(self):
+        return self.forest if self.forest is not None else self.estimator
+
+    def predict(self, houses):
+        if not self.shards:
+            return self._predict(houses)
+
+        # Each house goes to the model of its city, houses of the cities without one to the fallback
+        positions = {}
+        for position, house in enumerate(houses):
+            positions.setdefault(house['city'] if house['city'] in self.shards else None, []).append(position)
+        prices = np.empty(len(houses))
+        for city, city_positions in positions.items():
+            model = self.shards[city] if city is not None else self
+            prices[city_positions] = model._predict([houses[position] for position in city_positions])
+        return prices
+
+    @property
+    def tree_nodes(self):
+        def node_count(model):
+            if model.forest is not None:
+                return model.forest.node_count
+            return sum(tree.tree_.node_count for tree in model.estimator.estimators_)
+        return int(sum(node_count(model) for model in [self, *self.shards.values()]))
+
+    @property
+    def artifact_bytes(self):
+        if self.artifact_path is None:
+            return None
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(self.artifact_path) for name in names)
+
+
+def build_features(df):
+    """Returns the float32 feature matrix of a training frame, its column names and the cities seen.
+
+    The matrix has the columns get_dummies(drop_first=True) would give, but it is written in a single
+    float32 allocation from the city codes instead of going through a copy of the frame per step.
+    """
+    cities = sorted(df['city'].dropna().unique().tolist())
+    feature_columns = FEATURE_FIELDS[1:] + [f'city_{city}' for city in cities[1:]]
+
+    X = np.zeros((len(df), len(feature_columns)), dtype=np.float32)
+    for index, field in enumerate(FEATURE_FIELDS[1:]):
+        X[:, index] = df[field].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    # One-hot columns straight from the category codes, one boolean row mask per city at a time
+    city = df['city'] if isinstance(df['city'].dtype, pd.CategoricalDtype) else df['city'].astype('category')
+    codes = city.cat.codes.to_numpy()
+    category_codes = {name: code for code, name in enumerate(city.cat.categories)}
+    for index, name in enumerate(cities[1:]):
+        X[:, len(FEATURE_FIELDS) - 1 + index] = codes == category_codes[name]
+    return X, feature_columns, cities
+
+
+def stratified_sample(cities, max_rows, seed=42):
+    """Positions of at most about max_rows rows, every city keeping its share of the rows and at least one."""
+    rng = np.random.default_rng(seed)
+    codes = pd.Categorical(cities).codes
+    positions = []
+    for code in np.unique(codes):
+        city_positions = np.flatnonzero(codes == code)
+        size = max(1, round(max_rows * len(city_positions) / len(codes)))
+        positions.append(city_positions if size >= len(city_positions) else rng.choice(city_positions, size, replace=False))
+    return np.sort(np.concatenate(positions))
+
+
+def train_model(df, version, data_version, deadline=None, n_jobs=None):
+    """Fits a model on a training frame, by the deadline (a time.perf_counter(), from TRAINING_TIME_BUDGET
+    when not given) and on n_jobs cores (TRAINING_N_JOBS when not given)."""
+    if deadline is None:
+        deadline = forest_training.deadline()
+    training_frame = df
+    fit_frame = df
+    if TRAINING_MAX_ROWS and len(df) > TRAINING_MAX_ROWS:
+        fit_frame = df.iloc[stratified_sample(df['city'], TRAINING_MAX_ROWS)]
+
+    with stage('training_encode'):
+        X, feature_columns, cities = build_features(fit_frame)
+        y = fit_frame['price'].to_numpy()
+
+    params = forest_training.forest_params()
+    cv_results = None
+    if forest_training.TRAINING_MODEL_SELECTION == 'cv' and len(fit_frame) >= 2:
+        # The folds are fitted on the same encoded matrix, the best parameters are then fitted on every row
+        with stage('training_cv'):
+            cv_started_at = time.perf_counter()
+            # Cross-validation may use its share of the time left, the final fit gets the rest
+            cv_deadline = None if deadline is None else cv_started_at + max(0.0, deadline - cv_started_at) * forest_training.TRAINING_CV_BUDGET_SHARE
+            cv_results = forest_training.cross_validate(X, y, n_jobs=n_jobs, deadline=cv_deadline)
+            cv_seconds = time.perf_counter() - cv_started_at
+        if cv_results[0]['cv_mae'] is not None:
+            params = cv_results[0]['params']
+        else:
+            logger.warning("Cross-validation did not complete any combination within the time budget, fitting the configured parameters")
+
+    # Trainning the model, the out-of-bag predictions give an error estimate without a hold-out set.
+    # Fitted on the float32 array the forest uses internally anyway, predictions then come from FeatureEncoder arrays
+    with stage('training_fit'):
+        fit_started_at = time.perf_counter()
+        model = forest_training.fit_forest(X, y, params, n_jobs=n_jobs, deadline=deadline)
+        fit_seconds = time.perf_counter() - fit_started_at
+
+    trained_model = TrainedModel(model, feature_columns, cities, version, data_version)
+    trained_model.n_rows = len(df)
+    trained_model.training_frame = training_frame
+    if 'seq' in training_frame and len(training_frame):
+        trained_model.watermark = int(training_frame['seq'].max())
+    trained_model.metrics = {
+        # None when the time budget ran out before the out-of-bag predictions
+        'oob_r2': float(model.oob_score_) if hasattr(model, 'oob_score_') else None,
+        'oob_mae': float(np.mean(np.abs(model.oob_prediction_ - y))) if hasattr(model, 'oob_prediction_') else None,
+        'fit_rows': len(fit_frame),
+        # Trees actually grown, fewer than asked for when the time budget ran out
+        'params': {**params, 'n_estimators': len(model.estimators_)},
+        'cores': forest_training.cores(n_jobs),
+        'fit_seconds': round(fit_seconds, 3)
+    }
+    if cv_results is not None:
+        trained_model.metrics.update({
+            'cv_mae': cv_results[0]['cv_mae'],
+            'cv_folds': min(forest_training.TRAINING_CV_FOLDS, len(fit_frame)),
+            # Combinations cross-validated on every fold before the time budget ran out
+            'cv_scored': sum(result['cv_mae'] is not None for result in cv_results),
+            'cv_seconds': round(cv_seconds, 3),
+            'cv_results': cv_results
+        })
+
+    if MODEL_PREDICTOR == 'compiled':
+        with stage('training_compile'):
+            forest = CompiledForest.from_estimator(model)
+            # Checked on the first training rows, the report (memory, single row latency) is kept with the metrics
+            report = compare(model, forest, X[:1000])
+        trained_model.metrics.update(report)
+        if report['compiled_max_abs_error'] > 1e-4 * max(1.0, float(np.abs(y).max(initial=0))):
+            logger.warning(f"Compiled forest of model version {version} differs from the estimator by {report['compiled_max_abs_error']}, serving the estimator")
+        else:
+            trained_model.forest = forest
+    return trained_model
+
+
+def train_sharded_model(df, version, data_version, previous=None, changed_cities=None, deadline=None):
+    """Fits one model per large city and a fallback model for the others, in parallel.
+
+    Given the previous sharded model and the cities whose rows changed since (None when unknown),
+    only the models of those cities are fitted again, the others are reused as they are. Every fit
+    ends by the same deadline, and the cores are split between the SHARD_TRAINING_THREADS fits.
+    """
+    if deadline is None:
+        deadline = forest_training.deadline()
+    n_jobs = max(1, forest_training.cores() // max(1, SHARD_TRAINING_THREADS))
+    counts = df['city'].value_counts()
+    shard_cities = sorted(city for city, count in counts.items() if count >= SHARD_MIN_ROWS)
+    small_cities = set(counts.index[counts > 0]) - set(shard_cities)
+
+    def reusable(city):
+        return previous is not None and changed_cities is not None and city in previous.shards and city not in changed_cities
+
+    # The fallback knows every city (one row of each is enough), so the unknown city policy works as without sharding
+    is_sharded = df['city'].isin(shard_cities).to_numpy()
+    sharded_positions = np.flatnonzero(is_sharded)
+    if len(sharded_positions) > SHARD_FALLBACK_ROWS:
+        sharded_positions = sharded_positions[stratified_sample(df['city'].iloc[sharded_positions], SHARD_FALLBACK_ROWS)]
+    fallback_positions = np.sort(np.concatenate([np.flatnonzero(~is_sharded), sharded_positions]))
+    reuse_fallback = (
+        previous is not None and changed_cities is not None
+        and not small_cities & set(changed_cities) and set(counts.index[counts > 0]) <= set(previous.cities)
+    )
+
+    def fit(frame):
+        # The stages of the models fitted side by side would add up to more than the wall time, only the total is kept
+        with profile():
+            model = train_model(frame, version, data_version, deadline=deadline, n_jobs=n_jobs)
+        model.training_frame = None
+        return model
+
+    with stage('training_fit'), ThreadPoolExecutor(max_workers=max(1, SHARD_TRAINING_THREADS)) as executor:
+        shard_futures = {city: executor.submit(fit, df[df['city'] == city]) for city in shard_cities if not reusable(city)}
+        fallback_future = None if reuse_fallback else executor.submit(fit, df.iloc[fallback_positions])
+        shards = {city: previous.shards[city] if reusable(city) else shard_futures[city].result() for city in shard_cities}
+        fallback = previous if reuse_fallback else fallback_future.result()
+
+    model = TrainedModel(fallback.estimator, fallback.feature_columns, fallback.cities, version, data_version)
+    model.shards = shards
+    model.n_rows = len(df)
+    model.training_frame = df
+    if len(df):
+        model.watermark = int(df['seq'].max())
+    model.metrics = dict(fallback.metrics)
+    model.estimator_file = fallback.estimator_file
+    model.forest = fallback.forest
+    return model
+
+
+def _column(values, dtype):
+    # NULLs turn the column into float32 NaN, which the forest handles as missing values
+    if any(value is None for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float32)
+    return np.array(values, dtype=dtype)
+
+
+def frame_from_chunks(chunks):
+    """Builds a compact training frame from chunks of TRAINING_QUERY rows.
+
+    Every column gets its smallest type and the city a categorical code, only the
+    Python tuples of the chunk being converted exist at a time.
+    """
+    names = list(TRAINING_DTYPES)
+    arrays = {name: [] for name in names}
+    city_codes = {}
+    city_arrays = []
+    for rows in chunks:
+        city, *columns = zip(*rows)
+        city_arrays.append(np.array([city_codes.setdefault(name, len(city_codes)) for name in city], dtype=np.int32))
+        for name, values in zip(names, columns):
+            arrays[name].append(_column(values, TRAINING_DTYPES[name]))
+
+    if not city_arrays:
+        return pd.DataFrame({'city': pd.Categorical([]), **{name: np.empty(0, dtype) for name, dtype in TRAINING_DTYPES.items()}})
+    # A column with NULLs in any chunk is float32 in all of them (numpy would promote int32 + float32 to float64)
+    dtypes = {name: TRAINING_DTYPES[name] if all(array.dtype == TRAINING_DTYPES[name] for array in arrays[name]) else np.float32 for name in names}
+    # Each column's chunks are freed as soon as they are joined, so only one column exists twice at a time
+    df = pd.DataFrame({name: np.concatenate(arrays.pop(name), dtype=dtypes[name]) for name in names}, copy=False)
+    df.insert(0, 'city', pd.Categorical.from_codes(np.concatenate(city_arrays), categories=list(city_codes)))
+    return df
+
+
+def concat_frames(base_frame, delta):
+    if not len(delta):
+        return base_frame
+    # Concatenating categoricals with different categories would turn the city back into strings
+    if isinstance(base_frame['city'].dtype, pd.CategoricalDtype) and isinstance(delta['city'].dtype, pd.CategoricalDtype):
+        city = pd.api.types.union_categoricals([base_frame['city'], delta['city']], ignore_order=True)
+        df = pd.concat([base_frame.drop(columns='city'), delta.drop(columns='city')], ignore_index=True)
+        df.insert(0, 'city', city)
+        return df
+    return pd.concat([base_frame, delta], ignore_index=True)
+
+
+def iter_training_chunks(connection, after_seq=None):
+    # A named (server side) cursor, so only one chunk of rows is ever held by psycopg2
+    with connection.cursor(name='training_data') as cursor:
+        cursor.itersize = TRAINING_CHUNK_SIZE
+        if after_seq is None:
+            cursor.execute(TRAINING_QUERY)
+        else:
+            cursor.execute(f"{TRAINING_QUERY} WHERE seq > %(after_seq)s", {'after_seq': after_seq})
+        while True:
+            rows = cursor.fetchmany(TRAINING_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+
+
+def load_training_data(connection, after_seq=None):
+    return frame_from_chunks(iter_training_chunks(connection, after_seq))
+
+
+def load_delta(connection, base_rows, base_watermark):
+    """Returns the rows added after the watermark, or None when the cached rows can not be reused."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM houses WHERE seq <= %s", (base_watermark,))
+        kept_rows = cursor.fetchone()[0]
+
+    # Rows were deleted, or committed with a seq below the watermark after it was taken
+    if kept_rows != base_rows:
+        logger.info(f"Full retrain: {kept_rows} rows up to seq {base_watermark} in houses, {base_rows} cached")
+        return None
+    delta = load_training_data(connection, after_seq=base_watermark)
+    if len(delta) > TRAINING_DRIFT_THRESHOLD * base_rows:
+        logger.info(f"Full retrain: {len(delta)} new rows is past the drift threshold for {base_rows} cached rows")
+        return None
+    return delta
+
+
+def update_snapshot(snapshot, delta, data_version):
+    """Appends the new rows to the training snapshot and returns the training frame read from it."""
     try:
-        query = "SELECT city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage, price FROM houses"
-        df = pd.read_sql(query, connection)
+        with stage('training_snapshot'):
+            return snapshot.append(delta, data_version).frame()
+    except OSError as error:
+        # The snapshot is left as it was, the next job appends the rows again
+        logger.error(f"Could not append to the training snapshot: {error}")
+        return concat_frames(snapshot.frame(), delta)
+
+
+def save_snapshot(df, data_version):
+    try:
+        with stage('training_snapshot'):
+            training_snapshot.write_snapshot(df, data_version)
+    except OSError as error:
+        logger.error(f"Could not write the training snapshot: {error}")
+
+
+def train_from_database(version, data_version, full=False, previous=None):
+    """Fits a new model, this is what runs inside a training job process.
+
+    The rows come from the training snapshot, the database is only asked for the rows past its
+    watermark, which are appended to it. The whole houses table is read again (and the snapshot
+    rewritten) when a full retrain is asked for, when rows were deleted or too many were added.
+    With sharding, the city models of the previous model whose rows did not change are reused.
+    """
+    started_at = time.time()
+    # One wall-clock budget for the whole job, loading included
+    deadline = forest_training.deadline()
+    # The job usually runs in another process, its stage times go back with the model instead of into its own metrics
+    with profile() as stages:
+        # The snapshot is locked from its watermark to its last write, a job of another worker waits for it
+        with stage('training_load'), closing(db.connect()) as connection, training_snapshot.snapshot_lock():
+            # Same snapshot for the row count and the rows read
+            connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+
+            snapshot = None if full else training_snapshot.open_snapshot()
+            delta = load_delta(connection, snapshot.rows, snapshot.watermark) if snapshot is not None else None
+            if delta is not None:
+                df = update_snapshot(snapshot, delta, data_version)
+            else:
+                df = load_training_data(connection)
+                save_snapshot(df, data_version)
+        loaded_at = time.time()
 
-        df = pd.get_dummies(df, columns=['city'], drop_first=True)
-        
-        X = df.drop('price', axis=1)
-        y = df['price']
+        if MODEL_SHARDING == 'city':
+            changed_cities = set(delta['city'].unique()) if delta is not None else None
+            model = train_sharded_model(df, version, data_version, previous, changed_cities, deadline=deadline)
+        else:
+            model = train_model(df, version, data_version, deadline=deadline)
+        finished_at = time.time()
 
-        # Trainning the model
-        model = RandomForestRegressor(n_estimators=100, random_state=42)
-        model.fit(X, y)
+    model.training_mode = 'incremental' if delta is not None else 'full'
+    timings = {
+        'started_at': started_at,
+        'load_seconds': round(loaded_at - started_at, 3),
+        'fit_seconds': round(finished_at - loaded_at, 3),
+        'cores': forest_training.cores(),
+        'mode': model.training_mode,
+        'rows_loaded': len(delta) if delta is not None else len(df),
+        'shards_trained': sorted(city for city, shard in model.shards.items() if shard.version == version),
+        'stages': {name: round(seconds, 6) for name, seconds in stages.items()}
+    }
+    return model, timings
+
+
+class ModelRegistry:
+    """Keeps the fitted model in memory and retrains it only when the data has changed.
+
+    Every write to the houses table bumps the data version through mark_stale(),
+    a cached model is served for as long as it was trained on the current data version.
+    Training itself is delegated to the trainer (the training job runner), which is asked
+    for a new model when the current one is stale and installs it with install().
+    """
+
+    def __init__(self, trainer=None):
+        self._lock = threading.Lock()
+        self._data_version = 0
+        self._last_version = 0
+        # Models trained before this data version include deleted rows, they can not be extended incrementally
+        self.full_rebuild_version = 0
+        self.trainer = trainer
+        self.model = None
+
+    @property
+    def data_version(self):
+        return self._data_version
+
+    def mark_stale(self, rows_deleted=False):
+        with self._lock:
+            self._data_version += 1
+            if rows_deleted:
+                self.full_rebuild_version = self._data_version
+
+    def is_stale(self, model):
+        return model is None or model.data_version != self._data_version
+
+    def next_version(self):
+        with self._lock:
+            self._last_version += 1
+            return self._last_version
+
+    def install(self, model):
+        # Swapping the reference is atomic, requests already holding the previous model finish with it
+        with self._lock:
+            # Models loaded from disk carry their own version, new ones must be numbered after it
+            self._last_version = max(self._last_version, model.version)
+            if self.model is None or model.version > self.model.version:
+                self.model = model
+                return True
+            return False
+
+    def get_model(self, timeout=None):
+        model = self.model
+        if not self.is_stale(model):
+            return model
+
+        # Retraining happens in the background, the previous model keeps serving until it is replaced.
+        # Only the very first prediction, with no model at all, has to wait for the job
+        training = self.trainer("stale")
+        if model is None:
+            training.result(timeout)
+            model = self.model
+        return model
+
+
+registry = ModelRegistry()
+
+
+def _model_gauge(name, documentation, value):
+    # Read at scrape time from the model being served, nothing is reported before the first one is installed
+    def read():
+        model = registry.model
+        return value(model) if model is not None and model.predictor is not None else None
+    return metrics_registry.gauge(name, documentation, function=read)
+
+
+_model_gauge("house_api_model_version", "Version of the model serving predictions", lambda model: model.version)
+_model_gauge("house_api_model_rows", "Rows the served model was trained on", lambda model: model.n_rows)
+_model_gauge("house_api_model_tree_nodes", "Nodes in all the trees of the served model", lambda model: model.tree_nodes)
+_model_gauge("house_api_model_artifact_bytes", "Size on disk of the served model artifact", lambda model: model.artifact_bytes)
+_model_gauge("house_api_model_stale", "1 while the served model is older than the data", lambda model: int(registry.is_stale(model)))
+
+
+def price_predict(city, latitude, longitude, age, num_bedrooms, num_bathrooms, area, is_apartment, has_pool, garage):
+    try:
+        with stage('model'):
+            model = registry.get_model()
 
         # Create input data frame
         house_data = {
@@ -32,16 +565,37 @@ def price_predict(city, latitude, longitude, age, num_bedrooms, num_bathrooms, a
             'garage': garage
         }
 
-        city_dummies = pd.get_dummies(pd.Series([city]), prefix='city')
+        # Same (rounded) house and same model, same price
+        with stage('cache'):
+            house_price = prediction_cache.get(model.version, house_data)
+        if house_price is None:
+            if prediction_batcher.enabled:
+                # Shares a predict call with the houses of concurrent requests
+                with stage('batch'):
+                    house_price = prediction_batcher.predict(model, house_data)
+            else:
+                house_price = float(model.predict([house_data])[0])
+            prediction_cache.put(model.version, house_data, house_price)
+        return house_price, model.version
 
-        house_data.update(city_dummies.to_dict(orient='list'))
+    except UnknownCityError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error while training and predicting: {e}")
 
-        house_df = pd.DataFrame(house_data)
 
-        house_df = house_df.reindex(columns=X.columns, fill_value=0)
+def batch_predict(houses):
+    try:
+        with stage('model'):
+            model = registry.get_model()
 
-        price_prediction = model.predict(house_df)
-        return price_prediction[0]
+        # Houses in a city the model does not know get an error, the others go through
+        # a single feature matrix and a single predict call
+        errors = [model.encoder.unknown_city_error(house) for house in houses]
+        known_houses = [house for house, error in zip(houses, errors) if error is None]
+        price_predictions = iter(model.predict(known_houses) if known_houses else [])
+        results = [{'error': error} if error else {'price': float(next(price_predictions))} for error in errors]
+        return results, model.version
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error while training and predicting: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error while training and predicting: {e}")
@@ -0,0 +1,204 @@
+import json
+import fcntl
+import logging
+import shutil
+import tempfile
+import os
+from contextlib import contextmanager
+import numpy as np
+from lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+
+# Directory of the columnar copy of the training data, read by training jobs instead of the houses table
+TRAINING_SNAPSHOT_DIR = os.getenv("TRAINING_SNAPSHOT_DIR", "snapshot")
+# Bumped whenever the layout of the snapshot changes, an older snapshot is then rebuilt from the database
+SNAPSHOT_FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+class TrainingSnapshot:
+    """Append-only columnar copy of the training rows, one raw binary file per column.
+
+    metadata.json records the number of rows, the highest seq (watermark) and the data version
+    they match, the column types and the city names the codes of city.bin point to. Columns are
+    memory-mapped when read, and rows added to the table later are appended to the files, so a
+    retrain reads from the database only the rows past the watermark.
+    The metadata is replaced last and is the only commit point: bytes written past its row count by an
+    interrupted append are ignored, and a column rewritten in another type goes to a new file that
+    only the new metadata points to.
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+
+    @property
+    def rows(self):
+        return self.metadata["rows"]
+
+    @property
+    def watermark(self):
+        return self.metadata["watermark"]
+
+    @property
+    def data_version(self):
+        return self.metadata["data_version"]
+
+    def _column_path(self, name, files=None):
+        files = self.metadata.get("files", {}) if files is None else files
+        return os.path.join(self.path, files.get(name, f"{name}.bin"))
+
+    def _read_column(self, name):
+        if not self.rows:
+            return np.empty(0, dtype=self.metadata["dtypes"][name])
+        return np.memmap(self._column_path(name), dtype=self.metadata["dtypes"][name], mode="r", shape=(self.rows,))
+
+    def frame(self):
+        """The training frame, its columns are mapped from the files rather than read into memory."""
+        columns = {name: self._read_column(name) for name in self.metadata["dtypes"] if name != "city"}
+        df = pd.DataFrame(columns, copy=False)
+        df.insert(0, "city", pd.Categorical.from_codes(self._read_column("city"), categories=self.metadata["cities"]))
+        return df
+
+    def append(self, delta, data_version):
+        """Appends the rows of a training frame (newer than the watermark) and returns the updated snapshot."""
+        if not len(delta):
+            return self._write_metadata({**self.metadata, "data_version": data_version})
+
+        cities = list(self.metadata["cities"])
+        dtypes = dict(self.metadata["dtypes"])
+        files = dict(self.metadata.get("files", {}))
+        replaced = []
+        for name, values in _columns(delta, cities).items():
+            dtype = np.dtype(dtypes[name])
+            if not np.can_cast(values.dtype, dtype, casting="same_kind"):
+                # NULLs in the new rows turned an integer or boolean column into float32, it is rewritten as float32
+                # to a new file, the current one stays valid for the current metadata until it is replaced
+                replaced.append(self._column_path(name))
+                dtype = np.dtype(np.float32)
+                files[name] = f"{name}.{dtype.name}.bin"
+                dtypes[name] = dtype.name
+                _write_file(self._column_path(name, files), self._read_column(name).astype(dtype))
+            path = self._column_path(name, files)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                # Drops what an interrupted append may have left past the recorded rows
+                f.truncate(self.rows * dtype.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(values.astype(dtype, copy=False).tobytes())
+
+        snapshot = self._write_metadata({
+            **self.metadata,
+            "rows": self.rows + len(delta),
+            "watermark": max(self.watermark, int(delta["seq"].max())),
+            "data_version": data_version,
+            "cities": cities,
+            "dtypes": dtypes,
+            "files": files
+        })
+        for path in replaced:
+            os.remove(path)
+        return snapshot
+
+    def _write_metadata(self, metadata):
+        _write_metadata(self.path, metadata)
+        return TrainingSnapshot(self.path, metadata)
+
+
+def _columns(df, cities):
+    """The columns of a training frame as arrays, the city as codes into cities (which new names are added to)."""
+    codes = {name: code for code, name in enumerate(cities)}
+    city = df["city"] if isinstance(df["city"].dtype, pd.CategoricalDtype) else df["city"].astype("category")
+    for name in city.cat.categories:
+        if name not in codes:
+            codes[name] = len(cities)
+            cities.append(name)
+    category_codes = np.array([codes[name] for name in city.cat.categories] + [-1], dtype=np.int32)
+
+    columns = {"city": category_codes[city.cat.codes.to_numpy()]}
+    for name in df.columns:
+        if name != "city":
+            columns[name] = df[name].to_numpy()
+    return columns
+
+
+def _write_file(path, array):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, path)
+
+
+def _write_metadata(path, metadata):
+    tmp_path = os.path.join(path, "metadata.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, os.path.join(path, "metadata.json"))
+
+
+def write_snapshot(df, data_version, snapshot_dir=None):
+    """Replaces the snapshot with the rows of a training frame.
+
+    The new snapshot is written next to the current one and swapped in with renames. Callers hold
+    snapshot_lock(), the temporary directories are still unique to the call.
+    """
+    snapshot_dir = snapshot_dir or TRAINING_SNAPSHOT_DIR
+    parent, name = os.path.split(os.path.abspath(snapshot_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f"{name}.tmp-", dir=parent)
+
+    cities = []
+    columns = _columns(df, cities)
+    for name, values in columns.items():
+        _write_file(os.path.join(tmp_path, f"{name}.bin"), values)
+    _write_metadata(tmp_path, {
+        "format": SNAPSHOT_FORMAT,
+        "rows": len(df),
+        "watermark": int(df["seq"].max()) if len(df) else 0,
+        "data_version": data_version,
+        "cities": cities,
+        "dtypes": {name: values.dtype.name for name, values in columns.items()}
+    })
+
+    old_path = f"{tmp_path}.old"
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old_path)
+    os.rename(tmp_path, snapshot_dir)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return open_snapshot(snapshot_dir)
+
+
+@contextmanager
+def snapshot_lock(snapshot_dir=None):
+    """Exclusive lock of the snapshot across processes, held by a training job while it reads and writes it.
+
+    Every API worker runs its own training jobs, without it two jobs could append to the same files or
+    swap the directory under each other. The lock file sits next to the directory, which write_snapshot replaces.
+    """
+    snapshot_dir = snapshot_dir or TRAINING_SNAPSHOT_DIR
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_dir)), exist_ok=True)
+    with open(f"{snapshot_dir}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_snapshot(snapshot_dir=None):
+    """Returns the snapshot, or None when there is none this code can read."""
+    snapshot_dir = snapshot_dir or TRAINING_SNAPSHOT_DIR
+    try:
+        with open(os.path.join(snapshot_dir, "metadata.json")) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning(f"Could not read the training snapshot in {snapshot_dir}: {error}")
+        return None
+
+    if metadata.get("format") != SNAPSHOT_FORMAT:
+        logger.info(f"Ignoring training snapshot in {snapshot_dir} written in format {metadata.get('format')}")
+        return None
+    return TrainingSnapshot(snapshot_dir, metadata)
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class WindowedQueue:
+    """Queue drained in batches by a worker thread, started on the first put().
+
+    The first item queued opens a window of window seconds; the batch is handed to handle_batch when
+    the window ends or max_batch items are queued, whichever comes first. Items queued while a batch
+    is handled go in the next one, whose window has usually already ended by then. Items have a
+    queued_at (time.perf_counter()) the window is measured from. With max_queued, put() waits for
+    room. close() hands over what is still queued and stops the thread.
+    """
+
+    def __init__(self, handle_batch, window, max_batch, max_queued=None, name="windowed-queue"):
+        self.handle_batch = handle_batch
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.max_queued = None if max_queued is None else max(self.max_batch, max_queued)
+        self.name = name
+        self._condition = threading.Condition()
+        self._items = []
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._condition:
+            while self.max_queued is not None and len(self._items) >= self.max_queued and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise RuntimeError(f"The {self.name} queue is closed")
+            self._items.append(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if not self._items:
+                return None
+            deadline = self._items[0].queued_at + self.window
+            while len(self._items) < self.max_batch and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._items[:self.max_batch]
+            del self._items[:self.max_batch]
+            # Callers waiting for room in the queue
+            self._condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.handle_batch(batch)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()